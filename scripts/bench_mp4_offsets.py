@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Benchmark of the chunk offset update of the vendored mutagen, on tag saves
+
+# Usage:
+# `python3 scripts/bench_mp4_offsets.py`
+# `python3 scripts/bench_mp4_offsets.py --hours 4 --saves 20`
+
+# Writes a synthetic stem file: five tracks of `--hours` of ALAC (one
+# 4096-frame sample per chunk, the worst case) with their `stco` tables, and a
+# tiny `mdat` (mutagen doesn't read the samples). Then saves tags of growing
+# size without padding, so every save moves `mdat` and rewrites all the
+# offsets, with the previous list-based update and the current one. The two
+# files must end up identical.
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "stemgen", "ni-stem"))
+
+import mutagen.mp4  # noqa: E402
+from mutagen._util import cdata  # noqa: E402
+
+TRACKS = 5
+SAMPLE_RATE = 44100
+FRAMES_PER_SAMPLE = 4096
+# ALAC of 16-bit stereo is around 60% of the PCM
+BYTES_PER_SECOND = SAMPLE_RATE * 2 * 2 * 0.6
+
+
+def _box(kind, *payloads):
+    payload = b"".join(payloads)
+    return struct.pack(">I4s", len(payload) + 8, kind) + payload
+
+
+def _full(kind, *payloads):
+    return _box(kind, b"\x00\x00\x00\x00", *payloads)
+
+
+def write_file(path, hours):
+    chunks = int(hours * 3600 * SAMPLE_RATE / FRAMES_PER_SAMPLE)
+    chunk_size = int(BYTES_PER_SECOND * FRAMES_PER_SAMPLE / SAMPLE_RATE)
+    large = TRACKS * chunks * chunk_size > 0xFFFFFFFF - 2**20
+
+    traks = []
+    for track in range(TRACKS):
+        # Interleaved: the chunks of the five tracks follow each other
+        offsets = [2**20 + (i * TRACKS + track) * chunk_size for i in range(chunks)]
+        if large:
+            table = _full(b"co64", struct.pack(f">I{chunks}Q", chunks, *offsets))
+        else:
+            table = _full(b"stco", struct.pack(f">I{chunks}I", chunks, *offsets))
+        stbl = _box(b"stbl", _full(b"stsc", struct.pack(">IIII", 1, 1, 1, 1)), table)
+        # Not a sound handler: mutagen skips the stream info
+        hdlr = _full(b"hdlr", b"\x00" * 4 + b"stem" + b"\x00" * 13)
+        traks.append(_box(b"trak", _box(b"mdia", hdlr, _box(b"minf", stbl))))
+
+    with open(path, "wb") as f:
+        f.write(_box(b"ftyp", b"M4A ", b"\x00\x00\x00\x00", b"M4A mp42isom"))
+        f.write(_box(b"moov", *traks))
+        f.write(_box(b"mdat", b"\x00" * 1024))
+
+    return chunks, large
+
+
+def _update_offset_table_lists(self, fileobj, dtype, atom, delta, offset):
+    """The previous implementation: unpack, comprehension, pack"""
+    fmt = ">%dI" if dtype == ">u4" else ">%dQ"
+    if atom.offset > offset:
+        atom.offset += delta
+    fileobj.seek(atom.offset + 12)
+    data = fileobj.read(atom.length - 12)
+    fmt = fmt % cdata.uint_be(data[:4])
+    offsets = struct.unpack(fmt, data[4:])
+    offsets = [o + (0, delta)[offset < o] for o in offsets]
+    fileobj.seek(atom.offset + 16)
+    fileobj.write(struct.pack(fmt, *offsets))
+
+
+def _update_parents_reads(self, fileobj, path, delta):
+    """The previous implementation: read every size back from the file"""
+    if delta == 0:
+        return
+    for atom in path:
+        fileobj.seek(atom.offset)
+        size = cdata.uint_be(fileobj.read(4))
+        if size == 1:
+            size = cdata.ulonglong_be(fileobj.read(12)[4:])
+            fileobj.seek(atom.offset + 8)
+            fileobj.write(cdata.to_ulonglong_be(size + delta))
+        else:
+            fileobj.seek(atom.offset)
+            fileobj.write(cdata.to_uint_be(size + delta))
+
+
+def run(path, saves):
+    """Seconds of every save of tags growing by 1KB"""
+    times = []
+    for i in range(saves):
+        stem = mutagen.mp4.MP4(path)
+        if stem.tags is None:
+            stem.add_tags()
+        stem.tags["\xa9cmt"] = "x" * 1024 * (i + 1)
+        start = time.perf_counter()
+        stem.save(padding=lambda info: 0)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chunk offset update of mutagen")
+    parser.add_argument("--hours", type=float, default=2.0, help="duration of the tracks")
+    parser.add_argument("--saves", type=int, default=10, help="number of tag saves")
+    args = parser.parse_args()
+
+    tags = mutagen.mp4.MP4Tags
+    current = (tags._MP4Tags__update_offset_table, tags._MP4Tags__update_parents)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_path = os.path.join(tmp, "before.stem.m4a")
+        after_path = os.path.join(tmp, "after.stem.m4a")
+        chunks, large = write_file(before_path, args.hours)
+        write_file(after_path, args.hours)
+        print(
+            f"{TRACKS} tracks, {args.hours:g}h, {chunks} chunks per track "
+            f"({'co64' if large else 'stco'}), {os.path.getsize(before_path) / 1024**2:.1f}MB file"
+        )
+
+        tags._MP4Tags__update_offset_table = _update_offset_table_lists
+        tags._MP4Tags__update_parents = _update_parents_reads
+        try:
+            before = run(before_path, args.saves)
+        finally:
+            tags._MP4Tags__update_offset_table, tags._MP4Tags__update_parents = current
+        after = run(after_path, args.saves)
+
+        with open(before_path, "rb") as f1, open(after_path, "rb") as f2:
+            identical = f1.read() == f2.read()
+
+    print(f"lists:  {sum(before) / len(before) * 1000:.1f}ms per save")
+    print(f"numpy:  {sum(after) / len(after) * 1000:.1f}ms per save")
+    print(f"speedup: {sum(before) / sum(after):.1f}x, identical files: {identical}")
+
+    return 0 if identical else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
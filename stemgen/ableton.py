@@ -28,12 +28,13 @@ from pathlib import Path
 import platform
 import sys
 import subprocess
+import tempfile
 import live
 import pyautogui
 import time
 import logging
 from stemgen.metadata import create_metadata_json, ableton_color_index_to_hex
-from shutil import which, move
+from shutil import which, move, rmtree
 import re
 
 
@@ -317,8 +318,10 @@ def main():
         say("Oops")
         exit()
 
-    if len(soloed_tracks) > 8:
-        print("You can't create stems with more than 8 tracks or groups.")
+    if len(soloed_tracks) % 4:
+        print(
+            "You need to solo a multiple of 4 tracks or groups: one stem file per 4 tracks or groups."
+        )
         say("Oops")
         exit()
 
@@ -361,15 +364,16 @@ def main():
         pyautogui.press("tab")
         pyautogui.keyUp("command")
 
-    # Create metadata.part1.json and metadata.part2.json if double stems
-    if len(soloed_tracks) == 8:
-        create_metadata_json(
-            STEMS[:4], os.path.join(INSTALL_DIR, "metadata.part1.json")
-        )
-        create_metadata_json(
-            STEMS[4:], os.path.join(INSTALL_DIR, "metadata.part2.json")
-        )
-        print("Created or updated metadata files.")
+    # Create metadata.part1.json, metadata.part2.json, etc. if several stem files
+    # (in a temporary folder, not in the install dir shared by all the runs)
+    metadata_dir = tempfile.mkdtemp(prefix="stemgen-")
+    metadata_args = []
+    if len(soloed_tracks) > 4:
+        metadata_args = ["--metadata"]
+        for part in range(len(soloed_tracks) // 4):
+            metadata_args.append(os.path.join(metadata_dir, f"metadata.part{part + 1}.json"))
+            create_metadata_json(STEMS[4 * part : 4 * part + 4], metadata_args[-1])
+        print("Created metadata files.")
 
     # Create the stem file(s)
     if OS == "windows":
@@ -384,6 +388,7 @@ def main():
                 "-f",
                 "aac",
             ]
+            + metadata_args
         )
     else:
         subprocess.run(
@@ -395,8 +400,11 @@ def main():
                 "-o",
                 os.path.join(desktop_path, "output"),
             ]
+            + metadata_args
         )
 
+    rmtree(metadata_dir, ignore_errors=True)
+
     # Move the stems to the Desktop folder
     for file in os.listdir(os.path.join(desktop_path, "output")):
         if file.startswith(NAME):
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Analysis of the track during the pipeline: BPM, musical key and loudness
+
+# Runs on the mix already decoded for the separation and on the separated
+# drums (much cleaner onsets than the full mix for the tempo), so the audio
+# is never decoded again just for the tags. Everything is vectorized numpy,
+# the loudness uses pyloudnorm (ITU-R BS.1770).
+# The result is written to the `----:com.stemgen:analysis` atom of the stem
+# file, and to the BPM and key tags when the master doesn't have them.
+
+import json
+
+import numpy as np
+import pyloudnorm as pyln
+import soundfile as sf
+
+from stemgen.incremental import read_freeform
+
+ANALYSIS_KEY = "----:com.stemgen:analysis"
+
+INT32_FULL_SCALE = 2**31
+
+# Tempo
+BPM_RANGE = (60.0, 200.0)
+BPM_PRIOR = 120.0
+BPM_PRIOR_OCTAVES = 1.0
+ONSET_HOP = 128  # at 11025 Hz: ~86 onsets per second
+ONSET_FRAME = 256
+
+# Key
+KEY_FRAME = 4096  # at 11025 Hz: ~2.7 Hz per bin
+KEY_MIN_FREQUENCY = 55.0
+KEY_MAX_FREQUENCY = 5000.0
+KEY_CHUNK = 256
+
+# Krumhansl-Kessler key profiles, from C
+MAJOR_PROFILE = np.array(
+    [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+)
+MINOR_PROFILE = np.array(
+    [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+)
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+
+def to_float(data):
+    """int32 samples (as read for the silence detection) to float32"""
+    if data.dtype == np.int32:
+        return (data / INT32_FULL_SCALE).astype(np.float32)
+    return data.astype(np.float32, copy=False)
+
+
+def _downsample(mono, factor):
+    # Box filter then decimation: good enough below 5kHz for the analysis
+    length = len(mono) // factor * factor
+    return mono[:length].reshape(-1, factor).mean(axis=1)
+
+
+def _frames(signal, frame, hop):
+    if len(signal) < frame:
+        signal = np.pad(signal, (0, frame - len(signal)))
+    count = 1 + (len(signal) - frame) // hop
+    return np.lib.stride_tricks.as_strided(
+        signal,
+        shape=(count, frame),
+        strides=(signal.strides[0] * hop, signal.strides[0]),
+        writeable=False,
+    )
+
+
+def estimate_bpm(drums, sample_rate):
+    """Tempo from the autocorrelation of the onset strength of the drums"""
+    factor = max(1, int(round(sample_rate / 11025)))
+    rate = sample_rate / factor
+    mono = _downsample(to_float(drums).mean(axis=1), factor)
+
+    # Spectral flux
+    window = np.hanning(ONSET_FRAME).astype(np.float32)
+    spectrum = np.abs(np.fft.rfft(_frames(mono, ONSET_FRAME, ONSET_HOP) * window, axis=1))
+    spectrum = np.log1p(1000 * spectrum)
+    onset = np.maximum(np.diff(spectrum, axis=0), 0).sum(axis=1)
+    if len(onset) < 2 or not np.any(onset):
+        return None
+    onset -= onset.mean()
+
+    # Autocorrelation through the FFT
+    size = 1 << int(np.ceil(np.log2(2 * len(onset))))
+    power = np.abs(np.fft.rfft(onset, size)) ** 2
+    acf = np.fft.irfft(power, size)[: len(onset)]
+
+    fps = rate / ONSET_HOP
+    lags = np.arange(
+        int(np.floor(60 * fps / BPM_RANGE[1])),
+        min(int(np.ceil(60 * fps / BPM_RANGE[0])) + 1, len(acf) - 1),
+    )
+    if len(lags) < 3:
+        return None
+    bpms = 60 * fps / lags
+    prior = np.exp(-0.5 * (np.log2(bpms / BPM_PRIOR) / BPM_PRIOR_OCTAVES) ** 2)
+    best = lags[np.argmax(acf[lags] * prior)]
+
+    # Parabolic interpolation around the peak
+    a, b, c = acf[best - 1], acf[best], acf[best + 1]
+    denominator = a - 2 * b + c
+    shift = 0.5 * (a - c) / denominator if denominator else 0.0
+
+    return round(float(60 * fps / (best + shift)), 2)
+
+
+def estimate_key(mix, sample_rate):
+    """Key from the chroma of the mix against the Krumhansl-Kessler profiles
+
+    Returns e.g. `"Am"` or `"F#"`.
+    """
+    factor = max(1, int(round(sample_rate / 11025)))
+    rate = sample_rate / factor
+    mono = _downsample(to_float(mix).mean(axis=1), factor)
+
+    frequencies = np.fft.rfftfreq(KEY_FRAME, 1 / rate)
+    bins = np.flatnonzero(
+        (frequencies >= KEY_MIN_FREQUENCY) & (frequencies <= KEY_MAX_FREQUENCY)
+    )
+    pitch_classes = (
+        np.round(12 * np.log2(frequencies[bins] / 440.0)).astype(int) + 9
+    ) % 12
+
+    window = np.hanning(KEY_FRAME).astype(np.float32)
+    frames = _frames(mono, KEY_FRAME, KEY_FRAME // 2)
+    energy = np.zeros(len(bins))
+    # Chunks of frames to bound the memory of the FFT
+    for start in range(0, len(frames), KEY_CHUNK):
+        spectrum = np.fft.rfft(frames[start : start + KEY_CHUNK] * window, axis=1)
+        energy += np.sum(np.abs(spectrum[:, bins]) ** 2, axis=0)
+
+    chroma = np.bincount(pitch_classes, weights=np.sqrt(energy), minlength=12)
+    if not np.any(chroma):
+        return None
+
+    # Correlation with the 24 rotated profiles: row i is the profile of key i
+    rotations = np.arange(12)[None, :] - np.arange(12)[:, None]
+    major = np.corrcoef(chroma, MAJOR_PROFILE[rotations % 12])[0, 1:]
+    minor = np.corrcoef(chroma, MINOR_PROFILE[rotations % 12])[0, 1:]
+
+    if major.max() >= minor.max():
+        return PITCH_CLASSES[int(np.argmax(major))]
+    return PITCH_CLASSES[int(np.argmax(minor))] + "m"
+
+
+def integrated_loudness(mix, sample_rate):
+    loudness = pyln.Meter(sample_rate).integrated_loudness(to_float(mix).astype(np.float64))
+    return round(float(loudness), 2) if np.isfinite(loudness) else None
+
+
+def analyze(mix, sample_rate, drums_path):
+    """BPM (from the drums), key and integrated LUFS of the track
+
+    `mix` is the decoded mix, with shape `(samples, channels)`.
+    """
+    print("Analyzing...")
+
+    drums, drums_rate = sf.read(drums_path, dtype="float32", always_2d=True)
+
+    result = {
+        "bpm": estimate_bpm(drums, drums_rate),
+        "key": estimate_key(mix, sample_rate),
+        "lufs": integrated_loudness(mix, sample_rate),
+    }
+
+    print(f"bpm={result['bpm']} key={result['key']} lufs={result['lufs']}")
+    print("Done.")
+
+    return result
+
+
+def apply(tags, result):
+    """Add the analysis to the tags, without overriding the tags of the master"""
+    if result.get("bpm") and "bpm" not in tags:
+        tags["bpm"] = str(int(round(result["bpm"])))
+    if result.get("key") and "initialkey" not in tags and "key" not in tags:
+        tags["initialkey"] = result["key"]
+        tags["key"] = result["key"]
+    tags["stemgen_analysis"] = json.dumps(result)
+    return tags
+
+
+def read(stem_path):
+    """Returns the analysis recorded in `stem_path`, or `None`"""
+    try:
+        return json.loads(read_freeform(stem_path, ANALYSIS_KEY))
+    except (TypeError, ValueError):
+        return None
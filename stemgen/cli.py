@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 import shutil
 import sys
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import unicodedata
-import torch
+import importlib
+import soundfile as sf
+from stemgen import analysis, edit, incremental, ladder, profiling, qc, routing, segments, silence, toolchain
+from stemgen.events import log_event, read_events
+from stemgen.fingerprint import find_duplicates
+from stemgen.preflight import preflight
+from stemgen.probe import collect_inputs, probe, probe_all
 from stemgen.metadata import get_cover, get_metadata
 
 LOGO = r"""
@@ -19,12 +29,16 @@ LOGO = r"""
 """
 
 SUPPORTED_FILES = [".wave", ".wav", ".aiff", ".aif", ".flac"]
+SUPPORTED_FORMATS = ["alac", "aac"]
 REQUIRED_PACKAGES = ["ffmpeg", "sox"]
 
 USAGE = f"""{LOGO}
 Stemgen is a Stem file generator. Convert any track into a stem and have fun with Traktor.
 
 Usage: stemgen -i [INPUT_PATH] -o [OUTPUT_PATH]
+       stemgen [INPUT_PATH or FOLDER ...] -o [OUTPUT_PATH]
+       stemgen plan [INPUT_PATH ...]
+       stemgen watch [INBOX] -o [OUTPUT_PATH]
 
 Supported input file format: {SUPPORTED_FILES}
 """
@@ -38,7 +52,9 @@ parser = argparse.ArgumentParser(
     description=USAGE, formatter_class=argparse.RawTextHelpFormatter
 )
 parser.add_argument(
-    dest="POSITIONAL_INPUT_PATH", nargs="?", help="the path to the input file"
+    dest="POSITIONAL_INPUT_PATHS",
+    nargs="*",
+    help="the path to the input file(s) or folder(s)",
 )
 parser.add_argument(
     "-i", "--input", dest="INPUT_PATH", help="the path to the input file"
@@ -54,7 +70,13 @@ parser.add_argument(
     ),
     help="the path to the output folder",
 )
-parser.add_argument("-f", "--format", dest="FORMAT", default="alac", help="aac or alac")
+parser.add_argument(
+    "-f",
+    "--format",
+    dest="FORMAT",
+    default="alac",
+    help="aac or alac, or a list (alac,aac) to encode every format from the same stems",
+)
 parser.add_argument("-d", "--device", dest="DEVICE", help="cpu or cuda or mps")
 parser.add_argument("-v", "--version", action="version", version=VERSION)
 parser.add_argument(
@@ -70,40 +92,166 @@ parser.add_argument(
     default="1",
     help="number of shifts for demucs to use",
 )
-args = parser.parse_args()
-
-INPUT_PATH = args.POSITIONAL_INPUT_PATH or args.INPUT_PATH
-OUTPUT_PATH = (
-    args.OUTPUT_PATH
-    if os.path.isabs(args.OUTPUT_PATH)
-    else os.path.join(PROCESS_DIR, args.OUTPUT_PATH)
+parser.add_argument(
+    "--preview",
+    dest="PREVIEW",
+    action="store_true",
+    help="create a quick preview stem file first, then upgrade it in the background",
+)
+parser.add_argument(
+    "--preview-wait",
+    dest="PREVIEW_WAIT",
+    action="store_true",
+    help="with --preview, upgrade the previews before exiting instead of in the background",
+)
+# Internal: the upgrade run of --preview, and its log to remove on success
+parser.add_argument("--preview-upgrade", dest="PREVIEW_UPGRADE", action="store_true", help=argparse.SUPPRESS)
+parser.add_argument("--upgrade-log", dest="UPGRADE_LOG", help=argparse.SUPPRESS)
+parser.add_argument(
+    "--routes",
+    dest="ROUTES",
+    help="JSON file routing each stem to a model, see stemgen/routing.py",
+)
+parser.add_argument(
+    "--deadline",
+    dest="DEADLINE",
+    help="finish the batch by HH:MM or within a duration (90m, 2h), lowering the quality only as needed",
+)
+parser.add_argument(
+    "--no-trim",
+    dest="NO_TRIM",
+    action="store_true",
+    help="separate the leading and trailing silence too",
+)
+parser.add_argument(
+    "--incremental",
+    dest="INCREMENTAL",
+    action="store_true",
+    help="skip the inputs whose stem file is up to date, only retag when the tags changed",
+)
+parser.add_argument(
+    "--segment-cache",
+    dest="SEGMENT_CACHE",
+    action="store_true",
+    help="reuse the stems of the audio shared with tracks already separated (edits, extended mixes)",
+)
+parser.add_argument(
+    "--no-qc",
+    dest="NO_QC",
+    action="store_true",
+    help="skip the quality check of the stems before the encode",
+)
+parser.add_argument(
+    "--preflight-report",
+    dest="PREFLIGHT_REPORT",
+    help="write the check of every input (errors, warnings, audio info) to this JSON file",
+)
+parser.add_argument(
+    "--profile",
+    dest="PROFILE",
+    action="store_true",
+    help="profile CPU and memory and write a report in the output folder",
 )
-FORMAT = args.FORMAT
 
-# Automatically set DEVICE to "cuda" if CUDA is available or "mps" if Metal is available, otherwise set it to "cpu"
-DEVICE = (
-    args.DEVICE
-    if args.DEVICE is not None
-    else (
+PYTHON_EXEC = sys.executable if not None else "python3"
+
+# Separation attempts before giving up on a track that fails the quality check
+QC_ATTEMPTS = 2
+
+# Fast separation settings of the preview: small model, no shifts, less overlap
+PREVIEW_MODEL_NAME = "htdemucs"
+PREVIEW_MODEL_SHIFTS = "0"
+PREVIEW_MODEL_OVERLAP = "0.1"
+
+# Subcommands: `stemgen [COMMAND] ...`, each module has its own `main(argv)`
+COMMANDS = {
+    "edit": "stemgen.edit",
+    "layout": "stemgen.layout",
+    "plan": "stemgen.plan",
+    "replace-stem": "stemgen.replace",
+    "toolchain": "stemgen.toolchain",
+    "watch": "stemgen.watch",
+}
+
+
+def get_device():
+    # Automatically set DEVICE to "cuda" if CUDA is available or "mps" if Metal is available, otherwise set it to "cpu"
+    import torch
+
+    return (
         "cuda"
         if torch.cuda.is_available()
         else "mps" if torch.backends.mps.is_available() else "cpu"
     )
-)
 
-if DEVICE == "cuda":
-    print("Using GPU for processing.")
-elif DEVICE == "mps":
-    print("Using Metal for processing.")
-else:
-    print("Using CPU for processing.")
 
+def parse_args(argv=None):
+    global args, INPUT_PATHS, OUTPUT_PATH, FORMAT, FORMATS, DEVICE
+    global MODEL_NAME, MODEL_PATH, MODEL_SHIFTS, MODEL_OVERLAP, QUALITY, DEADLINE, ROUTES
 
-PYTHON_EXEC = sys.executable if not None else "python3"
+    args = parser.parse_args(argv)
+
+    INPUT_PATHS = [
+        os.path.join(PROCESS_DIR, path)
+        for path in collect_inputs(
+            args.POSITIONAL_INPUT_PATHS + ([args.INPUT_PATH] if args.INPUT_PATH else []),
+            SUPPORTED_FILES,
+        )
+    ]
+    OUTPUT_PATH = (
+        args.OUTPUT_PATH
+        if os.path.isabs(args.OUTPUT_PATH)
+        else os.path.join(PROCESS_DIR, args.OUTPUT_PATH)
+    )
+    # The first format is `[name].stem.m4a`, the others `[name].[format].stem.m4a`
+    FORMATS = list(dict.fromkeys(f.strip() for f in args.FORMAT.split(",") if f.strip()))
+    for format in FORMATS:
+        if format not in SUPPORTED_FORMATS:
+            print(f"Invalid format: {format}. Should be one of: {SUPPORTED_FORMATS}")
+            sys.exit(1)
+    FORMAT = ",".join(FORMATS)
+
+    DEVICE = args.DEVICE if args.DEVICE is not None else get_device()
+
+    if DEVICE == "cuda":
+        print("Using GPU for processing.")
+    elif DEVICE == "mps":
+        print("Using Metal for processing.")
+    else:
+        print("Using CPU for processing.")
+
+    MODEL_NAME = args.MODEL_NAME
+    MODEL_PATH = args.MODEL_PATH
+    MODEL_SHIFTS = args.MODEL_SHIFTS
+    MODEL_OVERLAP = None
+    QUALITY = "full"
+
+    if args.PREVIEW:
+        print("Creating previews first.")
+        MODEL_NAME = PREVIEW_MODEL_NAME
+        MODEL_PATH = None
+        MODEL_SHIFTS = PREVIEW_MODEL_SHIFTS
+        MODEL_OVERLAP = PREVIEW_MODEL_OVERLAP
+        QUALITY = "preview"
+
+    try:
+        DEADLINE = ladder.parse_deadline(args.DEADLINE) if args.DEADLINE else None
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    ROUTES = None
+    if args.ROUTES:
+        if args.PREVIEW or DEADLINE:
+            print("--routes can't be used with --preview or --deadline.")
+            sys.exit(1)
+        try:
+            ROUTES = routing.load_routes(args.ROUTES)
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        MODEL_NAME = "routed"
 
-MODEL_NAME = args.MODEL_NAME
-MODEL_PATH = args.MODEL_PATH
-MODEL_SHIFTS = args.MODEL_SHIFTS
 
 # CONVERSION AND GENERATION
 
@@ -131,7 +279,7 @@ def convert():
         if FILE_PATH == converted_file_path:
             subprocess.run(
                 [
-                    "sox",
+                    toolchain.command("sox"),
                     FILE_PATH,
                     "--show-progress",
                     "-b",
@@ -154,7 +302,7 @@ def convert():
         else:
             subprocess.run(
                 [
-                    "sox",
+                    toolchain.command("sox"),
                     FILE_PATH,
                     "--show-progress",
                     "-b",
@@ -179,7 +327,7 @@ def convert():
             if FILE_PATH == converted_file_path:
                 subprocess.run(
                     [
-                        "sox",
+                        toolchain.command("sox"),
                         FILE_PATH,
                         "--show-progress",
                         "--no-dither",
@@ -203,7 +351,7 @@ def convert():
             else:
                 subprocess.run(
                     [
-                        "sox",
+                        toolchain.command("sox"),
                         FILE_PATH,
                         "--show-progress",
                         "--no-dither",
@@ -221,41 +369,42 @@ def convert():
     print("Done.")
 
 
-def split_stems():
-    print("Splitting stems...")
-
-    if MODEL_NAME == "bs_roformer":
+def separate(model, model_path, shifts, overlap, input_path, output_dir):
+    # The stems end up in `[output_dir]/[model]/[FILE_NAME]/[stem].wav`
+    if model == "bs_roformer":
         print("Using BS RoFormer...")
         cmd = [
             PYTHON_EXEC,
             "-m",
             "bs_roformer",
-            FILE_PATH,
+            input_path,
             "--output_folder",
-            OUTPUT_PATH,
+            output_dir,
             "--pcm_type",
             "PCM_24" if BIT_DEPTH == 24 else "PCM_16",
             "--lossless",
         ]
 
-        if MODEL_PATH:
-            print(f"Using specified model: {MODEL_PATH}")
+        if model_path:
+            print(f"Using specified model: {model_path}")
             cmd.append("--start_check_point")
-            cmd.append(MODEL_PATH)
+            cmd.append(model_path)
 
-        subprocess.run(cmd)
+        subprocess.run(cmd, check=True)
 
         # Create full directory structure to match Demucs
-        os.makedirs(f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}", exist_ok=True)
+        os.makedirs(f"{output_dir}/{model}/{FILE_NAME}", exist_ok=True)
         stem_files = ["drums", "bass", "other", "vocals"]
         for stem in stem_files:
-            src = f"{OUTPUT_PATH}/{FILE_NAME}_{stem}.wav"
-            dst = f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/{stem}.wav"
+            src = f"{output_dir}/{FILE_NAME}_{stem}.wav"
+            dst = f"{output_dir}/{model}/{FILE_NAME}/{stem}.wav"
             if os.path.exists(src):
                 shutil.move(src, dst)
     else:
         print("Using Demucs...")
 
+        overlap_args = ["--overlap", overlap] if overlap else []
+
         if BIT_DEPTH == 24:
             print("Using 24-bit model...")
             subprocess.run(
@@ -265,15 +414,17 @@ def split_stems():
                     "demucs",
                     "--int24",
                     "-n",
-                    MODEL_NAME,
+                    model,
                     "--shifts",
-                    MODEL_SHIFTS,
+                    shifts,
                     "-d",
                     DEVICE,
-                    FILE_PATH,
+                    input_path,
                     "-o",
-                    f"{OUTPUT_PATH}/{FILE_NAME}",
+                    output_dir,
                 ]
+                + overlap_args,
+                check=True,
             )
         else:
             print("Using 16-bit model...")
@@ -283,53 +434,390 @@ def split_stems():
                     "-m",
                     "demucs",
                     "-n",
-                    MODEL_NAME,
+                    model,
                     "--shifts",
-                    MODEL_SHIFTS,
+                    shifts,
                     "-d",
                     DEVICE,
-                    FILE_PATH,
+                    input_path,
                     "-o",
-                    f"{OUTPUT_PATH}/{FILE_NAME}",
+                    output_dir,
                 ]
+                + overlap_args,
+                check=True,
             )
 
+
+def route_stems(input_path):
+    # Run every distinct model of the routes once, in parallel when possible,
+    # then pick each stem from its model
+    backends = routing.backends(ROUTES)
+
+    # The models share the GPU, on CPU each one uses several cores
+    workers = 1 if DEVICE != "cpu" else (os.cpu_count() or 1) // 4
+    workers = max(1, min(len(backends), workers))
+
+    def _separate(i, backend):
+        output_dir = os.path.join(OUTPUT_PATH, WORKING_DIR, "routes", str(i))
+        start = time.perf_counter()
+        separate(
+            backend["model"],
+            backend["model_path"],
+            backend["shifts"],
+            backend["overlap"],
+            input_path,
+            output_dir,
+        )
+        return output_dir, time.perf_counter() - start
+
+    print(f"Running {len(backends)} model(s) with {workers} worker(s)...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(lambda item: _separate(*item), enumerate(backends))
+        )
+
+    stems_dir = f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}"
+    os.makedirs(stems_dir, exist_ok=True)
+
+    report = []
+    for (backend, stems), (output_dir, seconds) in zip(backends, results):
+        for stem in stems:
+            src = f"{output_dir}/{backend['model']}/{FILE_NAME}/{stem}.wav"
+            if not os.path.exists(src):
+                raise RuntimeError(f"{backend['model']} did not output {stem}")
+            os.replace(src, f"{stems_dir}/{stem}.wav")
+        report.append((backend, stems, seconds))
+
+    if ROUTES["other"] == routing.RESIDUAL:
+        print("Deriving other from the mix...")
+        routing.residual(
+            input_path,
+            [f"{stems_dir}/{stem}.wav" for stem in ["drums", "bass", "vocals"]],
+            f"{stems_dir}/other.wav",
+            "PCM_24" if BIT_DEPTH == 24 else "PCM_16",
+        )
+
+    # Time and quality tradeoff of every route
+    error = routing.reconstruction_error(
+        input_path,
+        [f"{stems_dir}/{stem}.wav" for stem in ["drums", "bass", "other", "vocals"]],
+    )
+    print("Routes:")
+    for backend, stems, seconds in report:
+        print(
+            f"  {', '.join(stems):<24}{backend['model']:<16}"
+            f"shifts={backend['shifts']:<4}{seconds:>8.1f}s"
+            f"{seconds / DURATION:>8.2f}x realtime"
+        )
+        log_event(
+            "route",
+            stems=stems,
+            seconds=seconds,
+            reconstruction_error=error,
+            **{**job_fields(), "model": backend["model"], "shifts": backend["shifts"]},
+        )
+    if ROUTES["other"] == routing.RESIDUAL:
+        print(f"  {'other':<24}{'residual':<16}")
+    print(f"Reconstruction error: {error:.1f} dB (mix minus the sum of the stems)")
+
+
+def separate_track(input_path):
+    if ROUTES:
+        route_stems(input_path)
+    else:
+        separate(
+            MODEL_NAME,
+            MODEL_PATH,
+            MODEL_SHIFTS,
+            MODEL_OVERLAP,
+            input_path,
+            f"{OUTPUT_PATH}/{WORKING_DIR}",
+        )
+
+
+def separate_segments(input_path, trimmed):
+    # Only separate the chunks that are not in the segment cache, see
+    # `stemgen/segments.py`
+    global SEGMENTS
+
+    print("Checking segment cache...")
+
+    data, sample_rate = load_mix()
+    if trimmed:
+        data = data[trimmed[1] : trimmed[1] + sf.info(input_path).frames]
+    cache_dir = get_segment_cache_dir()
+    chunks = segments.plan(data, sample_rate, cache_dir)
+    cached = [chunk for chunk in chunks if chunk[3]]
+    cached_seconds = sum(end - start for start, end, _, _ in cached) / sample_rate
+    print(f"{len(cached)}/{len(chunks)} segment(s) cached ({cached_seconds:.1f}s).")
+
+    if not cached:
+        separate_track(input_path)
+    else:
+        stems_dir = f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}"
+        separated_dir = f"{OUTPUT_PATH}/{WORKING_DIR}/segments/stems"
+        subtype = "PCM_24" if BIT_DEPTH == 24 else "PCM_16"
+
+        layout = segments.regions(chunks, len(data), sample_rate)
+        if layout:
+            regions_path = f"{OUTPUT_PATH}/{WORKING_DIR}/segments/{FILE_NAME}.wav"
+            segments.write_regions(data, sample_rate, layout, regions_path, subtype)
+            separate_track(regions_path)
+            os.replace(stems_dir, separated_dir)
+
+        print("Assembling stems...")
+        segments.assemble(
+            chunks,
+            layout,
+            separated_dir,
+            stems_dir,
+            ["drums", "bass", "other", "vocals"],
+            len(data),
+            sample_rate,
+            subtype,
+            cache_dir,
+        )
+        segments.touch(chunks, cache_dir)
+
+    SEGMENTS = (chunks, trimmed[1] if trimmed else 0, sample_rate)
+    log_event(
+        "segments",
+        segments=len(chunks),
+        cached=len(cached),
+        cached_seconds=cached_seconds,
+        **job_fields(),
+    )
+
     print("Done.")
 
 
-def create_stem():
-    print("Creating stem...")
-    os.chdir(PACKAGE_DIR)
+def cache_segments():
+    # Only the stems that passed the quality check are cached
+    if not SEGMENTS:
+        return
 
-    stem_args = [PYTHON_EXEC, "ni-stem/ni-stem", "create", "-s"]
-    stem_args += [
+    print("Caching segments...")
+
+    chunks, offset, sample_rate = SEGMENTS
+    segments.store(
+        chunks,
+        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}",
+        ["drums", "bass", "other", "vocals"],
+        sample_rate,
+        "PCM_24" if BIT_DEPTH == 24 else "PCM_16",
+        get_segment_cache_dir(),
+        offset,
+    )
+
+    print("Done.")
+
+
+def split_stems(use_cache=True):
+    global SEGMENTS
+
+    print("Splitting stems...")
+
+    SEGMENTS = None
+
+    # Only separate the active region of the converted track
+    trimmed = None
+    if not args.NO_TRIM:
+        trimmed = silence.trim(
+            get_mix_path(),
+            os.path.join(OUTPUT_PATH, WORKING_DIR, "trimmed"),
+            audio=load_mix(),
+        )
+    input_path = trimmed[0] if trimmed else FILE_PATH
+
+    if args.SEGMENT_CACHE and use_cache:
+        separate_segments(input_path, trimmed)
+    else:
+        separate_track(input_path)
+
+    if trimmed:
+        _, start, frames = trimmed
+        silence.pad(
+            [
+                f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/{stem}.wav"
+                for stem in ["drums", "bass", "other", "vocals"]
+            ],
+            start,
+            frames,
+        )
+
+    print("Done.")
+
+
+def separate_and_check():
+    # Don't encode broken stems: retry the separation, then give up
+    for attempt in range(1, QC_ATTEMPTS + 1):
+        try:
+            # The retry separates the whole track again, in case a cached
+            # segment is the culprit
+            with profiling.stage("split_stems", **job_fields()):
+                split_stems(use_cache=attempt == 1)
+        except subprocess.CalledProcessError as e:
+            errors = [f"the separator failed with exit code {e.returncode}"]
+            print(f"Error: {errors[0]}")
+        else:
+            errors = []
+            if not args.NO_QC:
+                with profiling.stage("quality_check"):
+                    errors = check_stems(attempt)
+            if not errors:
+                cache_segments()
+                return
+
+        if attempt < QC_ATTEMPTS:
+            print(f"Retrying the separation ({attempt}/{QC_ATTEMPTS - 1})...")
+
+    raise RuntimeError(f"Separation failed: {'; '.join(errors)}")
+
+
+def check_stems(attempt):
+    stems = ["drums", "bass", "other", "vocals"]
+
+    return qc.quality_check(
+        get_mix_path(),
+        [f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/{stem}.wav" for stem in stems],
+        stems,
+        attempt=attempt,
+        **job_fields(),
+    )
+
+
+def analyze_stems():
+    # BPM from the drums, key and LUFS from the mix already decoded for the
+    # silence detection, see `stemgen/analysis.py`
+    data, sample_rate = load_mix()
+    result = analysis.analyze(
+        data,
+        sample_rate,
         f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/drums.wav",
-        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/bass.wav",
-        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/other.wav",
-        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/vocals.wav",
+    )
+    update_tags(lambda tags: analysis.apply(tags, result))
+
+
+def share_stems(digest):
+    print("Keeping stems for the duplicates...")
+
+    shared_dir = os.path.join(SHARED_DIR, digest)
+    shutil.copytree(
+        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}",
+        shared_dir,
+        dirs_exist_ok=True,
+    )
+    SHARED_STEMS[digest] = shared_dir
+
+    print("Done.")
+
+
+def reuse_stems(shared_dir):
+    print(f"Reusing stems of {DUPLICATES[INPUT_PATH][0]}...")
+
+    shutil.copytree(
+        shared_dir,
+        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}",
+        dirs_exist_ok=True,
+    )
+
+    print("Done.")
+
+
+def encode_stem(format):
+    # Each format converts its tracks in its own dir, next to links to the
+    # shared stems and mixdown
+    format_dir = os.path.join(OUTPUT_PATH, WORKING_DIR, "formats", format)
+    os.makedirs(format_dir, exist_ok=True)
+
+    tracks = [f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}.wav"] + [
+        f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}/{stem}.wav"
+        for stem in ["drums", "bass", "other", "vocals"]
     ]
+    links = []
+    for track in tracks:
+        link = os.path.join(format_dir, os.path.basename(track))
+        try:
+            os.symlink(os.path.abspath(track), link)
+        except OSError:
+            shutil.copy(track, link)
+        links.append(link)
+
+    stem_args = [PYTHON_EXEC, os.path.join(PACKAGE_DIR, "ni-stem/ni-stem"), "create", "-s"]
+    stem_args += links[1:]
     stem_args += [
         "-x",
-        f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}.wav",
+        links[0],
         "-t",
         f"{OUTPUT_PATH}/{WORKING_DIR}/tags.json",
         "-m",
-        "metadata.json",
+        os.path.join(PACKAGE_DIR, "metadata.json"),
         "-f",
-        FORMAT,
+        format,
+        "-o",
+        os.path.join(OUTPUT_PATH, WORKING_DIR, get_stem_name(FILE_NAME, format)),
+    ]
+
+    subprocess.run(stem_args, check=True)
+
+
+def create_stem():
+    print("Creating stem...")
+
+    # One separation, one metadata pass, every format encoded in parallel
+    with ThreadPoolExecutor(max_workers=len(ENCODE_FORMATS)) as executor:
+        list(executor.map(encode_stem, ENCODE_FORMATS))
+
+    print("Done.")
+
+
+def keep_analysis(stem_path):
+    # Keep the analysis of the previous build, the audio didn't change
+    result = analysis.read(stem_path)
+    if result:
+        update_tags(lambda tags: analysis.apply(tags, result))
+
+
+def decode_stems(stem_path):
+    # The tracks of an ALAC stem file are the mixdown and the stems, lossless
+    print(f"Decoding {stem_path}...")
+
+    stems_dir = f"{OUTPUT_PATH}/{WORKING_DIR}/{MODEL_NAME}/{FILE_NAME}"
+    os.makedirs(stems_dir, exist_ok=True)
+    outputs = [f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}.wav"] + [
+        f"{stems_dir}/{stem}.wav" for stem in ["drums", "bass", "other", "vocals"]
     ]
 
-    subprocess.run(stem_args)
+    cmd = [toolchain.command("ffmpeg"), "-v", "error", "-y", "-i", stem_path]
+    for i, output in enumerate(outputs):
+        cmd += ["-map", f"0:a:{i}", "-c:a", "pcm_s24le" if BIT_DEPTH >= 24 else "pcm_s16le", output]
+    subprocess.run(cmd, check=True)
 
     print("Done.")
 
 
+def retag_stem():
+    for format in RETAG_FORMATS:
+        subprocess.run(
+            [
+                PYTHON_EXEC,
+                os.path.join(PACKAGE_DIR, "ni-stem/ni-stem"),
+                "tag",
+                "-s",
+                os.path.join(OUTPUT_PATH, get_stem_name(FILE_NAME, format)),
+                "-t",
+                f"{OUTPUT_PATH}/{WORKING_DIR}/tags.json",
+            ],
+            check=True,
+        )
+
+
 # SETUP
 
 
-def setup():
+def check_requirements():
     for package in REQUIRED_PACKAGES:
-        if not shutil.which(package):
+        if not toolchain.find(package):
             print(f"Please install {package} before running Stemgen.")
             sys.exit(2)
 
@@ -337,14 +825,20 @@ def setup():
         print("Please install ni-stem before running Stemgen.")
         sys.exit(2)
 
-    if MODEL_NAME == "htdemucs":
+    models = (
+        {backend["model"] for backend, _ in routing.backends(ROUTES)}
+        if ROUTES
+        else {MODEL_NAME}
+    )
+
+    if "htdemucs" in models:
         try:
             import demucs
         except ImportError:
             print("Please install demucs before running Stemgen.")
             sys.exit(2)
 
-    if MODEL_NAME == "bs_roformer":
+    if "bs_roformer" in models:
         try:
             import bs_roformer
         except ImportError:
@@ -352,12 +846,14 @@ def setup():
             sys.exit(2)
 
     if not os.path.exists(OUTPUT_PATH):
-        os.mkdir(OUTPUT_PATH)
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
         print("Output dir created.")
     else:
         print("Output dir already exists.")
 
-    global BASE_PATH, FILE_EXTENSION
+
+def setup():
+    global BASE_PATH, FILE_EXTENSION, FILE_NAME, ACTION
     BASE_PATH = os.path.basename(INPUT_PATH)
     FILE_EXTENSION = os.path.splitext(BASE_PATH)[1]
 
@@ -365,22 +861,95 @@ def setup():
         print("Invalid input file format. File should be one of:", SUPPORTED_FILES)
         sys.exit(1)
 
-    setup_file()
-    get_bit_depth()
-    get_sample_rate()
-    get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, WORKING_DIR)
-    get_metadata(FILE_PATH, OUTPUT_PATH, WORKING_DIR, FILE_NAME)
-    convert()
+    FILE_NAME = strip_accents(BASE_PATH.removesuffix(FILE_EXTENSION))
+
+    # Nothing to copy, probe or read when the input file is untouched
+    if args.INCREMENTAL and is_up_to_date():
+        ACTION = "skip"
+        return
+
+    with profiling.stage("setup_file"):
+        setup_file()
+    with profiling.stage("get_cover"):
+        get_cover(FILE_EXTENSION, INPUT_PATH, OUTPUT_PATH, WORKING_DIR)
+    with profiling.stage("get_metadata"):
+        tags = get_metadata(INPUT_PATH, OUTPUT_PATH, WORKING_DIR, FILE_NAME)
+    with profiling.stage("check_output"):
+        check_output(tags)
+    if ACTION not in ["rebuild", "encode"]:
+        return
+    with profiling.stage("copy_file"):
+        copy_file()
+    with profiling.stage("probe"):
+        get_bit_depth()
+        get_sample_rate()
+        get_duration()
+    if ACTION != "rebuild":
+        return
+    with profiling.stage("convert", **job_fields()):
+        convert()
 
     print("Ready!")
 
 
 def run():
+    if ACTION == "skip":
+        print(f"{FILE_NAME}.stem.m4a is up to date.")
+        return
+    if ACTION == "retag":
+        print(f"Retagging {FILE_NAME}.stem.m4a...")
+        keep_analysis(get_output_path(RETAG_FORMATS[0]))
+        retag_stem()
+        clean_dir()
+        print("Done.")
+        return
+    if ACTION == "encode":
+        # Only the encode is out of date (a new format): no separation
+        print(f"Encoding {', '.join(ENCODE_FORMATS)} from {STEMS_SOURCE}...")
+        with profiling.stage("decode_stems"):
+            decode_stems(STEMS_SOURCE)
+        keep_analysis(STEMS_SOURCE)
+        with profiling.stage("create_stem"):
+            create_stem()
+        retag_stem()
+        clean_dir()
+        print("Success! Have fun :)")
+        return
+
     print(f"Creating a Stem file for {FILE_NAME}...")
 
-    split_stems()
-    create_stem()
-    clean_dir()
+    # Duplicates reuse the stems of their source, if it succeeded
+    duplicate = DUPLICATES.get(INPUT_PATH)
+    if duplicate and duplicate[1] in SHARED_STEMS:
+        reuse_stems(SHARED_STEMS[duplicate[1]])
+    else:
+        separate_and_check()
+        if INPUT_PATH in SOURCES:
+            share_stems(SOURCES[INPUT_PATH])
+    with profiling.stage("analyze", **job_fields()):
+        analyze_stems()
+    with profiling.stage("create_stem", **job_fields()):
+        create_stem()
+    if args.PREVIEW_UPGRADE:
+        keep_preview_metadata()
+    with profiling.stage("clean_dir"):
+        clean_dir()
+
+    output_files = [
+        os.path.join(OUTPUT_PATH, get_stem_name(FILE_NAME, format)) for format in FORMATS
+    ]
+    if all(os.path.isfile(output_file) for output_file in output_files):
+        format_bytes = {
+            format: os.path.getsize(output_file)
+            for format, output_file in zip(FORMATS, output_files)
+        }
+        log_event(
+            "job",
+            output_bytes=sum(format_bytes.values()),
+            format_bytes=format_bytes,
+            input_bytes=os.path.getsize(INPUT_PATH),
+            **job_fields(),
+        )
 
     print("Success! Have fun :)")
 
@@ -394,7 +963,7 @@ def get_bit_depth():
         BIT_DEPTH = int(
             subprocess.check_output(
                 [
-                    "ffprobe",
+                    toolchain.command("ffprobe"),
                     "-v",
                     "error",
                     "-select_streams",
@@ -411,7 +980,7 @@ def get_bit_depth():
         BIT_DEPTH = int(
             subprocess.check_output(
                 [
-                    "ffprobe",
+                    toolchain.command("ffprobe"),
                     "-v",
                     "error",
                     "-select_streams",
@@ -437,7 +1006,7 @@ def get_sample_rate():
     SAMPLE_RATE = int(
         subprocess.check_output(
             [
-                "ffprobe",
+                toolchain.command("ffprobe"),
                 "-v",
                 "error",
                 "-select_streams",
@@ -455,6 +1024,177 @@ def get_sample_rate():
     print("Done.")
 
 
+def get_duration():
+    print("Extracting duration...")
+
+    global DURATION
+
+    DURATION = probe(FILE_PATH)["duration"]
+
+    print(f"duration={DURATION}")
+    print("Done.")
+
+
+def read_outputs():
+    # Build state and format of the existing stem files of the input, by path
+    outputs = {}
+    for format in SUPPORTED_FORMATS:
+        path = get_output_path(format)
+        if path not in outputs and os.path.isfile(path):
+            outputs[path] = (incremental.read_state(path), incremental.read_format(path))
+    return outputs
+
+
+def is_up_to_date():
+    # Only stats the input, see `incremental.is_untouched`
+    outputs = read_outputs()
+    for format in FORMATS:
+        previous, file_format = outputs.get(get_output_path(format), (None, None))
+        if file_format != format or not incremental.is_untouched(previous, INPUT_PATH, settings()):
+            return False
+    return True
+
+
+def check_output(tags):
+    # Record the build state in the stem files and, in incremental mode, only
+    # redo what is out of date
+    global ACTION, ENCODE_FORMATS, RETAG_FORMATS, STEMS_SOURCE
+
+    print("Checking output...")
+
+    outputs = read_outputs()
+    known = next((previous for previous, _ in outputs.values() if previous), None)
+    # The audio is only hashed in incremental mode
+    state = incremental.build_state(INPUT_PATH, settings(), tags, known, args.INCREMENTAL)
+
+    actions = {}
+    for format in FORMATS:
+        previous, file_format = outputs.get(get_output_path(format), (None, None))
+        actions[format] = incremental.check(previous, state) if file_format == format else "rebuild"
+    ENCODE_FORMATS = [format for format in FORMATS if actions[format] == "rebuild"]
+    RETAG_FORMATS = [format for format in FORMATS if actions[format] == "retag"]
+
+    # A new format is encoded from the stems of an up to date ALAC stem file
+    STEMS_SOURCE = next(
+        (
+            path
+            for path, (previous, file_format) in outputs.items()
+            if file_format == "alac" and incremental.check(previous, state) != "rebuild"
+        ),
+        None,
+    )
+
+    if not args.INCREMENTAL or (ENCODE_FORMATS and STEMS_SOURCE is None):
+        ACTION = "rebuild"
+        ENCODE_FORMATS = FORMATS
+        RETAG_FORMATS = []
+    elif ENCODE_FORMATS:
+        ACTION = "encode"
+    elif RETAG_FORMATS:
+        ACTION = "retag"
+    else:
+        ACTION = "skip"
+
+    tags["stemgen_state"] = json.dumps(state)
+    tags["stemgen_quality"] = QUALITY
+    with open(os.path.join(OUTPUT_PATH, WORKING_DIR, "tags.json"), "w") as f:
+        json.dump(tags, f)
+
+    print(f"action={ACTION}")
+    print("Done.")
+
+
+def update_tags(func):
+    tags_path = os.path.join(OUTPUT_PATH, WORKING_DIR, "tags.json")
+    with open(tags_path) as f:
+        tags = func(json.load(f))
+    with open(tags_path, "w") as f:
+        json.dump(tags, f)
+
+
+def get_mix_path():
+    # The converted track, if the input needed a conversion
+    converted_file_path = os.path.join(OUTPUT_PATH, WORKING_DIR, FILE_NAME + ".wav")
+    return converted_file_path if os.path.exists(converted_file_path) else FILE_PATH
+
+
+def get_segment_cache_dir():
+    # Segments are only shared between tracks separated the same way
+    separation = {key: value for key, value in settings().items() if key != "trim"}
+    separation["bit_depth"] = BIT_DEPTH
+    return os.path.join(segments.CACHE_DIR, incremental.settings_hash(separation))
+
+
+def load_mix():
+    # The mix is decoded once per track: silence detection and analysis
+    global MIX
+
+    if MIX is None:
+        MIX = sf.read(get_mix_path(), dtype="int32", always_2d=True)
+    return MIX
+
+
+def create_scheduler(queue):
+    # Estimate every track at every rung of the ladder, see `stemgen/ladder.py`
+    print("Building the quality ladder...")
+
+    rungs = ladder.build_ladder(
+        {
+            "model": MODEL_NAME,
+            "model_path": MODEL_PATH,
+            "shifts": MODEL_SHIFTS,
+            "overlap": MODEL_OVERLAP,
+        },
+        DEVICE,
+        FORMAT,
+        read_events(),
+    )
+    for rung in rungs:
+        print(f"  {rung['quality']}")
+
+    infos = {path: info for path, info in probe_all(queue)}
+
+    print("Done.")
+
+    return ladder.Scheduler(infos, rungs, DEADLINE, reused=DUPLICATES)
+
+
+def use_rung(rung):
+    global MODEL_NAME, MODEL_PATH, MODEL_SHIFTS, MODEL_OVERLAP, QUALITY
+
+    MODEL_NAME = rung["model"]
+    MODEL_PATH = rung["model_path"]
+    MODEL_SHIFTS = rung["shifts"]
+    MODEL_OVERLAP = rung["overlap"]
+    QUALITY = rung["quality"]
+
+
+def settings():
+    # Everything that changes the stems, the format is checked per stem file
+    settings = {
+        "model": MODEL_NAME,
+        "model_path": MODEL_PATH,
+        "shifts": MODEL_SHIFTS,
+        "trim": not args.NO_TRIM,
+    }
+    if MODEL_OVERLAP:
+        settings["overlap"] = MODEL_OVERLAP
+    if ROUTES:
+        settings["routes"] = ROUTES
+    return settings
+
+
+def job_fields():
+    # Logged with the timing events, see `stemgen plan`
+    return {
+        "audio_seconds": DURATION,
+        "model": MODEL_NAME,
+        "shifts": MODEL_SHIFTS,
+        "device": DEVICE,
+        "format": FORMAT,
+    }
+
+
 def strip_accents(text):
     text = unicodedata.normalize("NFKD", text)
     text = text.encode("ascii", "ignore")
@@ -463,16 +1203,23 @@ def strip_accents(text):
 
 
 def setup_file():
-    global FILE_NAME, WORKING_DIR, INPUT_DIR, FILE_PATH
-    FILE_NAME = strip_accents(BASE_PATH.removesuffix(FILE_EXTENSION))
-    WORKING_DIR = FILE_NAME.replace("[", "_").replace("]", "_")
-    INPUT_DIR = os.path.join(PROCESS_DIR, os.path.dirname(INPUT_PATH))
+    global WORKING_DIR
+
+    # Every job gets its own working dir, so several Stemgen processes can
+    # share the same output folder
+    WORKING_DIR = os.path.basename(
+        tempfile.mkdtemp(
+            prefix=f".{FILE_NAME.replace('[', '_').replace(']', '_')}.",
+            dir=OUTPUT_PATH,
+        )
+    )
+    print("Working dir created.")
 
-    if os.path.exists(f"{OUTPUT_PATH}/{WORKING_DIR}"):
-        print("Working dir already exists.")
-    else:
-        os.mkdir(f"{OUTPUT_PATH}/{WORKING_DIR}")
-        print("Working dir created.")
+
+def copy_file():
+    global FILE_PATH
+
+    print("Copying input...")
 
     shutil.copy(INPUT_PATH, f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}{FILE_EXTENSION}")
     FILE_PATH = f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}{FILE_EXTENSION}"
@@ -482,31 +1229,211 @@ def setup_file():
 def clean_dir():
     print("Cleaning...")
 
-    os.chdir(OUTPUT_PATH)
+    for format in FORMATS:
+        stem_name = get_stem_name(FILE_NAME, format)
+        if os.path.isfile(os.path.join(OUTPUT_PATH, WORKING_DIR, stem_name)):
+            os.replace(
+                os.path.join(OUTPUT_PATH, WORKING_DIR, stem_name),
+                os.path.join(OUTPUT_PATH, stem_name),
+            )
 
-    for file in os.listdir(INPUT_DIR):
-        if file.endswith(".m4a"):
-            os.remove(os.path.join(INPUT_DIR, file))
+    remove_working_dir()
 
-    if os.path.isfile(os.path.join(OUTPUT_PATH, WORKING_DIR, f"{FILE_NAME}.stem.m4a")):
-        os.rename(
-            os.path.join(OUTPUT_PATH, WORKING_DIR, f"{FILE_NAME}.stem.m4a"),
-            os.path.join(OUTPUT_PATH, f"{FILE_NAME}.stem.m4a"),
-        )
+    print("Done.")
+
+
+def remove_working_dir():
+    global WORKING_DIR
+
+    if WORKING_DIR is None:
+        return
 
     try:
         shutil.rmtree(os.path.join(OUTPUT_PATH, WORKING_DIR))
+    except FileNotFoundError:
+        pass
     except PermissionError:
         print(
             f"Permission error encountered. Directory {os.path.join(OUTPUT_PATH, WORKING_DIR)} might still be in use."
         )
+    WORKING_DIR = None
+
+
+def keep_preview_metadata():
+    # The tags and stem metadata of a preview may have been edited since it
+    # was created (e.g. with `stemgen edit`): the upgrade keeps them, only
+    # its build state and quality are new
+    for format in ENCODE_FORMATS:
+        preview_path = get_output_path(format)
+        if incremental.read_freeform(preview_path, incremental.QUALITY_KEY) != "preview":
+            continue
+
+        print(f"Keeping the metadata of {preview_path}...")
+        edit.copy_metadata(
+            preview_path,
+            os.path.join(OUTPUT_PATH, WORKING_DIR, get_stem_name(FILE_NAME, format)),
+            keep=[incremental.STATE_KEY, incremental.QUALITY_KEY],
+        )
+        print("Done.")
 
+
+def upgrade_previews(input_paths):
+    # Run the full separation on the previews, in a detached process unless
+    # --preview-wait: each stem file is replaced atomically (same path, same
+    # metadata) when ready. Returns `False` if the upgrade failed.
+    cmd = [PYTHON_EXEC, "-m", "stemgen"] + input_paths
+    cmd += [
+        "-o",
+        OUTPUT_PATH,
+        "-f",
+        FORMAT,
+        "-d",
+        DEVICE,
+        "-n",
+        args.MODEL_NAME,
+        "-s",
+        args.MODEL_SHIFTS,
+        "--preview-upgrade",
+    ]
+    if args.MODEL_PATH:
+        cmd += ["-m", args.MODEL_PATH]
+    for flag, enabled in [
+        ("--no-trim", args.NO_TRIM),
+        ("--segment-cache", args.SEGMENT_CACHE),
+        ("--incremental", args.INCREMENTAL),
+        ("--no-qc", args.NO_QC),
+        ("--profile", args.PROFILE),
+    ]:
+        if enabled:
+            cmd.append(flag)
+    if DEADLINE:
+        cmd += ["--deadline", f"{max(0, int(DEADLINE - time.time()))}s"]
+
+    if args.PREVIEW_WAIT:
+        print("Upgrading previews...")
+        result = subprocess.run(cmd)
+        print("Done.")
+        return result.returncode == 0
+
+    print("Upgrading previews in the background...")
+
+    log_path = os.path.join(OUTPUT_PATH, f".stemgen-upgrade.{os.getpid()}.log")
+    cmd += ["--upgrade-log", log_path]
+    with open(log_path, "w") as log:
+        if sys.platform == "win32":
+            subprocess.Popen(
+                cmd,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                creationflags=subprocess.DETACHED_PROCESS
+                | subprocess.CREATE_NEW_PROCESS_GROUP,
+            )
+        else:
+            subprocess.Popen(
+                cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+
+    print(f"Logs: {log_path} (removed if the upgrade succeeds)")
     print("Done.")
 
+    return True
+
+
+def get_stem_name(file_name, format):
+    if format == FORMATS[0]:
+        return f"{file_name}.stem.m4a"
+    return f"{file_name}.{format}.stem.m4a"
+
+
+def get_output_path(format):
+    return os.path.join(OUTPUT_PATH, get_stem_name(FILE_NAME, format))
+
+
+def get_output_name(input_path):
+    base_path = os.path.basename(input_path)
+    file_extension = os.path.splitext(base_path)[1]
+    return get_stem_name(strip_accents(base_path.removesuffix(file_extension)), FORMATS[0])
+
 
 def main():
-    setup()
-    run()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(importlib.import_module(COMMANDS[sys.argv[1]]).main(sys.argv[2:]))
+
+    parse_args()
+
+    if not INPUT_PATHS:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.PROFILE:
+        profiling.run("stemgen", _main, OUTPUT_PATH)
+    else:
+        _main()
+
+
+def _main():
+    global INPUT_PATH, WORKING_DIR, MIX, DUPLICATES, SOURCES, SHARED_DIR, SHARED_STEMS
+
+    check_requirements()
+
+    # Only clean inputs are admitted to the queue
+    queue = preflight(
+        INPUT_PATHS, OUTPUT_PATH, SUPPORTED_FILES, get_output_name, args.PREFLIGHT_REPORT
+    )
+    failed = len(INPUT_PATHS) - len(queue)
+
+    # Each distinct audio is separated once, its stems are kept until the end
+    # of the batch for the duplicates
+    DUPLICATES = find_duplicates(queue) if len(queue) > 1 else {}
+    SOURCES = {source: digest for source, digest in DUPLICATES.values()}
+    SHARED_DIR = (
+        tempfile.mkdtemp(prefix=".duplicates.", dir=OUTPUT_PATH) if DUPLICATES else None
+    )
+    SHARED_STEMS = {}
+
+    scheduler = create_scheduler(queue) if DEADLINE else None
+    previews = []
+
+    try:
+        for INPUT_PATH in queue:
+            WORKING_DIR = None
+            MIX = None
+            try:
+                if scheduler:
+                    use_rung(scheduler.pick(INPUT_PATH))
+                setup()
+                run()
+                if ACTION == "rebuild":
+                    previews.append(INPUT_PATH)
+            except (Exception, SystemExit) as e:
+                if len(INPUT_PATHS) == 1:
+                    raise
+                print(f"Failed to create a Stem file for {INPUT_PATH}: {e!r}")
+                failed += 1
+            finally:
+                # Only remove what this job created
+                remove_working_dir()
+    finally:
+        if SHARED_DIR:
+            shutil.rmtree(SHARED_DIR, ignore_errors=True)
+
+    if args.SEGMENT_CACHE:
+        segments.prune()
+
+    if args.PREVIEW and previews and not upgrade_previews(previews):
+        print("Failed to upgrade the previews.")
+        failed += 1
+
+    if failed:
+        print(f"{failed} file(s) failed.")
+        sys.exit(1)
+
+    # The log of a background upgrade is only kept when something failed
+    if args.UPGRADE_LOG:
+        try:
+            os.remove(args.UPGRADE_LOG)
+        except OSError:
+            pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# Edit the stem names and colours and the tags of stem files, without touching the audio
+
+# Usage:
+# `stemgen edit "Track.stem.m4a" --patch '{"tags": {"artist": "Artist"}}'`
+# `stemgen edit ~/Music/Stems --patch patch.json -j 8`
+
+# The patch is JSON, every part is optional:
+# {
+#   "stems": {"vocals": {"name": "Vocals", "color": "#56B4E9"}},
+#   "tags": {"artist": "Artist", "comment": null}
+# }
+# The tags use the names of `tags.json` (see `stemgen/ni-stem/_internal.py`),
+# `null` removes a tag. `bpm`, `track_no` and `track_count` are numbers, the
+# other tags are strings; the track number or count not patched is kept.
+# `moov/udta` (the NI `stem` box and the iTunes `meta`) is rewritten in place,
+# in the padding left by the muxer: one small write per file. When the padding
+# is too small, the file is remuxed with new padding (the compressed samples
+# are copied, nothing is encoded).
+
+import argparse
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from stemgen import mux
+from stemgen.probe import collect_inputs
+from stemgen.routing import STEMS
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ni-stem"))
+import _internal  # noqa: E402
+import mutagen.mp4  # noqa: E402
+
+STEM_FIELDS = ["name", "color"]
+COLOR = re.compile(r"^#[0-9A-Fa-f]{6}$")
+# Tags written as numbers, the others are strings
+NUMBER_TAGS = ["bpm", "track_no", "track_count"]
+
+# Size of a box header, the smallest `free` box
+BOX_HEADER = 8
+
+
+def _box(kind, payload):
+    return struct.pack(">I4s", BOX_HEADER + len(payload), kind) + payload
+
+
+def load_patch(value):
+    """Returns the patch from a JSON string or file, raises `ValueError` if invalid"""
+    if value.lstrip().startswith("{"):
+        patch = json.loads(value)
+    else:
+        with open(value) as f:
+            patch = json.load(f)
+
+    if not isinstance(patch, dict) or not set(patch) <= {"stems", "tags"}:
+        raise ValueError('The patch must be an object with "stems" and/or "tags"')
+    for part in patch:
+        if not isinstance(patch[part], dict):
+            raise ValueError(f'"{part}" must be an object')
+
+    for stem, fields in patch.get("stems", {}).items():
+        if stem not in STEMS:
+            raise ValueError(f"Unknown stem {stem}, expected one of {', '.join(STEMS)}")
+        if not isinstance(fields, dict) or not set(fields) <= set(STEM_FIELDS):
+            raise ValueError(f"Only {' and '.join(STEM_FIELDS)} can be set for {stem}")
+        if "color" in fields and not COLOR.match(str(fields["color"])):
+            raise ValueError(f'Invalid color for {stem}: {fields["color"]!r}, expected "#RRGGBB"')
+
+    for name, value in patch.get("tags", {}).items():
+        if name not in _internal.TAG_ATOMS:
+            raise ValueError(f"Unknown tag {name}")
+        if value is None:
+            continue
+        if name in NUMBER_TAGS:
+            if isinstance(value, bool) or not isinstance(value, (int, str)) or not re.match(
+                r"^\d+$", str(value).strip()
+            ):
+                raise ValueError(f"Invalid {name}: {value!r}, expected a number")
+        elif not isinstance(value, str):
+            raise ValueError(f"Invalid {name}: {value!r}, expected a string")
+
+    return patch
+
+
+def _patch_stem(payload, stems):
+    metadata = json.loads(payload.decode("utf-8"))
+    for stem, fields in stems.items():
+        metadata["stems"][STEMS.index(stem)].update(fields)
+    return json.dumps(metadata).encode("utf-8")
+
+
+def _patch_tags(path, patch):
+    tags = mutagen.mp4.MP4(path).tags
+    if tags is None:
+        tags = mutagen.mp4.MP4Tags()
+
+    values = {}
+    for name, value in patch.items():
+        if value is None:
+            tags.pop(_internal.TAG_ATOMS[name], None)
+        else:
+            values[name] = value
+
+    # `trkn` holds both the number and the count, the one not patched is kept
+    if "track_no" in values or "track_count" in values:
+        track_no, track_count = (tags.get("trkn") or [(0, 0)])[0]
+        values.setdefault("track_no", track_no)
+        values.setdefault("track_count", track_count)
+
+    if values:
+        tagger = _internal.StemTagger()
+        tagger._tags = values
+        tagger._fillTags(tags)
+
+    return tags
+
+
+def edit(path, patch):
+    """Apply `patch` to the stem file at `path`
+
+    Returns `True` if it was edited in place, `False` if it had to be remuxed.
+    """
+    with open(path, "rb") as f:
+        udta = mux.find_udta(f)
+    if udta is None:
+        raise mux.MuxError(f"{path} is not a stem file")
+    offset, size, boxes = udta
+
+    stem = [payload for kind, payload in boxes if kind == b"stem"]
+    if not stem:
+        raise mux.MuxError(f"{path} is not a stem file")
+    stem_payload = _patch_stem(stem[0], patch.get("stems", {}))
+    tags = _patch_tags(path, patch.get("tags", {}))
+
+    # The other boxes of `udta` are kept, the `free` ones make room
+    others = [
+        (kind, payload) for kind, payload in boxes if kind not in [b"stem", b"meta", b"free"]
+    ]
+    new_boxes = [(b"stem", stem_payload)] + others
+    used = sum(BOX_HEADER + len(payload) for _, payload in new_boxes)
+    meta = _internal.renderMetaPayload(tags, None)
+    room = size - used - (BOX_HEADER + len(meta))
+
+    if room == 0 or room >= BOX_HEADER:
+        if room:
+            meta += _box(b"free", b"\x00" * (room - BOX_HEADER))
+        payload = b"".join(_box(kind, data) for kind, data in new_boxes + [(b"meta", meta)])
+        assert len(payload) == size
+        with open(path, "rb+") as f:
+            f.seek(offset)
+            f.write(payload)
+        return True
+
+    _rewrite(path, new_boxes, tags)
+    return False
+
+
+def _rewrite(path, boxes, tags):
+    # Remux with new `udta` boxes, the tags get the usual padding
+    meta = _internal.renderMetaPayload(tags, _internal.tagPadding)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".edit.", suffix=".m4a", dir=os.path.dirname(os.path.abspath(path))
+    )
+    os.close(fd)
+    try:
+        mux.remux(path, tmp_path, udta=boxes + [(b"meta", meta)])
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def copy_metadata(source_path, path, keep=()):
+    """Replace the stem metadata and the tags of `path` with those of `source_path`
+
+    The tags in `keep` (MP4 keys) stay the ones of `path`.
+    """
+    boxes = [
+        (kind, payload)
+        for kind, payload in mux.read_udta(source_path)
+        if kind not in [b"meta", b"free"]
+    ]
+    if not any(kind == b"stem" for kind, _ in boxes):
+        raise mux.MuxError(f"{source_path} is not a stem file")
+
+    tags = mutagen.mp4.MP4(source_path).tags
+    if tags is None:
+        tags = mutagen.mp4.MP4Tags()
+    own_tags = mutagen.mp4.MP4(path).tags or {}
+    for key in keep:
+        if key in own_tags:
+            tags[key] = own_tags[key]
+        else:
+            tags.pop(key, None)
+
+    _rewrite(path, boxes, tags)
+
+
+def _edit(path, patch):
+    try:
+        in_place = edit(path, patch)
+    except (OSError, ValueError, TypeError, KeyError, IndexError, mux.MuxError) as e:
+        print(f"{path}: Error: {e}")
+        return False
+    print(f"{path}: {'edited in place' if in_place else 'remuxed, the padding was too small'}")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen edit",
+        description="Edit the stem names and colours and the tags of stem files. "
+        "The audio is not touched.",
+    )
+    parser.add_argument("inputs", nargs="+", help="stem files or folders")
+    parser.add_argument(
+        "-p", "--patch", dest="patch", required=True, help="JSON patch, or the path to a JSON file"
+    )
+    parser.add_argument(
+        "-j", "--workers", dest="workers", type=int, default=os.cpu_count() or 1,
+        help="number of files edited in parallel",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        patch = load_patch(args.patch)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    paths = [p for p in collect_inputs(args.inputs, [".m4a"]) if p.endswith(".stem.m4a")]
+    with ThreadPoolExecutor(max(1, args.workers)) as executor:
+        results = list(executor.map(lambda path: _edit(path, patch), paths))
+
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
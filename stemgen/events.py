@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# Timing events of past runs, one JSON object per line
+# They are used to calibrate `stemgen plan`
+
+import json
+import os
+import time
+
+EVENTS_PATH = os.environ.get("STEMGEN_EVENTS") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "stemgen",
+    "events.jsonl",
+)
+
+
+def log_event(kind, path=None, **fields):
+    path = path or EVENTS_PATH
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps({"kind": kind, "time": time.time(), **fields}) + "\n")
+    except OSError as e:
+        # Never fail a job because the events log is not writable
+        print(f"Could not write event to {path}: {e}")
+
+
+def read_events(kind=None, path=None):
+    path = path or EVENTS_PATH
+
+    if not os.path.exists(path):
+        return []
+
+    events = []
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written line
+                continue
+            if kind is None or event.get("kind") == kind:
+                events.append(event)
+
+    return events
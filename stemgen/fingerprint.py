@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Detect the duplicate inputs of a batch (e.g. the WAV and the FLAC of the
+# same master) so that they are only separated once
+
+# All the supported inputs are lossless, so the fingerprint is an exact hash
+# of the decoded PCM: it doesn't depend on the container, the file name or the
+# tags. Only the files with the same sample rate, channel count, length and bit
+# depth are decoded and hashed.
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import soundfile as sf
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def _shape(path):
+    try:
+        info = sf.info(path)
+    except RuntimeError:
+        return None
+    return info.samplerate, info.channels, info.frames, info.subtype
+
+
+def fingerprint(path):
+    """Returns the hex digest of the decoded audio of `path`"""
+    info = sf.info(path)
+    digest = hashlib.blake2b(
+        f"{info.samplerate}:{info.channels}:{info.frames}:{info.subtype}".encode(),
+        digest_size=16,
+    )
+
+    # Read as int32 so that the same samples stored with the same bit depth in
+    # different containers give the same bytes
+    for block in sf.blocks(path, blocksize=BLOCK_SIZE, dtype="int32", always_2d=True):
+        digest.update(block.tobytes())
+
+    return digest.hexdigest()
+
+
+def _safe_fingerprint(path):
+    try:
+        return fingerprint(path)
+    except RuntimeError:
+        return None
+
+
+def find_duplicates(paths, workers=None):
+    """Returns `{duplicate: (source, fingerprint)}` for the inputs of a batch
+
+    The source of a duplicate is the first input with the same audio, in the
+    order of `paths`.
+    """
+    print("Looking for duplicates...")
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shapes = list(executor.map(_shape, paths))
+
+        groups = {}
+        for path, shape in zip(paths, shapes):
+            if shape is not None:
+                groups.setdefault(shape, []).append(path)
+        candidates = [path for group in groups.values() if len(group) > 1 for path in group]
+
+        fingerprints = dict(
+            zip(candidates, executor.map(_safe_fingerprint, candidates))
+        )
+
+    sources = {}
+    duplicates = {}
+    for path in paths:
+        digest = fingerprints.get(path)
+        if digest is None:
+            continue
+        if digest in sources:
+            duplicates[path] = (sources[digest], digest)
+            print(f"{path} is a duplicate of {sources[digest]}")
+        else:
+            sources[digest] = path
+
+    print(f"{len(duplicates)} duplicate(s) found.")
+    print("Done.")
+
+    return duplicates
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Incremental mode: only redo the work that is out of date
+
+# Usage:
+# `stemgen ~/Music/Library -o ~/Music/Stems --incremental`
+
+# Every stem file created by Stemgen records its build state in a freeform
+# atom (`----:com.stemgen:state`): the size and mtime of the source, the hash
+# of the separation settings, the hash of the tags and, in incremental mode,
+# the hash of the source audio. On the next run:
+# - source file untouched, same settings: the input is skipped right away
+# - audio and settings unchanged, same tags: the input is skipped
+# - audio and settings unchanged, new tags: the stem file is only retagged
+# - a stem file missing or in another format: the stems are decoded from an
+#   up to date ALAC stem file and encoded, without a new separation
+# - otherwise: the stem file is rebuilt
+
+import hashlib
+import json
+import os
+
+import mutagen.mp4
+
+from stemgen import mux
+from stemgen.fingerprint import fingerprint
+
+STATE_KEY = "----:com.stemgen:state"
+# Separation quality, see `stemgen/ladder.py`
+QUALITY_KEY = "----:com.stemgen:quality"
+
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_freeform(stem_path, key):
+    """Returns the text of the freeform atom `key` of `stem_path`, or `None`"""
+    if not os.path.isfile(stem_path):
+        return None
+
+    try:
+        tags = mutagen.mp4.MP4(stem_path).tags
+        if tags is None or key not in tags:
+            return None
+        return bytes(tags[key][0]).decode("utf-8")
+    except (mutagen.MutagenError, ValueError):
+        return None
+
+
+def read_state(stem_path):
+    """Returns the build state recorded in `stem_path`, or `None`"""
+    try:
+        return json.loads(read_freeform(stem_path, STATE_KEY))
+    except (TypeError, ValueError):
+        return None
+
+
+def read_format(stem_path):
+    """Returns the format (`alac` or `aac`) of `stem_path`, or `None`"""
+    try:
+        tracks = mux.read_tracks(stem_path)
+    except (OSError, mux.MuxError):
+        return None
+    return mux.FORMATS.get(tracks[0].codec) if tracks else None
+
+
+def _same_file(a, b):
+    return (
+        a is not None
+        and a.get("size") == b["size"]
+        and a.get("mtime") == b["mtime"]
+    )
+
+
+def _same_source(a, b):
+    if a.get("audio") and b.get("audio"):
+        return a["audio"] == b["audio"]
+    return _same_file(a, b)
+
+
+def source_state(path, previous=None, hash_audio=True):
+    """Size, mtime and audio hash of `path`
+
+    The audio is only hashed again if the size or the mtime changed since
+    `previous`, and not at all without `hash_audio`.
+    """
+    stat = os.stat(path)
+    state = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    if _same_file(previous, state):
+        if previous.get("audio"):
+            state["audio"] = previous["audio"]
+    elif hash_audio:
+        state["audio"] = fingerprint(path)
+
+    return state
+
+
+def settings_hash(settings):
+    return _hash(json.dumps(settings, sort_keys=True).encode("utf-8"))
+
+
+def tags_hash(tags):
+    """Hash of the tags, including the content of the cover"""
+    tags = {key: value for key, value in tags.items() if not key.startswith("stemgen_")}
+    data = json.dumps(
+        {key: value for key, value in tags.items() if key != "cover"}, sort_keys=True
+    ).encode("utf-8")
+
+    if "cover" in tags and os.path.isfile(tags["cover"]):
+        with open(tags["cover"], "rb") as f:
+            data += f.read()
+
+    return _hash(data)
+
+
+def build_state(input_path, settings, tags, previous=None, hash_audio=True):
+    """Returns the build state to record in the stem file of `input_path`
+
+    `previous` is the state of the existing stem file, to avoid hashing the
+    same audio again.
+    """
+    return {
+        "source": source_state(input_path, previous and previous.get("source"), hash_audio),
+        "settings": settings_hash(settings),
+        "tags": tags_hash(tags),
+    }
+
+
+def is_untouched(previous, input_path, settings):
+    """Whether neither the source file nor the settings changed since `previous`
+
+    Only stats the source: the tags live in the source too, so they can't
+    have changed either.
+    """
+    stat = os.stat(input_path)
+    return (
+        previous is not None
+        and previous.get("settings") == settings_hash(settings)
+        and _same_file(previous.get("source"), {"size": stat.st_size, "mtime": stat.st_mtime_ns})
+    )
+
+
+def check(previous, state):
+    """Returns `"skip"`, `"retag"` or `"rebuild"` for a stem file built with
+    the state `previous`, `state` being the current one"""
+    if previous is None:
+        return "rebuild"
+    if (
+        not _same_source(previous.get("source") or {}, state["source"])
+        or previous.get("settings") != state["settings"]
+    ):
+        return "rebuild"
+    if previous.get("tags") != state["tags"]:
+        return "retag"
+    return "skip"
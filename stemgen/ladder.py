@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Quality ladder for batches with a deadline
+
+# Usage:
+# `stemgen ~/Music/Inbox -o output --deadline 2h`
+# `stemgen ~/Music/Inbox -o output --deadline 21:30`
+
+# The ladder goes from the requested separation settings down to cheaper
+# ones, ordered by their estimated cost (see `stemgen plan`), the fallbacks
+# that are not cheaper than the requested settings are left out. Before every
+# track, the scheduler picks the best rung that still lets all the remaining
+# tracks finish on time, so the quality is only lowered as much as needed.
+# The rung of every track is written to the `----:com.stemgen:quality` tag.
+
+import datetime
+import importlib.util
+import re
+import time
+
+from stemgen.plan import calibrate, estimate
+
+# Cheaper settings, from the best to the fastest
+RUNGS = [
+    {"model": "htdemucs", "shifts": "1", "overlap": None},
+    {"model": "htdemucs", "shifts": "1", "overlap": "0.1"},
+]
+
+# Overlap used by demucs when none is given
+DEFAULT_OVERLAP = 0.25
+
+
+def parse_deadline(value, now=None):
+    """Returns the timestamp of a deadline given as `HH:MM` or as a duration
+    (`90m`, `2h`, `1h30m`, `3600` seconds)"""
+    now = time.time() if now is None else now
+
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", value)
+    if match:
+        today = datetime.datetime.fromtimestamp(now)
+        deadline = today.replace(
+            hour=int(match[1]), minute=int(match[2]), second=0, microsecond=0
+        )
+        if deadline.timestamp() <= now:
+            deadline += datetime.timedelta(days=1)
+        return deadline.timestamp()
+
+    match = re.fullmatch(r"(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?", value)
+    if not value or not match:
+        raise ValueError(f"Invalid deadline: {value}")
+    hours, minutes, seconds = (int(group or 0) for group in match.groups())
+    return now + hours * 3600 + minutes * 60 + seconds
+
+
+def build_ladder(requested, device, format, events, demucs=None):
+    """Returns the rungs, with their calibration, from the best to the cheapest
+
+    `requested` is the `{"model", "model_path", "shifts", "overlap"}` asked
+    for on the command line, it is always the top rung.
+    """
+    if demucs is None:
+        demucs = importlib.util.find_spec("demucs") is not None
+
+    rungs = [dict(requested)]
+    if demucs:
+        for rung in RUNGS:
+            rung = {"model_path": None, **rung}
+            if any(
+                all(rung[key] == r[key] for key in ["model", "shifts", "overlap"])
+                for r in rungs
+            ):
+                continue
+            rungs.append(rung)
+
+    for rung in rungs:
+        rung["calibration"] = calibrate(
+            events, rung["model"], device, rung["shifts"], format
+        )
+        # Demucs splits the track in overlapping segments
+        if rung["model"] != "bs_roformer" and rung["overlap"] is not None:
+            rate, source = rung["calibration"]["separation"]
+            rung["calibration"]["separation"] = (
+                rate * (1 - DEFAULT_OVERLAP) / (1 - float(rung["overlap"])),
+                source,
+            )
+
+    # The requested settings stay on top, the fallbacks that don't save time
+    # are dropped and the others go from the most to the least expensive
+    # (stable sort: same cost keeps the quality order)
+    def cost(rung):
+        return rung["calibration"]["separation"][0]
+
+    fallbacks = [rung for rung in rungs[1:] if cost(rung) < cost(rungs[0])]
+    rungs = rungs[:1] + sorted(fallbacks, key=cost, reverse=True)
+
+    for i, rung in enumerate(rungs):
+        rung["quality"] = f"{i + 1}/{len(rungs)} {rung['model']}"
+        if rung["model"] != "bs_roformer":
+            rung["quality"] += (
+                f" shifts={rung['shifts']} overlap={rung['overlap'] or DEFAULT_OVERLAP}"
+            )
+
+    return rungs
+
+
+class Scheduler:
+    def __init__(self, infos, ladder, deadline, reused=()):
+        """`infos` maps the inputs, in processing order, to their probe info
+
+        The inputs in `reused` don't need a separation (duplicates).
+        """
+        self._infos = infos
+        self._ladder = ladder
+        self._deadline = deadline
+        self._reused = set(reused)
+        self._pending = list(infos)
+
+    def _cost(self, path, level):
+        e = estimate(self._infos[path], self._ladder[level]["calibration"])
+        if path in self._reused:
+            return e["encode"]
+        return e["separation"] + e["encode"]
+
+    def pick(self, path):
+        """Returns the rung to use for `path`, the next input to process"""
+        remaining = self._deadline - time.time()
+        rest = [p for p in self._pending if p != path]
+        if path in self._pending:
+            self._pending.remove(path)
+
+        # Best rung that fits for all the remaining tracks
+        level = len(self._ladder) - 1
+        for i in range(len(self._ladder)):
+            if self._cost(path, i) + sum(self._cost(p, i) for p in rest) <= remaining:
+                level = i
+                break
+        else:
+            print("Warning: the deadline can't be met, even at the lowest quality.")
+
+        # Spend the slack on this track
+        rest_cost = sum(self._cost(p, level) for p in rest)
+        for i in range(level):
+            if self._cost(path, i) + rest_cost <= remaining:
+                level = i
+                break
+
+        rung = self._ladder[level]
+        print(f"Quality: {rung['quality']} ({max(0, remaining) / 60:.0f}min left)")
+        return rung
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Layout reports how well the tracks of stem files are interleaved, and fixes them
+
+# Usage:
+# `stemgen layout ~/Music/Stems`
+# `stemgen layout ~/Music/Stems --fix`
+
+# A player reads the five tracks at the same position at once: the samples
+# of every track for the same time should be next to each other in the file,
+# and `moov` should come first so the file plays before it is fully read. For
+# every slice of time, the report gives the number of separate reads (seeks)
+# and the span of the file covering it, relative to the size of the samples.
+# `--fix` rewrites the badly laid out files with the stemgen muxer, in one
+# sequential pass, keeping the tracks, the stem metadata and the tags.
+
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from stemgen import mux
+from stemgen.probe import collect_inputs
+
+# Span of the file read for one slice, relative to the size of its samples
+MAX_SPAN_RATIO = 2.0
+# Separate reads per second of audio, for all the tracks
+MAX_READS_PER_SECOND = 4.0
+
+
+def measure(path, slice_seconds=mux.CHUNK_SECONDS):
+    """Returns the interleave metrics of the stem file at `path`"""
+    tracks = mux.read_tracks(path)
+    if not tracks:
+        raise mux.MuxError(f"No audio track in {path}")
+
+    # Slice, offset and size of every sample of every track
+    slices = []
+    for track in tracks:
+        starts = (np.cumsum(track.durations) - track.durations) / track.timescale
+        slices.append((starts // slice_seconds).astype(np.int64))
+    slices = np.concatenate(slices)
+    offsets = np.concatenate([track.offsets for track in tracks])
+    sizes = np.concatenate([track.sizes for track in tracks])
+
+    order = np.lexsort((offsets, slices))
+    slices, offsets, sizes = slices[order], offsets[order], sizes[order]
+    firsts = np.flatnonzero(np.diff(slices, prepend=-1))
+
+    ends = offsets + sizes
+    spans = np.maximum.reduceat(ends, firsts) - offsets[firsts]
+    data = np.add.reduceat(sizes, firsts)
+    # A read starts at the first sample of a slice and after every gap
+    gaps = np.ones(len(offsets), dtype=bool)
+    gaps[1:] = offsets[1:] != ends[:-1]
+    gaps[firsts] = True
+    duration = max(track.duration for track in tracks) / mux.MOVIE_TIMESCALE
+
+    return {
+        "tracks": len(tracks),
+        "fast_start": mux.is_fast_start(path),
+        "reads_per_second": float(np.count_nonzero(gaps) / max(duration, 1e-3)),
+        "span_ratio": float(np.percentile(spans / np.maximum(data, 1), 95)),
+        "max_span": int(spans.max()),
+    }
+
+
+def is_well_laid_out(metrics):
+    return (
+        metrics["fast_start"]
+        and metrics["span_ratio"] <= MAX_SPAN_RATIO
+        and metrics["reads_per_second"] <= MAX_READS_PER_SECOND
+    )
+
+
+def relayout(path, slice_seconds=mux.CHUNK_SECONDS):
+    """Rewrite the stem file at `path` in place, interleaved with `moov` first"""
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".layout.", suffix=".m4a", dir=os.path.dirname(os.path.abspath(path))
+    )
+    os.close(fd)
+    try:
+        mux.remux(path, tmp_path, slice_seconds)
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen layout",
+        description="Report the interleaving of stem files, and fix them with --fix.",
+    )
+    parser.add_argument("inputs", nargs="+", help="stem files or folders")
+    parser.add_argument(
+        "--fix", action="store_true", help="rewrite the badly laid out files"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="with --fix, rewrite all the files"
+    )
+    parser.add_argument(
+        "--slice",
+        dest="slice_seconds",
+        type=float,
+        default=mux.CHUNK_SECONDS,
+        help=f"seconds of every track stored together (default: {mux.CHUNK_SECONDS})",
+    )
+    args = parser.parse_args(argv)
+
+    bad = 0
+    paths = [p for p in collect_inputs(args.inputs, [".m4a"]) if p.endswith(".stem.m4a")]
+    for path in paths:
+        try:
+            metrics = measure(path, args.slice_seconds)
+        except (OSError, mux.MuxError) as e:
+            print(f"{path}: cannot read the layout: {e}")
+            bad += 1
+            continue
+
+        ok = is_well_laid_out(metrics)
+        print(
+            f"{path}: {'ok' if ok else 'BAD'} tracks={metrics['tracks']} "
+            f"fast_start={metrics['fast_start']} reads/s={metrics['reads_per_second']:.1f} "
+            f"span_ratio={metrics['span_ratio']:.2f} max_span={metrics['max_span'] / 1024:.0f}KB"
+        )
+
+        if args.fix and (args.force or not ok):
+            print(f"Rewriting {path}...")
+            try:
+                relayout(path, args.slice_seconds)
+            except (OSError, mux.MuxError) as e:
+                print(f"Error: {e}")
+                bad += 1
+                continue
+            print("Done.")
+        elif not ok:
+            bad += 1
+
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -5,9 +5,11 @@ import sys
 import subprocess
 import json
 
-sys.path.append(os.path.abspath("ni-stem/mutagen"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ni-stem"))
 import mutagen
 
+from stemgen import toolchain
+
 
 def get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, WORKING_DIR):
     print("Extracting cover...")
@@ -30,7 +32,7 @@ def get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, WORKING_DIR):
     else:
         subprocess.run(
             [
-                "ffmpeg",
+                toolchain.command("ffmpeg"),
                 "-i",
                 FILE_PATH,
                 "-an",
@@ -284,6 +286,8 @@ def get_metadata(FILE_PATH, OUTPUT_PATH, WORKING_DIR, FILE_NAME):
 
     print("Done.")
 
+    return TAGS
+
 
 def create_metadata_json(stems, path):
     print(stems)
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+
+# Pure-Python NI stem muxer
+
+# Takes the encoded tracks (the mixdown then the four stems, each one an
+# `.m4a` with one ALAC or AAC track, as written by ffmpeg) and writes them in
+# one stem file:
+# - `ftyp`, then `moov` at the front (fast start), then `mdat`
+# - one `trak` per input, the first one enabled and the stems disabled
+# - the sample descriptions and timing tables copied as is, the chunks
+#   interleaved in fixed time slices, with `co64` when the file needs it
+# - the NI `stem` box and the iTunes `meta` in `moov/udta`
+# The samples are copied with large sequential reads and writes, nothing is
+# decoded. `remux` rewrites an existing stem file with this layout (see
+# `stemgen layout`).
+
+import struct
+import time
+
+import numpy as np
+
+# Duration of the chunks of every track, interleaved
+CHUNK_SECONDS = 0.5
+# Bytes buffered before each write to `mdat`
+WRITE_BUFFER = 8 * 1024 * 1024
+
+MOVIE_TIMESCALE = 1000
+# Seconds between 1904 and 1970
+MAC_EPOCH = 2082844800
+
+TRACK_ENABLED = 0x1
+TRACK_IN_MOVIE = 0x2
+TRACK_IN_PREVIEW = 0x4
+
+MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+# Codec of the tracks, as in `stsd`, to stemgen format
+FORMATS = {"alac": "alac", "mp4a": "aac"}
+
+# Sample tables copied from the source, in this order (sample indexes don't change)
+COPIED_TABLES = [b"stsd", b"stts", b"ctts", b"stss", b"sdtp", b"sbgp", b"sgpd", b"stsz"]
+
+
+class MuxError(Exception):
+    pass
+
+
+class Track:
+    def __init__(self, path):
+        """An audio track of `path`: its boxes, and the file offset, size and
+        duration of every sample"""
+        self.path = path
+        self.boxes = {}
+        self.tables = []
+        self.codec = None
+        self.channels = None
+
+
+def _boxes(data, start=0, end=None):
+    """Yields `(type, payload_start, box_end)` of the boxes of `data[start:end]`"""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            raise MuxError(f"Invalid {kind!r} box at {start}")
+        yield kind, start + header, start + size
+        start += size
+
+
+def _top_level(fileobj):
+    """Yields `(type, payload_offset, payload_size)` of the top level boxes"""
+    fileobj.seek(0, 2)
+    file_size = fileobj.tell()
+    offset = 0
+    while offset + 8 <= file_size:
+        fileobj.seek(offset)
+        size, kind = struct.unpack(">I4s", fileobj.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", fileobj.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header:
+            raise MuxError(f"Invalid {kind!r} box at {offset}")
+        yield kind, offset + header, size - header
+        offset += size
+
+
+def find_moov(fileobj):
+    """Returns the `(offset, size)` of the payload of `moov` in `fileobj`"""
+    for kind, offset, size in _top_level(fileobj):
+        if kind == b"moov":
+            return offset, size
+    raise MuxError("No moov box")
+
+
+def read_moov(fileobj):
+    offset, size = find_moov(fileobj)
+    fileobj.seek(offset)
+    return fileobj.read(size)
+
+
+def find_udta(fileobj):
+    """Returns the `(offset, size, boxes)` of the payload of `moov/udta` in
+    `fileobj`, `boxes` being its `(type, payload)` children, or `None`"""
+    moov_offset, moov_size = find_moov(fileobj)
+    fileobj.seek(moov_offset)
+    moov = fileobj.read(moov_size)
+
+    for kind, start, end in _boxes(moov):
+        if kind == b"udta":
+            boxes = [(child, moov[payload:box_end]) for child, payload, box_end in _boxes(moov, start, end)]
+            return moov_offset + start, end - start, boxes
+    return None
+
+
+def read_udta(path):
+    """Returns the `(type, payload)` boxes of `moov/udta` of the file at `path`"""
+    with open(path, "rb") as f:
+        udta = find_udta(f)
+    return udta[2] if udta else []
+
+
+def is_fast_start(path):
+    """Whether `moov` is before the sample data in the file at `path`"""
+    with open(path, "rb") as f:
+        for kind, _, _ in _top_level(f):
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+    raise MuxError("No moov box")
+
+
+def _children(data, start, end):
+    return {kind: (payload, box_end) for kind, payload, box_end in _boxes(data, start, end)}
+
+
+def _full_box(data, start):
+    return data[start], start + 4
+
+
+def _parse_track(path, moov, trak_start, trak_end, movie_timescale):
+    trak = _children(moov, trak_start, trak_end)
+    mdia = _children(moov, *trak[b"mdia"])
+    minf = _children(moov, *mdia[b"minf"])
+    stbl_start, stbl_end = minf[b"stbl"]
+
+    track = Track(path)
+
+    # Boxes copied as is
+    for kind, (start, end) in mdia.items():
+        if kind in [b"mdhd", b"hdlr"]:
+            track.boxes[kind] = moov[start - 8 : end]
+    tables = {kind: (start, end) for kind, start, end in _boxes(moov, stbl_start, stbl_end)}
+    for kind in COPIED_TABLES:
+        if kind in tables:
+            start, end = tables[kind]
+            track.tables.append(moov[start - 8 : end])
+
+    # Codec and channel count, from the first sample entry of `stsd`
+    if b"stsd" in tables:
+        start = tables[b"stsd"][0]
+        track.codec = moov[start + 12 : start + 16].decode("latin-1")
+        (track.channels,) = struct.unpack_from(">H", moov, start + 32)
+
+    version, start = _full_box(moov, mdia[b"mdhd"][0])
+    if version == 1:
+        track.timescale, media_duration = struct.unpack_from(">IQ", moov, start + 16)
+    else:
+        track.timescale, media_duration = struct.unpack_from(">II", moov, start + 8)
+
+    # Presentation duration, in the movie timescale
+    version, start = _full_box(moov, trak[b"tkhd"][0])
+    if version == 1:
+        (duration,) = struct.unpack_from(">Q", moov, start + 24)
+    else:
+        (duration,) = struct.unpack_from(">I", moov, start + 16)
+    if duration:
+        track.duration = duration * MOVIE_TIMESCALE // movie_timescale
+    else:
+        track.duration = media_duration * MOVIE_TIMESCALE // track.timescale
+
+    # Edit list (e.g. the AAC priming samples), rescaled to the movie timescale
+    track.edits = None
+    if b"edts" in trak:
+        edts = _children(moov, *trak[b"edts"])
+        if b"elst" in edts:
+            version, start = _full_box(moov, edts[b"elst"][0])
+            (count,) = struct.unpack_from(">I", moov, start)
+            fmt = ">QqI" if version == 1 else ">IiI"
+            entry_size = struct.calcsize(fmt)
+            track.edits = [
+                struct.unpack_from(fmt, moov, start + 4 + i * entry_size) for i in range(count)
+            ]
+            track.edits = [
+                (segment * MOVIE_TIMESCALE // movie_timescale, media_time, rate)
+                for segment, media_time, rate in track.edits
+            ]
+
+    # Sizes
+    version, start = _full_box(moov, tables[b"stsz"][0])
+    sample_size, count = struct.unpack_from(">II", moov, start)
+    if sample_size:
+        sizes = np.full(count, sample_size, dtype=np.int64)
+    else:
+        sizes = np.frombuffer(moov, ">u4", count, start + 8).astype(np.int64)
+
+    # Durations
+    version, start = _full_box(moov, tables[b"stts"][0])
+    (entries,) = struct.unpack_from(">I", moov, start)
+    stts = np.frombuffer(moov, ">u4", 2 * entries, start + 4).reshape(-1, 2).astype(np.int64)
+    durations = np.repeat(stts[:, 1], stts[:, 0])
+
+    # Offsets: chunk offsets plus the sizes of the previous samples of the chunk
+    if b"co64" in tables:
+        version, start = _full_box(moov, tables[b"co64"][0])
+        (chunks,) = struct.unpack_from(">I", moov, start)
+        chunk_offsets = np.frombuffer(moov, ">u8", chunks, start + 4).astype(np.int64)
+    else:
+        version, start = _full_box(moov, tables[b"stco"][0])
+        (chunks,) = struct.unpack_from(">I", moov, start)
+        chunk_offsets = np.frombuffer(moov, ">u4", chunks, start + 4).astype(np.int64)
+
+    version, start = _full_box(moov, tables[b"stsc"][0])
+    (entries,) = struct.unpack_from(">I", moov, start)
+    stsc = np.frombuffer(moov, ">u4", 3 * entries, start + 4).reshape(-1, 3).astype(np.int64)
+    runs = np.diff(np.append(stsc[:, 0], chunks + 1))
+    samples_per_chunk = np.repeat(stsc[:, 1], runs)
+
+    if len(sizes) != len(durations) or samples_per_chunk.sum() != len(sizes):
+        raise MuxError(f"Inconsistent sample tables in {path}")
+
+    first_sample = np.cumsum(samples_per_chunk) - samples_per_chunk
+    ends = np.cumsum(sizes)
+    within = ends - sizes - np.repeat((ends - sizes)[first_sample], samples_per_chunk)
+    track.offsets = np.repeat(chunk_offsets, samples_per_chunk) + within
+    track.sizes = sizes
+    track.durations = durations
+
+    return track
+
+
+def read_tracks(path):
+    """Returns the audio tracks of the file at `path`, in order"""
+    with open(path, "rb") as f:
+        moov = read_moov(f)
+
+    boxes = list(_boxes(moov))
+    movie_timescale = MOVIE_TIMESCALE
+    for kind, start, _ in boxes:
+        if kind == b"mvhd":
+            version, start = _full_box(moov, start)
+            movie_timescale = struct.unpack_from(">I", moov, start + (16 if version == 1 else 8))[0]
+
+    tracks = []
+    for kind, start, end in boxes:
+        if kind != b"trak":
+            continue
+        mdia = _children(moov, *_children(moov, start, end)[b"mdia"])
+        hdlr_start = mdia[b"hdlr"][0]
+        if moov[hdlr_start + 8 : hdlr_start + 12] == b"soun":
+            tracks.append(_parse_track(path, moov, start, end, movie_timescale))
+
+    return tracks
+
+
+def _box(kind, *payloads):
+    payload = b"".join(payloads)
+    if len(payload) + 8 > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, kind, len(payload) + 16) + payload
+    return struct.pack(">I4s", len(payload) + 8, kind) + payload
+
+
+def _full(kind, version, flags, *payloads):
+    return _box(kind, struct.pack(">I", (version << 24) | flags), *payloads)
+
+
+def plan_chunks(tracks, chunk_seconds=CHUNK_SECONDS):
+    """Returns the chunks in file order, as `(track, first_sample, end_sample)`
+
+    Every track is cut in slices of `chunk_seconds`, and the slices of all the
+    tracks at the same time are stored next to each other.
+    """
+    slices = []
+    for index, track in enumerate(tracks):
+        starts = np.cumsum(track.durations) - track.durations
+        slice_of_sample = starts // max(1, int(chunk_seconds * track.timescale))
+        # First sample of every slice
+        boundaries = np.flatnonzero(np.diff(slice_of_sample)) + 1
+        firsts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(track.sizes)]])
+        for first, end in zip(firsts, ends):
+            slices.append((int(slice_of_sample[first]), index, int(first), int(end)))
+
+    return [(index, first, end) for _, index, first, end in sorted(slices)]
+
+
+def _track_box(track, track_id, enabled, chunks, chunk_offsets, large):
+    now = int(time.time()) + MAC_EPOCH
+
+    flags = TRACK_IN_MOVIE | TRACK_IN_PREVIEW | (TRACK_ENABLED if enabled else 0)
+    tkhd = _full(
+        b"tkhd",
+        0,
+        flags,
+        struct.pack(">IIIII", now, now, track_id, 0, track.duration),
+        # Reserved, layer, alternate group (only one track plays), volume
+        struct.pack(">8xhhh2x", 0, 1, 0x0100),
+        MATRIX,
+        struct.pack(">II", 0, 0),
+    )
+
+    edts = b""
+    if track.edits:
+        large_edits = any(segment > 0xFFFFFFFF for segment, _, _ in track.edits)
+        fmt = ">QqI" if large_edits else ">IiI"
+        edts = _box(
+            b"edts",
+            _full(
+                b"elst",
+                1 if large_edits else 0,
+                0,
+                struct.pack(">I", len(track.edits)),
+                *[struct.pack(fmt, *edit) for edit in track.edits],
+            ),
+        )
+
+    # Runs of chunks with the same sample count
+    counts = np.array([end - first for first, end in chunks], dtype=np.int64)
+    changes = np.flatnonzero(np.diff(counts, prepend=-1))
+    stsc = np.column_stack([changes + 1, counts[changes], np.ones(len(changes), dtype=np.int64)])
+    stsc = _full(b"stsc", 0, 0, struct.pack(">I", len(stsc)), stsc.astype(">u4").tobytes())
+
+    offsets = np.asarray(chunk_offsets, dtype=np.int64)
+    if large:
+        stco = _full(b"co64", 0, 0, struct.pack(">I", len(offsets)), offsets.astype(">u8").tobytes())
+    else:
+        stco = _full(b"stco", 0, 0, struct.pack(">I", len(offsets)), offsets.astype(">u4").tobytes())
+
+    minf = _box(
+        b"minf",
+        _full(b"smhd", 0, 0, struct.pack(">hh", 0, 0)),
+        _box(b"dinf", _full(b"dref", 0, 0, struct.pack(">I", 1), _full(b"url ", 0, 1))),
+        _box(b"stbl", *track.tables[:-1], stsc, track.tables[-1], stco),
+    )
+
+    return _box(
+        b"trak",
+        tkhd,
+        edts,
+        _box(b"mdia", track.boxes[b"mdhd"], track.boxes[b"hdlr"], minf),
+    )
+
+
+def _moov(tracks, chunks, chunk_offsets, large, udta):
+    now = int(time.time()) + MAC_EPOCH
+    duration = max(track.duration for track in tracks)
+
+    mvhd = _full(
+        b"mvhd",
+        0,
+        0,
+        struct.pack(">IIII", now, now, MOVIE_TIMESCALE, duration),
+        # Rate, volume, reserved
+        struct.pack(">Ih10x", 0x00010000, 0x0100),
+        MATRIX,
+        # Pre-defined, next track ID
+        struct.pack(">24xI", len(tracks) + 1),
+    )
+
+    traks = []
+    for index, track in enumerate(tracks):
+        track_chunks = [(first, end) for i, first, end in chunks if i == index]
+        traks.append(
+            _track_box(
+                track,
+                index + 1,
+                index == 0,
+                track_chunks,
+                [offset for (i, _, _), offset in zip(chunks, chunk_offsets) if i == index],
+                large,
+            )
+        )
+
+    udta = _box(b"udta", *[_box(kind, payload) for kind, payload in udta]) if udta else b""
+
+    return _box(b"moov", mvhd, *traks, udta)
+
+
+def _check_tables(track):
+    # `stsz` is last: `stsc` and `stco` are inserted around it
+    if not track.tables or track.tables[-1][4:8] != b"stsz" or track.tables[0][4:8] != b"stsd":
+        raise MuxError(f"Missing sample tables in {track.path}")
+
+
+def mux(tracks, output_path, udta=(), chunk_seconds=CHUNK_SECONDS):
+    """Write `tracks` (from `read_tracks`) to the stem file `output_path`
+
+    The first track is the mixdown, the others are disabled. `udta` is a list
+    of `(type, payload)` boxes for `moov/udta`.
+    """
+    for track in tracks:
+        _check_tables(track)
+
+    chunks = plan_chunks(tracks, chunk_seconds)
+    chunk_sizes = [int(tracks[i].sizes[first:end].sum()) for i, first, end in chunks]
+    data_size = sum(chunk_sizes)
+
+    ftyp = _box(b"ftyp", b"M4A ", struct.pack(">I", 0), b"M4A ", b"mp42", b"isom")
+
+    # The size of `moov` doesn't depend on the offsets, only on their width
+    placeholder = [0] * len(chunks)
+    large = False
+    moov_size = len(_moov(tracks, chunks, placeholder, large, udta))
+    if len(ftyp) + moov_size + 16 + data_size > 0xFFFFFFFF:
+        large = True
+        moov_size = len(_moov(tracks, chunks, placeholder, large, udta))
+
+    mdat_header = (
+        struct.pack(">I4sQ", 1, b"mdat", data_size + 16)
+        if data_size + 8 > 0xFFFFFFFF
+        else struct.pack(">I4s", data_size + 8, b"mdat")
+    )
+    data_start = len(ftyp) + moov_size + len(mdat_header)
+    chunk_offsets = data_start + np.cumsum([0] + chunk_sizes[:-1])
+    moov = _moov(tracks, chunks, chunk_offsets, large, udta)
+    assert len(moov) == moov_size
+
+    sources = {}
+    try:
+        for track in tracks:
+            if track.path not in sources:
+                sources[track.path] = open(track.path, "rb")
+
+        with open(output_path, "wb") as output:
+            output.write(ftyp)
+            output.write(moov)
+            output.write(mdat_header)
+
+            buffer = bytearray()
+            for index, first, end in chunks:
+                track = tracks[index]
+                source = sources[track.path]
+                offsets = track.offsets[first:end]
+                sizes = track.sizes[first:end]
+                # Contiguous runs of samples are read at once
+                breaks = np.flatnonzero(offsets[1:] != offsets[:-1] + sizes[:-1]) + 1
+                for run_first, run_end in zip(
+                    np.concatenate([[0], breaks]), np.concatenate([breaks, [len(sizes)]])
+                ):
+                    source.seek(int(offsets[run_first]))
+                    size = int(sizes[run_first:run_end].sum())
+                    data = source.read(size)
+                    if len(data) != size:
+                        raise MuxError(f"Truncated sample data in {track.path}")
+                    buffer += data
+                if len(buffer) >= WRITE_BUFFER:
+                    output.write(buffer)
+                    buffer.clear()
+            output.write(buffer)
+    finally:
+        for source in sources.values():
+            source.close()
+
+
+def mux_files(input_paths, output_path, udta=(), chunk_seconds=CHUNK_SECONDS):
+    """Mux the first audio track of each file of `input_paths`"""
+    tracks = []
+    for path in input_paths:
+        audio = read_tracks(path)
+        if not audio:
+            raise MuxError(f"No audio track in {path}")
+        tracks.append(audio[0])
+
+    mux(tracks, output_path, udta, chunk_seconds)
+
+
+def remux(path, output_path, chunk_seconds=CHUNK_SECONDS, udta=None):
+    """Rewrite the stem file at `path` to `output_path` with the same tracks and `udta`
+
+    Only the layout changes: `moov` in front and the chunks interleaved.
+    `udta` replaces the boxes of `moov/udta` if given.
+    """
+    with open(path, "rb") as f:
+        moov = read_moov(f)
+    tracks = read_tracks(path)
+    if len(tracks) != sum(kind == b"trak" for kind, _, _ in _boxes(moov)):
+        raise MuxError(f"{path} has tracks that are not audio")
+
+    mux(tracks, output_path, read_udta(path) if udta is None else udta, chunk_seconds)
@@ -1,18 +1,27 @@
 import codecs
 import json
-import base64
 import mutagen
 import mutagen.mp4
 import mutagen.id3
+from mutagen.mp4 import _item_sort_key
+from mutagen.mp4._atom import Atom
 import os
 import platform
 import subprocess
 import sys
-import re
+import soundfile
+
+# The muxer lives in the stemgen package, next to this folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
+from stemgen import mux, toolchain
 
 stemDescription = "stem-meta"
 stemOutExtension = ".m4a"
 
+# Room reserved in `moov/udta/meta` after the tags, so retagging overwrites
+# it in place instead of moving `mdat`
+tagPadding = 512 * 1024
+
 _windows = platform.system() == "Windows"
 _linux = platform.system() == "Linux"
 _macos = platform.system() == "Darwin"
@@ -39,49 +48,28 @@ def _getProgramPath():
 
 
 def _findCmd(cmd):
-    try:
-        from shutil import which
-
-        return which(cmd)
-    except ImportError:
-        import os
-
-        for path in os.environ["PATH"].split(os.pathsep):
-            if os.access(os.path.join(path, cmd), os.X_OK):
-                return path
-    return None
+    return toolchain.find(cmd)
 
 
 def _checkAvailableAacEncoders():
-    output = subprocess.check_output([_findCmd("ffmpeg"), "-v", "error", "-codecs"])
-    aac_codecs = [
-        x for x in output.splitlines() if "AAC (Advanced Audio Coding)" in str(x)
-    ][0]
-    hay = aac_codecs.decode("ascii")
-    match = re.findall(r"\(encoders: ([^\)]*) \)", hay)
-    if match:
-        return match[0].split(" ")
-    else:
-        return None
+    return toolchain.aac_encoders() or None
 
 
 def _getAacCodec():
-    avail = _checkAvailableAacEncoders()
-    if avail is not None:
-        if "aac_at" in avail:
-            codec = "aac_at"
-        elif "libfdk_aac" in avail:
-            codec = "libfdk_aac"
-        else:
-            print("For better audio quality, install `aac_at` or `libfdk_aac` codec.")
-            codec = "aac"
-    else:
-        codec = "aac"
+    codec = toolchain.aac_codec()
+    if codec == "aac":
+        print("For better audio quality, install `aac_at` or `libfdk_aac` codec.")
 
     return codec
 
 
 def _getSampleRate(trackPath):
+    # libsndfile reads the header of WAV, AIFF and FLAC files, no ffprobe
+    try:
+        return soundfile.info(trackPath).samplerate
+    except RuntimeError:
+        pass
+
     output = subprocess.check_output(
         [
             _findCmd("ffprobe"),
@@ -99,189 +87,109 @@ def _getSampleRate(trackPath):
     return int(output)
 
 
-class StemCreator:
-    _defaultMetadata = [
-        {"name": "Drums", "color": "#009E73"},
-        {"name": "Bass", "color": "#D55E00"},
-        {"name": "Other", "color": "#CC79A7"},
-        {"name": "Vox", "color": "#56B4E9"},
-    ]
+def _tagPadding(info):
+    # Overwrite in place when the tags fit, otherwise reserve room for the next ones
+    if info.padding >= 0:
+        return info.padding
+    return tagPadding
 
-    def __init__(
-        self, mixdownTrack, stemTracks, fileFormat, metadataFile=None, tags=None
-    ):
-        self._mixdownTrack = mixdownTrack
-        self._stemTracks = stemTracks
-        self._format = fileFormat if fileFormat else "alac"
-        self._tags = json.load(open(tags)) if tags else {}
+
+def renderMetaPayload(tags, padding):
+    """`moov/udta/meta` payload with `tags` (`MP4Tags`), followed by a `free`
+    box of `padding` bytes (none if `padding` is `None`)"""
+    values = [
+        tags._render(key, value)
+        for key, value in sorted(tags.items(), key=lambda kv: _item_sort_key(*kv))
+    ]
+    hdlr = Atom.render(b"hdlr", b"\x00" * 8 + b"mdirappl" + b"\x00" * 9)
+    meta = b"\x00\x00\x00\x00" + hdlr + Atom.render(b"ilst", b"".join(values))
+    if padding is not None:
+        meta += Atom.render(b"free", b"\x00" * padding)
+    return meta
+
+
+# MP4 atom written by `StemTagger` for each tag of `tags.json`, keep in sync
+# with `StemTagger._fillTags`
+TAG_ATOMS = {
+    "title": "\xa9nam",
+    "artist": "\xa9ART",
+    "release": "\xa9alb",
+    "album": "\xa9alb",
+    "album_artist": "aART",
+    "remixer": "----:com.apple.iTunes:REMIXER",
+    "mix": "----:com.apple.iTunes:MIXER",
+    "producer": "----:com.apple.iTunes:PRODUCER",
+    "organization": "----:com.apple.iTunes:LABEL",
+    "publisher": "----:com.apple.iTunes:LABEL",
+    "label": "----:com.apple.iTunes:LABEL",
+    "genre": "\xa9gen",
+    "style": "\xa9gen",
+    "track": "trkn",
+    "track_no": "trkn",
+    "track_count": "trkn",
+    "catalog_no": "----:com.apple.iTunes:CATALOGNUMBER",
+    "year": "\xa9day",
+    "date": "\xa9day",
+    "isrc": "----:com.apple.iTunes:ISRC",
+    "upc": "----:com.apple.iTunes:BARCODE",
+    "barcode": "----:com.apple.iTunes:BARCODE",
+    "cover": "covr",
+    "description": "ldes",
+    "comment": "\xa9cmt",
+    "bpm": "tmpo",
+    "initialkey": "----:com.apple.iTunes:initialkey",
+    "key": "----:com.apple.iTunes:KEY",
+    "mood": "----:com.apple.iTunes:MOOD",
+    "grouping": "\xa9grp",
+    "composer": "\xa9wrt",
+    "lyrics": "\xa9lyr",
+    "copyright": "cprt",
+    "url_discogs_artist_site": "----:com.apple.iTunes:URL_DISCOGS_ARTIST_SITE",
+    "www": "----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE",
+    "url_discogs_release_site": "----:com.apple.iTunes:URL_DISCOGS_RELEASE_SITE",
+    "youtube_id": "----:com.apple.iTunes:YouTube Id",
+    "beatport_id": "----:com.apple.iTunes:Beatport Id",
+    "qobuz_id": "----:com.apple.iTunes:Qobuz Id",
+    "discogs_release_id": "----:com.apple.iTunes:Discogs Id",
+    "media": "----:com.apple.iTunes:MEDIA",
+    "country": "----:com.apple.iTunes:COUNTRY",
+    "stemgen_state": "----:com.stemgen:state",
+    "stemgen_quality": "----:com.stemgen:quality",
+    "stemgen_analysis": "----:com.stemgen:analysis",
+}
+
+
+class StemTagger:
+    def __init__(self, tags=None):
+        # "-": the tags come from stdin, e.g. one set of tags per part of a double stem
+        if tags == "-":
+            self._tags = json.load(sys.stdin)
+        else:
+            self._tags = json.load(open(tags)) if tags else {}
 
         # Mutagen complains gravely if we do not explicitly convert the tag values to a
         # particular encoding. We chose UTF-8, others would work as well.
         # for key, value in self._tags.iteritems(): self._tags[key] = repr(value).encode('utf-8')
 
-        metaData = []
-        if metadataFile:
-            fileObj = codecs.open(metadataFile, encoding="utf-8")
-            try:
-                metaData = json.load(fileObj)
-            except IOError:
-                raise
-            except Exception as e:
-                raise RuntimeError("Error while reading metadata file")
-            finally:
-                fileObj.close()
-
-        numStems = len(stemTracks)
-        numMetaEntries = len(metaData["stems"])
-
-        self._metadata = metaData
-
-        # If the input JSON file contains less metadata entries than there are stem tracks, we use the default
-        # entries. If even those are not enough, we pad the remaining entries with the following default value:
-        # {"name" : "Stem_${TRACK#}", "color" : "#000000"}
-
-        if numStems > numMetaEntries:
-            print(
-                "missing stem metadata for stems "
-                + str(numMetaEntries)
-                + " - "
-                + str(numStems)
-            )
-            numDefaultEntries = len(self._defaultMetadata)
-            self._metadata.extend(
-                self._defaultMetadata["stems"][
-                    numMetaEntries : min(numStems, numDefaultEntries)
-                ]
-            )
-            self._metadata["stems"].extend(
-                [
-                    {
-                        "name": "".join(["Stem_", str(i + numDefaultEntries)]),
-                        "color": "#000000",
-                    }
-                    for i in range(numStems - numDefaultEntries)
-                ]
-            )
-
-    def _convertToFormat(self, trackPath, format):
-        trackName, fileExtension = os.path.splitext(trackPath)
-
-        if fileExtension in _supported_files_no_conversion:
-            return trackPath
-
-        if fileExtension in _supported_files_conversion:
-            print("\nconverting " + trackPath + " to " + self._format + "...")
-            sys.stdout.flush()
-
-            newPath = trackName + ".m4a"
-            _removeFile(newPath)
-
-            converter = "ffmpeg"
-            converterArgs = [converter]
-
-            if self._format == "aac":
-                # AAC
-                if _windows and (
-                    _findCmd("qaac64") is not None
-                    or _findCmd("qaac32") is not None
-                    or _findCmd("qaac") is not None
-                ):
-                    # Use QAAC on Windows if installed
-                    qaac = (
-                        _findCmd("qaac64")
-                        if not None
-                        else _findCmd("qaac32") if not None else _findCmd("qaac")
-                    )
-                    print("using QAAC Audio Toolbox codec")
-
-                    converterArgs = [qaac]
-                    converterArgs.extend([trackPath])
-                    converterArgs.extend(["--tvbr", "127"])
-                    converterArgs.extend(["-o"])
-                else:
-                    aacCodec = _getAacCodec()
-                    sampleRate = _getSampleRate(trackPath)
-
-                    print("using " + aacCodec + " codec")
-
-                    converterArgs.extend(["-i", trackPath])
-                    converterArgs.extend(["-c:a", aacCodec])
-                    if aacCodec == "aac_at":
-                        converterArgs.extend(["-q:a", "0"])
-                    elif aacCodec == "libfdk_aac":
-                        converterArgs.extend(["-vbr", "5"])
-                        # converterArgs.extend(["-cutoff", "20000"])
-                    converterArgs.extend(["-c:v", "copy"])
-                    # If the sample rate is superior to 48kHz, we need to downsample to 48kHz
-                    if sampleRate > 48000:
-                        print(str(sampleRate) + "Hz sample rate, downsampling to 48kHz")
-                        converterArgs.extend(["-ar", "48000"])
-            else:
-                # ALAC
-                converterArgs.extend(["-i", trackPath])
-                converterArgs.extend(["-c:a", "alac"])  # "alac_at"
-                converterArgs.extend(["-c:v", "copy"])
-
-            converterArgs.extend([newPath])
-            subprocess.check_call(converterArgs)
-            return newPath
-        else:
-            print('invalid input file format "' + fileExtension + '"')
-            print(
-                "valid input file formats are " + ", ".join(_supported_files_conversion)
-            )
-            sys.exit()
-
-    def save(self, outputFilePath=None):
-        # When using mp4box, in order to get a playable file, the initial file
-        # extension has to be .m4a -> this gets renamed at the end of the method.
-        if not outputFilePath:
-            root, ext = os.path.splitext(self._mixdownTrack)
-            root += ".stem"
-        else:
-            root, ext = os.path.splitext(outputFilePath)
-
-        outputFilePath = "".join([root, stemOutExtension])
-        _removeFile(outputFilePath)
-
-        folderName = "GPAC_win" if _windows else "GPAC_mac" if _macos else "GPAC_linux"
-        executable = "mp4box.exe" if _windows else "mp4box" if _macos else "MP4Box"
-        mp4box = os.path.join(_getProgramPath(), folderName, executable)
-
-        print("\n[Done 0/6]\n")
-        sys.stdout.flush()
-
-        callArgs = [mp4box]
-        callArgs.extend(
-            [
-                "-add",
-                self._convertToFormat(self._mixdownTrack, format) + "#ID=Z",
-                outputFilePath,
-            ]
-        )
-        print("\n[Done 1/6]\n")
-        sys.stdout.flush()
-        conversionCounter = 1
-        for stemTrack in self._stemTracks:
-            callArgs.extend(
-                ["-add", self._convertToFormat(stemTrack, format) + "#ID=Z:disable"]
-            )
-            conversionCounter += 1
-            print("\n[Done " + str(conversionCounter) + "/6]\n")
-            sys.stdout.flush()
-
-        metadata = json.dumps(self._metadata)
-        metadata = base64.b64encode(metadata.encode("utf-8"))
-        metadata = "0:type=stem:src=base64," + metadata.decode("utf-8")
-        callArgs.extend(["-udta", metadata])
-        subprocess.check_call(callArgs)
-        sys.stdout.flush()
-
+    def tag(self, outputFilePath, clear=False):
         # https://picard-docs.musicbrainz.org/en/appendices/tag_mapping.html
         # http://www.jthink.net/jaudiotagger/tagmapping.html
         # https://mutagen.readthedocs.io/en/latest/api/mp4.html
 
         tags = mutagen.mp4.Open(outputFilePath)
+        if clear:
+            tags.clear()
+        self._fillTags(tags)
+        tags.save(outputFilePath, padding=_tagPadding)
+
+    def renderMeta(self):
+        """`moov/udta/meta` payload with all the tags and the padding, to be
+        written along with the rest of the container"""
+        tags = mutagen.mp4.MP4Tags()
+        self._fillTags(tags)
+        return renderMetaPayload(tags, tagPadding)
+
+    def _fillTags(self, tags):
         # name
         if "title" in self._tags:
             tags["\xa9nam"] = self._tags["title"]
@@ -464,8 +372,183 @@ class StemCreator:
                 self._tags["country"].encode("utf-8")
             )
 
+        # Stemgen build state, see `stemgen/incremental.py`
+        if "stemgen_state" in self._tags:
+            tags["----:com.stemgen:state"] = mutagen.mp4.MP4FreeForm(
+                self._tags["stemgen_state"].encode("utf-8")
+            )
+        # Stemgen separation quality, see `stemgen/ladder.py`
+        if "stemgen_quality" in self._tags:
+            tags["----:com.stemgen:quality"] = mutagen.mp4.MP4FreeForm(
+                self._tags["stemgen_quality"].encode("utf-8")
+            )
+        # Stemgen analysis (BPM, key, LUFS), see `stemgen/analysis.py`
+        if "stemgen_analysis" in self._tags:
+            tags["----:com.stemgen:analysis"] = mutagen.mp4.MP4FreeForm(
+                self._tags["stemgen_analysis"].encode("utf-8")
+            )
+
         tags["TAUT"] = "STEM"
-        tags.save(outputFilePath)
+
+
+def convertTrack(trackPath, format):
+    """Converts `trackPath` to an `.m4a` next to it, returns its path"""
+    trackName, fileExtension = os.path.splitext(trackPath)
+
+    if fileExtension in _supported_files_no_conversion:
+        return trackPath
+
+    if fileExtension in _supported_files_conversion:
+        print("\nconverting " + trackPath + " to " + format + "...")
+        sys.stdout.flush()
+
+        newPath = trackName + ".m4a"
+        _removeFile(newPath)
+
+        converter = toolchain.command("ffmpeg")
+        converterArgs = [converter]
+
+        if format == "aac":
+            # AAC
+            # qaac64, qaac32 or qaac
+            qaac = _findCmd("qaac") if _windows else None
+            if qaac is not None:
+                # Use QAAC on Windows if installed
+                print("using QAAC Audio Toolbox codec")
+
+                converterArgs = [qaac]
+                converterArgs.extend([trackPath])
+                converterArgs.extend(["--tvbr", "127"])
+                converterArgs.extend(["-o"])
+            else:
+                aacCodec = _getAacCodec()
+                sampleRate = _getSampleRate(trackPath)
+
+                print("using " + aacCodec + " codec")
+
+                converterArgs.extend(["-i", trackPath])
+                converterArgs.extend(["-c:a", aacCodec])
+                if aacCodec == "aac_at":
+                    converterArgs.extend(["-q:a", "0"])
+                elif aacCodec == "libfdk_aac":
+                    converterArgs.extend(["-vbr", "5"])
+                    # converterArgs.extend(["-cutoff", "20000"])
+                converterArgs.extend(["-c:v", "copy"])
+                # If the sample rate is superior to 48kHz, we need to downsample to 48kHz
+                if sampleRate > 48000:
+                    print(str(sampleRate) + "Hz sample rate, downsampling to 48kHz")
+                    converterArgs.extend(["-ar", "48000"])
+        else:
+            # ALAC
+            converterArgs.extend(["-i", trackPath])
+            converterArgs.extend(["-c:a", "alac"])  # "alac_at"
+            converterArgs.extend(["-c:v", "copy"])
+
+        converterArgs.extend([newPath])
+        subprocess.check_call(converterArgs)
+        return newPath
+    else:
+        print('invalid input file format "' + fileExtension + '"')
+        print(
+            "valid input file formats are " + ", ".join(_supported_files_conversion)
+        )
+        sys.exit()
+
+
+class StemCreator(StemTagger):
+    _defaultMetadata = [
+        {"name": "Drums", "color": "#009E73"},
+        {"name": "Bass", "color": "#D55E00"},
+        {"name": "Other", "color": "#CC79A7"},
+        {"name": "Vox", "color": "#56B4E9"},
+    ]
+
+    def __init__(
+        self, mixdownTrack, stemTracks, fileFormat, metadataFile=None, tags=None
+    ):
+        StemTagger.__init__(self, tags)
+        self._mixdownTrack = mixdownTrack
+        self._stemTracks = stemTracks
+        self._format = fileFormat if fileFormat else "alac"
+
+        metaData = []
+        if metadataFile:
+            fileObj = codecs.open(metadataFile, encoding="utf-8")
+            try:
+                metaData = json.load(fileObj)
+            except IOError:
+                raise
+            except Exception as e:
+                raise RuntimeError("Error while reading metadata file")
+            finally:
+                fileObj.close()
+
+        numStems = len(stemTracks)
+        numMetaEntries = len(metaData["stems"])
+
+        self._metadata = metaData
+
+        # If the input JSON file contains less metadata entries than there are stem tracks, we use the default
+        # entries. If even those are not enough, we pad the remaining entries with the following default value:
+        # {"name" : "Stem_${TRACK#}", "color" : "#000000"}
+
+        if numStems > numMetaEntries:
+            print(
+                "missing stem metadata for stems "
+                + str(numMetaEntries)
+                + " - "
+                + str(numStems)
+            )
+            numDefaultEntries = len(self._defaultMetadata)
+            self._metadata.extend(
+                self._defaultMetadata["stems"][
+                    numMetaEntries : min(numStems, numDefaultEntries)
+                ]
+            )
+            self._metadata["stems"].extend(
+                [
+                    {
+                        "name": "".join(["Stem_", str(i + numDefaultEntries)]),
+                        "color": "#000000",
+                    }
+                    for i in range(numStems - numDefaultEntries)
+                ]
+            )
+
+    def _convertToFormat(self, trackPath, format):
+        return convertTrack(trackPath, self._format)
+
+    def save(self, outputFilePath=None):
+        if not outputFilePath:
+            root, ext = os.path.splitext(self._mixdownTrack)
+            root += ".stem"
+        else:
+            root, ext = os.path.splitext(outputFilePath)
+
+        outputFilePath = "".join([root, stemOutExtension])
+        _removeFile(outputFilePath)
+
+        print("\n[Done 0/6]\n")
+        sys.stdout.flush()
+
+        tracks = [self._convertToFormat(self._mixdownTrack, format)]
+        print("\n[Done 1/6]\n")
+        sys.stdout.flush()
+        conversionCounter = 1
+        for stemTrack in self._stemTracks:
+            tracks.append(self._convertToFormat(stemTrack, format))
+            conversionCounter += 1
+            print("\n[Done " + str(conversionCounter) + "/6]\n")
+            sys.stdout.flush()
+
+        # The NI metadata and the iTunes tags are written in the same pass as
+        # the audio
+        metadata = json.dumps(self._metadata).encode("utf-8")
+        mux.mux_files(
+            tracks,
+            outputFilePath,
+            [(b"stem", metadata), (b"meta", self.renderMeta())],
+        )
 
         print("\n[Done 6/6]\n")
         sys.stdout.flush()
@@ -478,22 +561,9 @@ class StemMetadataViewer:
         self._metadata = {}
 
         if stemFile:
-            folderName = (
-                "GPAC_win" if _windows else "GPAC_mac" if _macos else "GPAC_linux"
-            )
-            executable = "mp4box.exe" if _windows else "mp4box" if _macos else "MP4Box"
-            mp4box = os.path.join(_getProgramPath(), folderName, executable)
-
-            callArgs = [mp4box]
-            callArgs.extend(["-dump-udta", "0:stem", stemFile])
-            subprocess.check_call(callArgs)
-
-            root, ext = os.path.splitext(stemFile)
-            udtaFile = root + "_stem.udta"
-            fileObj = codecs.open(udtaFile, encoding="utf-8")
-            fileObj.seek(8)
-            self._metadata = json.load(fileObj)
-            os.remove(udtaFile)
+            for kind, payload in mux.read_udta(stemFile):
+                if kind == b"stem":
+                    self._metadata = json.loads(payload.decode("utf-8"))
 
     def dump(self, metadataFile=None, reportFile=None):
         if metadataFile:
@@ -13,6 +13,8 @@ intended for internal use in Mutagen only.
 """
 
 import sys
+import os
+import stat
 import struct
 import codecs
 import errno
@@ -27,6 +29,12 @@ from fnmatch import fnmatchcase
 
 _DEFAULT_BUFFER_SIZE = 2 ** 18
 
+# copy_file_range can't copy between overlapping ranges of the same file, so
+# moves are done in blocks of at most the shift: below this shift, the
+# syscalls cost more than read()/write() through a buffer
+_MIN_COPY_RANGE_SHIFT = 2 ** 20
+_MAX_COPY_RANGE_BLOCK = 2 ** 26
+
 
 def endswith(text, end):
     # usefull for paths which can be both, str and bytes
@@ -683,6 +691,18 @@ def seek_end(fileobj, offset):
         fileobj.seek(-offset, 2)
 
 
+def _regular_fileno(fobj):
+    """The file descriptor of fobj if it is a regular file, else None"""
+
+    try:
+        fileno = fobj.fileno()
+        if stat.S_ISREG(os.fstat(fileno).st_mode):
+            return fileno
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
 def resize_file(fobj, diff, BUFFER_SIZE=_DEFAULT_BUFFER_SIZE):
     """Resize a file by `diff`.
 
@@ -704,6 +724,24 @@ def resize_file(fobj, diff, BUFFER_SIZE=_DEFAULT_BUFFER_SIZE):
         # truncate flushes internally
         fobj.truncate(filesize + diff)
     elif diff > 0:
+        fileno = _regular_fileno(fobj)
+        if fileno is not None:
+            # Extended with zeros by the kernel, then allocated so that a
+            # full disk fails here and not in the middle of the move
+            fobj.flush()
+            os.ftruncate(fileno, filesize + diff)
+            try:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fileno, filesize, diff)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    os.ftruncate(fileno, filesize)
+                    fobj.seek(0, 2)
+                    raise
+                # not supported by the file system
+            fobj.seek(0, 2)
+            return
+
         try:
             while diff:
                 addsize = min(BUFFER_SIZE, diff)
@@ -720,8 +758,41 @@ def resize_file(fobj, diff, BUFFER_SIZE=_DEFAULT_BUFFER_SIZE):
             raise
 
 
+def _copy_range_move(fileno, dest, src, count):
+    """Moves data with os.copy_file_range, in blocks that don't overlap.
+
+    Returns the amount of data moved: from the start if src > dest, from
+    the end otherwise.
+    """
+
+    block = min(abs(dest - src), _MAX_COPY_RANGE_BLOCK)
+    moved = 0
+    try:
+        while moved < count:
+            this_move = min(block, count - moved)
+            if src > dest:
+                this_src, this_dest = src + moved, dest + moved
+            else:
+                this_src = src + count - moved - this_move
+                this_dest = dest + count - moved - this_move
+            done = 0
+            while done < this_move:
+                copied = os.copy_file_range(
+                    fileno, fileno, this_move - done,
+                    this_src + done, this_dest + done)
+                if copied == 0:
+                    return moved
+                done += copied
+            moved += this_move
+    except OSError:
+        # e.g. not supported by the file system, the rest is done otherwise
+        pass
+    return moved
+
+
 def move_bytes(fobj, dest, src, count, BUFFER_SIZE=_DEFAULT_BUFFER_SIZE):
-    """Moves data around using read()/write().
+    """Moves data around using copy_file_range() for regular files and large
+    shifts, else (or for what the kernel couldn't move) using read()/write().
 
     Args:
         fileobj (fileobj)
@@ -742,6 +813,18 @@ def move_bytes(fobj, dest, src, count, BUFFER_SIZE=_DEFAULT_BUFFER_SIZE):
     if max(dest, src) + count > filesize:
         raise ValueError("area outside of file")
 
+    fileno = _regular_fileno(fobj)
+    if fileno is not None and hasattr(os, "copy_file_range") and \
+            abs(dest - src) >= _MIN_COPY_RANGE_SHIFT:
+        fobj.flush()
+        moved = _copy_range_move(fileno, dest, src, count)
+        # the kernel wrote behind the buffer of fobj
+        fobj.seek(0, 2)
+        if src > dest:
+            dest += moved
+            src += moved
+        count -= moved
+
     if src > dest:
         moved = 0
         while count - moved:
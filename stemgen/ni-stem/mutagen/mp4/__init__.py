@@ -29,6 +29,8 @@ from io import BytesIO
 from collections.abc import Sequence
 from datetime import timedelta
 
+import numpy as np
+
 from mutagen import FileType, Tags, StreamInfo, PaddingInfo
 from mutagen._constants import GENRES
 from mutagen._util import cdata, insert_bytes, DictProxy, MutagenError, \
@@ -502,29 +504,38 @@ class MP4Tags(DictProxy, Tags):
         if delta == 0:
             return
 
+        # The sizes are known from parsing, only the headers are written
+        headers = []
         for atom in path:
-            fileobj.seek(atom.offset)
-            size = cdata.uint_be(fileobj.read(4))
-            if size == 1:  # 64bit
-                # skip name (4B) and read size (8B)
-                size = cdata.ulonglong_be(fileobj.read(12)[4:])
-                fileobj.seek(atom.offset + 8)
-                fileobj.write(cdata.to_ulonglong_be(size + delta))
+            if atom._dataoffset - atom.offset == 16:
+                # 64bit: skip size (4B) and name (4B)
+                headers.append((atom.offset + 8,
+                                cdata.to_ulonglong_be(atom.length + delta)))
             else:  # 32bit
-                fileobj.seek(atom.offset)
-                fileobj.write(cdata.to_uint_be(size + delta))
+                headers.append((atom.offset,
+                                cdata.to_uint_be(atom.length + delta)))
+
+        for header_offset, header in sorted(headers):
+            fileobj.seek(header_offset)
+            fileobj.write(header)
 
-    def __update_offset_table(self, fileobj, fmt, atom, delta, offset):
+    def __update_offset_table(self, fileobj, dtype, atom, delta, offset):
         """Update offset table in the specified atom."""
         if atom.offset > offset:
             atom.offset += delta
         fileobj.seek(atom.offset + 12)
         data = fileobj.read(atom.length - 12)
-        fmt = fmt % cdata.uint_be(data[:4])
-        offsets = struct.unpack(fmt, data[4:])
-        offsets = [o + (0, delta)[offset < o] for o in offsets]
+        count = cdata.uint_be(data[:4])
+        try:
+            offsets = np.frombuffer(data, dtype, count, 4).astype(np.int64)
+        except ValueError as e:
+            raise MP4MetadataError(e)
+        offsets[offsets > offset] += delta
+        if count and (offsets.min() < 0 or
+                      offsets.max() > np.iinfo(dtype).max):
+            raise MP4MetadataError("chunk offset out of range")
         fileobj.seek(atom.offset + 16)
-        fileobj.write(struct.pack(fmt, *offsets))
+        fileobj.write(offsets.astype(dtype).tobytes())
 
     def __update_tfhd(self, fileobj, atom, delta, offset):
         if atom.offset > offset:
@@ -545,9 +556,9 @@ class MP4Tags(DictProxy, Tags):
             return
         moov = atoms[b"moov"]
         for atom in moov.findall(b'stco', True):
-            self.__update_offset_table(fileobj, ">%dI", atom, delta, offset)
+            self.__update_offset_table(fileobj, ">u4", atom, delta, offset)
         for atom in moov.findall(b'co64', True):
-            self.__update_offset_table(fileobj, ">%dQ", atom, delta, offset)
+            self.__update_offset_table(fileobj, ">u8", atom, delta, offset)
         try:
             for atom in atoms[b"moof"].findall(b'tfhd', True):
                 self.__update_tfhd(fileobj, atom, delta, offset)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# Plan lets you estimate the time, disk and RAM needed by a batch before starting it
+
+# Usage:
+# `stemgen plan track.wav`
+# `stemgen plan ~/Music/Inbox --benchmark`
+
+# Nothing is written: the estimates are calibrated with the timing events of
+# past runs (see `stemgen/events.py`) or with a quick benchmark on this host.
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+
+from stemgen import cli, toolchain
+from stemgen.events import read_events
+from stemgen.probe import collect_inputs, probe_all
+
+# Seconds of processing per second of audio, used when no past run matches
+DEFAULT_SEPARATION_RATES = {
+    "bs_roformer": {"cuda": 0.15, "mps": 0.8, "cpu": 4.0},
+    "demucs": {"cuda": 0.05, "mps": 0.25, "cpu": 0.8},
+}
+DEFAULT_ENCODE_RATES = {"alac": 0.03, "aac": 0.15}
+DEFAULT_CONVERT_RATE = 0.02
+
+# Peak RAM of the separation: base + bytes per second of audio
+DEFAULT_SEPARATION_RAM = {
+    "bs_roformer": (3 * 1024**3, 2 * 1024**2),
+    "demucs": (1.5 * 1024**3, 3 * 1024**2),
+}
+
+# Size of the stem file (mixdown + 4 stems) per second of audio
+DEFAULT_OUTPUT_BYTES_RATES = {"alac": 5 * 44100 * 2 * 3 * 0.6, "aac": 5 * 40000}
+
+BENCHMARK_SECONDS = 30
+
+
+def _family(model):
+    return "bs_roformer" if model == "bs_roformer" else "demucs"
+
+
+def _formats(event):
+    # e.g. "alac,aac" when a run encoded several formats
+    return str(event.get("format") or "").split(",")
+
+
+def _combine(formats, calibrations, combine):
+    """One calibration for several formats, from the calibration of each format"""
+    if len(calibrations) == 1:
+        return calibrations[0]
+    return (
+        combine(rate for rate, _ in calibrations),
+        ", ".join(f"{format}: {source}" for format, (_, source) in zip(formats, calibrations)),
+    )
+
+
+def _median_rate(events):
+    rates = [
+        e["seconds"] / e["audio_seconds"] for e in events if e.get("audio_seconds")
+    ]
+    return statistics.median(rates) if rates else None
+
+
+def _fit(points):
+    """Least squares fit of `y = a + b * x`, returns `(a, b)`"""
+    if len({x for x, y in points}) < 2:
+        return max(y for x, y in points), 0.0
+
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    b = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum(
+        (x - mean_x) ** 2 for x, y in points
+    )
+    b = max(b, 0.0)
+    return mean_y - b * mean_x, b
+
+
+def calibrate(events, model, device, shifts, format):
+    """Returns the rates used for the estimates and where they come from
+
+    `format` can be a list, e.g. `alac,aac`.
+    """
+    stages = [e for e in events if e.get("kind") == "stage"]
+    formats = format.split(",")
+    calibration = {}
+
+    # Separation: same model, preferably on the same device with the same shifts
+    separations = [
+        e for e in stages if e["stage"] == "split_stems" and e.get("model") == model
+    ]
+    matching = [
+        e
+        for e in separations
+        if e.get("device") == device and str(e.get("shifts")) == str(shifts)
+    ]
+    separations = matching or separations
+    rate = _median_rate(separations)
+    if rate is not None:
+        calibration["separation"] = (rate, f"{len(separations)} past runs")
+    else:
+        rates = DEFAULT_SEPARATION_RATES[_family(model)]
+        rate = rates.get(device, rates["cpu"])
+        if _family(model) == "demucs":
+            rate *= max(1, int(shifts))
+        calibration["separation"] = (rate, "default")
+
+    points = [
+        (e["audio_seconds"], e["children_maxrss"])
+        for e in separations
+        if e.get("audio_seconds") and e.get("children_maxrss")
+    ]
+    if points:
+        calibration["ram"] = (_fit(points), f"{len(points)} past runs")
+    else:
+        calibration["ram"] = (DEFAULT_SEPARATION_RAM[_family(model)], "default")
+
+    # The formats of a run are encoded in parallel: the runs with the same
+    # formats, else the slowest format, from the runs that encoded it (alone
+    # preferably)
+    encodes = [e for e in stages if e["stage"] == "create_stem"]
+    same = [e for e in encodes if sorted(_formats(e)) == sorted(formats)]
+    rate = _median_rate(same)
+    if rate is not None:
+        calibration["encode"] = (rate, f"{len(same)} past runs")
+    else:
+        rates = []
+        for f in formats:
+            matching = [e for e in encodes if _formats(e) == [f]] or [
+                e for e in encodes if f in _formats(e)
+            ]
+            rate = _median_rate(matching)
+            rates.append(
+                (rate, f"{len(matching)} past runs")
+                if rate is not None
+                else (DEFAULT_ENCODE_RATES.get(f, DEFAULT_ENCODE_RATES["aac"]), "default")
+            )
+        calibration["encode"] = _combine(formats, rates, max)
+
+    conversions = [e for e in stages if e["stage"] == "convert"]
+    rate = _median_rate(conversions)
+    calibration["convert"] = (
+        (rate, f"{len(conversions)} past runs")
+        if rate is not None
+        else (DEFAULT_CONVERT_RATE, "default")
+    )
+
+    # Output size of each format, from the runs that wrote it
+    jobs = [e for e in events if e.get("kind") == "job" and e.get("audio_seconds")]
+    sizes = []
+    for f in formats:
+        rates = [
+            e["format_bytes"][f] / e["audio_seconds"]
+            for e in jobs
+            if f in (e.get("format_bytes") or {})
+        ] + [
+            e["output_bytes"] / e["audio_seconds"]
+            for e in jobs
+            if "format_bytes" not in e and _formats(e) == [f]
+        ]
+        sizes.append(
+            (statistics.median(rates), f"{len(rates)} past runs")
+            if rates
+            else (DEFAULT_OUTPUT_BYTES_RATES.get(f, DEFAULT_OUTPUT_BYTES_RATES["alac"]), "default")
+        )
+    calibration["output_bytes"] = _combine(formats, sizes, sum)
+
+    return calibration
+
+
+def benchmark(model, model_path, device, shifts, format):
+    """Run Stemgen on a short synthetic track and return its timing events"""
+    print(f"Running a {BENCHMARK_SECONDS}s benchmark...")
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        clip = os.path.join(tempdir, "benchmark.wav")
+        subprocess.run(
+            [
+                toolchain.command("sox"),
+                "-n",
+                "-r",
+                "44100",
+                "-c",
+                "2",
+                "-b",
+                "24",
+                clip,
+                "synth",
+                str(BENCHMARK_SECONDS),
+                "pinknoise",
+                "vol",
+                "0.5",
+            ],
+            check=True,
+        )
+
+        events_path = os.path.join(tempdir, "events.jsonl")
+        cmd = [
+            cli.PYTHON_EXEC,
+            "-m",
+            "stemgen",
+            clip,
+            "-o",
+            os.path.join(tempdir, "output"),
+            "-n",
+            model,
+            "-s",
+            str(shifts),
+            "-d",
+            device,
+            "-f",
+            format,
+        ]
+        if model_path:
+            cmd += ["-m", model_path]
+
+        subprocess.run(
+            cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            env={**os.environ, "STEMGEN_EVENTS": events_path},
+        )
+
+        events = read_events(path=events_path)
+
+    print("Done.")
+
+    return events
+
+
+def estimate(info, calibration):
+    """Estimate the time, peak RAM and peak scratch disk for one track"""
+    duration = info["duration"]
+    (ram_base, ram_rate), _ = calibration["ram"]
+
+    # Working copy, converted wav and 4 stems (24-bit, 44.1kHz at most),
+    # then the 5 encoded tracks and the stem file itself
+    pcm = duration * 44100 * max(info["channels"], 2) * 3
+    output = duration * calibration["output_bytes"][0]
+
+    return {
+        "separation": duration * calibration["separation"][0],
+        "encode": duration
+        * (calibration["encode"][0] + calibration["convert"][0]),
+        "ram": ram_base + ram_rate * duration,
+        "scratch": info["size"] + 5 * pcm + 2 * output,
+        "output": output,
+    }
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    return f"{minutes}m{seconds:02d}s"
+
+
+def _format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def _total_ram():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plan(inputs, output_path, model, model_path, device, shifts, format, run_benchmark):
+    paths = collect_inputs(inputs, cli.SUPPORTED_FILES)
+    if not paths:
+        print("No input file found. File should be one of:", cli.SUPPORTED_FILES)
+        return []
+
+    print(f"Probing {len(paths)} file(s)...")
+    probed = probe_all(paths)
+    print("Done.")
+
+    if run_benchmark:
+        events = benchmark(model, model_path, device, shifts, format)
+    else:
+        events = read_events()
+
+    calibration = calibrate(events, model, device, shifts, format)
+
+    print("\nCalibration:")
+    for key, (value, source) in calibration.items():
+        print(f"  {key:<14}{source}")
+
+    print(
+        f"\n{'track':<48}{'length':>10}{'separation':>12}{'encode':>10}"
+        f"{'peak RAM':>12}{'scratch':>12}"
+    )
+
+    estimates = []
+    for path, info in probed:
+        name = os.path.basename(path)
+        name = name if len(name) <= 46 else name[:43] + "..."
+        if isinstance(info, Exception):
+            print(f"{name:<48}  cannot be probed: {str(info).strip()}")
+            continue
+
+        e = estimate(info, calibration)
+        estimates.append((path, e))
+        print(
+            f"{name:<48}{_format_duration(info['duration']):>10}"
+            f"{_format_duration(e['separation']):>12}{_format_duration(e['encode']):>10}"
+            f"{_format_bytes(e['ram']):>12}{_format_bytes(e['scratch']):>12}"
+        )
+
+    if not estimates:
+        return estimates
+
+    # Tracks are processed one after the other: time and outputs add up, the
+    # scratch space of a track is freed before the next one
+    total_time = sum(e["separation"] + e["encode"] for _, e in estimates)
+    peak_ram = max(e["ram"] for _, e in estimates)
+    peak_scratch = max(e["scratch"] for _, e in estimates)
+    total_output = sum(e["output"] for _, e in estimates)
+    total_disk = total_output + peak_scratch
+
+    print(
+        f"\nTotal: {len(estimates)} track(s), {_format_duration(total_time)}, "
+        f"peak RAM {_format_bytes(peak_ram)}, peak scratch {_format_bytes(peak_scratch)}, "
+        f"output {_format_bytes(total_output)}"
+    )
+
+    # The output folder might not exist yet
+    disk_path = output_path
+    while not os.path.exists(disk_path):
+        disk_path = os.path.dirname(disk_path)
+    free = shutil.disk_usage(disk_path).free
+    if total_disk > free:
+        print(
+            f"Warning: {_format_bytes(total_disk)} needed but only "
+            f"{_format_bytes(free)} free in {disk_path}"
+        )
+
+    total_ram = _total_ram()
+    if total_ram is not None and peak_ram > total_ram:
+        print(
+            f"Warning: {_format_bytes(peak_ram)} of RAM needed but only "
+            f"{_format_bytes(total_ram)} installed"
+        )
+
+    return estimates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen plan",
+        description="Estimate time, disk and RAM before a batch. Writes nothing.",
+    )
+    parser.add_argument("inputs", nargs="+", help="input files or folders")
+    parser.add_argument(
+        "-o", "--output", dest="output", default=".", help="the path to the output folder"
+    )
+    parser.add_argument(
+        "-f", "--format", dest="format", default="alac", help="aac or alac, or a list (alac,aac)"
+    )
+    parser.add_argument("-d", "--device", dest="device", help="cpu or cuda or mps")
+    parser.add_argument(
+        "-n", "--model_name", dest="model", default="bs_roformer", help="name of the model to use"
+    )
+    parser.add_argument("-m", "--model_path", dest="model_path", help="path to the model to use")
+    parser.add_argument(
+        "-s", "--model_shifts", dest="shifts", default="1", help="number of shifts for demucs to use"
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help=f"calibrate with a {BENCHMARK_SECONDS}s benchmark on this host instead of past runs",
+    )
+    args = parser.parse_args(argv)
+
+    plan(
+        args.inputs,
+        os.path.abspath(args.output),
+        args.model,
+        args.model_path,
+        args.device or cli.get_device(),
+        args.shifts,
+        args.format,
+        args.benchmark,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Preflight validates all the inputs of a batch before any expensive work,
+# so that bad inputs don't waste separation slots
+
+# Checks, for every input and concurrently:
+# - supported extension
+# - decodable audio (ffprobe + full decode with ffmpeg)
+# - channel count and duration
+# - readable tags and cover (a missing cover is only a warning)
+# - output collisions within the batch (and existing outputs, as a warning)
+
+import json
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import mutagen
+
+from stemgen import toolchain
+from stemgen.probe import probe
+
+MAX_CHANNELS = 2
+MIN_DURATION = 1.0
+
+
+def _has_cover(file):
+    if file is None:
+        return False
+    if getattr(file, "pictures", None):
+        # FLAC
+        return True
+    return file.tags is not None and any(
+        key.startswith("APIC") for key in file.tags.keys()
+    )
+
+
+def check(path, extensions):
+    """Validate one input, returns `(errors, warnings, info)`"""
+    errors = []
+    warnings = []
+    info = None
+
+    if not os.path.isfile(path):
+        return [f"{path} does not exist"], warnings, info
+
+    extension = os.path.splitext(path)[1]
+    if extension not in extensions:
+        return [f"unsupported extension {extension}"], warnings, info
+
+    try:
+        info = probe(path)
+    except subprocess.CalledProcessError as e:
+        message = e.stderr.decode(errors="ignore").strip() if e.stderr else str(e)
+        return [f"ffprobe failed: {message}"], warnings, info
+    except ValueError as e:
+        return [str(e)], warnings, info
+
+    if info["channels"] < 1 or info["channels"] > MAX_CHANNELS:
+        errors.append(f"{info['channels']} channels, only mono and stereo are supported")
+
+    if info["duration"] < MIN_DURATION:
+        errors.append(f"duration is {info['duration']:.2f}s")
+
+    if not errors:
+        decode = subprocess.run(
+            [toolchain.command("ffmpeg"), "-v", "error", "-xerror", "-i", path, "-map", "0:a:0", "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if decode.returncode != 0:
+            lines = decode.stderr.decode(errors="ignore").strip().splitlines()
+            errors.append("audio cannot be decoded" + (f": {lines[-1]}" if lines else ""))
+
+    try:
+        file = mutagen.File(path)
+        if file is None:
+            errors.append("tags cannot be read")
+        elif not _has_cover(file):
+            warnings.append("no cover")
+    except Exception as e:
+        errors.append(f"tags cannot be read: {e}")
+
+    return errors, warnings, info
+
+
+def write_report(report, report_path):
+    """Write `report` to `report_path` atomically, several jobs can share a folder"""
+    folder = os.path.dirname(os.path.abspath(report_path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".preflight.", suffix=".json", dir=folder)
+    with os.fdopen(fd, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, report_path)
+
+
+def preflight(paths, output_path, extensions, output_name, report_path=None, workers=None):
+    """Validate `paths` on a thread pool, and write the report to `report_path` if given
+
+    `output_name(path)` returns the name of the stem file created for `path`.
+    Returns the clean inputs, in the same order.
+    """
+    print(f"Checking {len(paths)} file(s)...")
+
+    workers = workers or min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda path: check(path, extensions), paths))
+
+    report = []
+    outputs = {}
+    for path, (errors, warnings, info) in zip(paths, results):
+        name = output_name(path)
+        if name in outputs:
+            errors.append(f"same output file as {outputs[name]}: {name}")
+        else:
+            outputs[name] = path
+            if os.path.exists(os.path.join(output_path, name)):
+                warnings.append(f"{name} already exists and will be replaced")
+
+        report.append(
+            {
+                "path": path,
+                "output": name,
+                "status": "error" if errors else "ok",
+                "errors": errors,
+                "warnings": warnings,
+                "info": info,
+            }
+        )
+
+    for entry in report:
+        if entry["errors"]:
+            print(f"Rejected: {entry['path']}: {'; '.join(entry['errors'])}")
+        for warning in entry["warnings"]:
+            print(f"Warning: {entry['path']}: {warning}")
+
+    clean = [entry["path"] for entry in report if not entry["errors"]]
+
+    print(f"{len(clean)}/{len(paths)} file(s) ready")
+    if report_path:
+        write_report(report, report_path)
+        print(f"Report written to {os.path.abspath(report_path)}")
+    print("Done.")
+
+    return clean
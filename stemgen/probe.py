@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Probe audio files with ffprobe, in parallel for batches
+
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from stemgen import toolchain
+
+
+def collect_inputs(paths, extensions):
+    """Expand folders (recursively) and keep the files with a supported extension"""
+    inputs = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    if os.path.splitext(file)[1] in extensions:
+                        inputs.append(os.path.join(root, file))
+        else:
+            inputs.append(path)
+
+    return inputs
+
+
+def probe(path):
+    """Returns the audio properties of the first audio stream of `path`
+
+    Raises `subprocess.CalledProcessError` if ffprobe can't read the file and
+    `ValueError` if it has no audio stream.
+    """
+    output = subprocess.check_output(
+        [
+            toolchain.command("ffprobe"),
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=codec_name,sample_rate,channels,bits_per_sample,"
+            "bits_per_raw_sample,duration:format=duration,size",
+            "-of",
+            "json",
+            path,
+        ],
+        stderr=subprocess.PIPE,
+    )
+    info = json.loads(output)
+
+    if not info.get("streams"):
+        raise ValueError(f"No audio stream found in {path}")
+
+    stream = info["streams"][0]
+    fmt = info.get("format", {})
+
+    def _int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+
+    def _float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    return {
+        "codec": stream.get("codec_name"),
+        "sample_rate": _int(stream.get("sample_rate")),
+        "channels": _int(stream.get("channels")),
+        "bit_depth": _int(stream.get("bits_per_raw_sample"))
+        or _int(stream.get("bits_per_sample")),
+        "duration": _float(stream.get("duration")) or _float(fmt.get("duration")),
+        "size": _int(fmt.get("size")) or os.path.getsize(path),
+    }
+
+
+def _safe_probe(path):
+    try:
+        return path, probe(path)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        return path, e
+
+
+def probe_all(paths, workers=None):
+    """Probe all `paths` on a thread pool
+
+    Returns a list of `(path, info)` in the same order, where `info` is the
+    exception raised if the file could not be probed.
+    """
+    # ffprobe runs in a subprocess, threads are enough
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_safe_probe, paths))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Profiling hooks for the Stemgen commands
+
+# Usage:
+# `stemgen track.wav --profile`
+# `stem track.0.wav --profile`
+# `stemsep track.stem.m4a --profile`
+# `stemcheck track.stem.m4a --profile`
+
+# Writes `[NAME].[PID].pstats` (open it with `python3 -m pstats`) and
+# `[NAME].[PID].profile.txt`, a report ranking stages and functions by time and
+# memory. The PID keeps concurrent runs in the same output folder apart.
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from stemgen.events import log_event
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+ENABLED = False
+STAGES = []
+RSS_INTERVAL = 0.1
+
+_sampler = None
+
+
+def _rss():
+    """Current resident set size of this process, in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if resource is not None:
+        # Only the peak is available: kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    return 0
+
+
+def _children_usage():
+    """CPU time (user + sys) and peak RSS of all the waited-for child processes
+
+    This covers the ffmpeg, sox, MP4Box and separation subprocesses. The peak
+    RSS is the largest child since the start of the process, not per stage.
+    """
+    if resource is None:
+        return 0.0, 0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    maxrss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, maxrss
+
+
+class _RSSSampler(threading.Thread):
+    """Samples the RSS periodically and keeps the peak of the current stage"""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def reset(self):
+        peak, self.peak = self.peak, _rss()
+        return peak
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, _rss())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextmanager
+def stage(name, **fields):
+    """Time a pipeline stage
+
+    Records wall time, CPU time of this process and of its children, peak RSS
+    and peak traced Python memory when profiling is enabled.
+
+    With `fields` (e.g. `audio_seconds`, `model`), the wall time and the
+    children usage are also logged to the events log, to calibrate
+    `stemgen plan`.
+    """
+    if not ENABLED and not fields:
+        yield
+        return
+
+    if ENABLED:
+        if _sampler is not None:
+            _sampler.reset()
+        tracemalloc.reset_peak()
+    children_cpu, start_children_maxrss = _children_usage()
+    cpu = time.process_time()
+    start = time.perf_counter()
+
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        wall = time.perf_counter() - start
+        end_children_cpu, children_maxrss = _children_usage()
+        # Only known for the stage that raised the peak, the others may have
+        # used less than an earlier stage (e.g. the encode after the separation)
+        if children_maxrss <= start_children_maxrss:
+            children_maxrss = None
+
+        # Failed stages would skew the calibration
+        if fields and completed:
+            if children_maxrss is not None:
+                fields = {**fields, "children_maxrss": children_maxrss}
+            log_event(
+                "stage",
+                stage=name,
+                seconds=wall,
+                children_cpu=end_children_cpu - children_cpu,
+                **fields,
+            )
+
+        if ENABLED:
+            STAGES.append(
+                {
+                    "stage": name,
+                    "wall": wall,
+                    "cpu": time.process_time() - cpu,
+                    "children_cpu": end_children_cpu - children_cpu,
+                    "children_maxrss": children_maxrss,
+                    "peak_rss": max(_sampler.reset() if _sampler else 0, _rss()),
+                    "peak_traced": tracemalloc.get_traced_memory()[1],
+                }
+            )
+
+
+def _format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+
+def _report(profiler, snapshot, total):
+    out = io.StringIO()
+
+    out.write(f"Total: {total:.2f}s\n\n")
+
+    out.write("Stages (by wall time)\n")
+    out.write(
+        f"{'stage':<24}{'wall':>10}{'cpu':>10}{'children':>10}"
+        f"{'peak rss':>12}{'peak py':>12}{'child rss':>12}\n"
+    )
+    for s in sorted(STAGES, key=lambda s: s["wall"], reverse=True):
+        out.write(
+            f"{s['stage']:<24}{s['wall']:>9.2f}s{s['cpu']:>9.2f}s"
+            f"{s['children_cpu']:>9.2f}s{_format_bytes(s['peak_rss']):>12}"
+            f"{_format_bytes(s['peak_traced']):>12}"
+            f"{_format_bytes(s['children_maxrss']) if s['children_maxrss'] else '-':>12}\n"
+        )
+    out.write(
+        f"\nPeak RSS of the child processes: {_format_bytes(_children_usage()[1])}\n"
+        "(child rss is only shown for the stage that raised it)\n"
+    )
+
+    out.write("\nFunctions (by cumulative time)\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(25)
+
+    out.write("Allocations (by size)\n")
+    for stat in snapshot.statistics("lineno")[:15]:
+        out.write(f"{stat}\n")
+
+    return out.getvalue()
+
+
+def run(name, func, output_dir="."):
+    """Run `func` under cProfile and tracemalloc and write the report
+
+    Writes `[name].[pid].pstats` and `[name].[pid].profile.txt` in `output_dir`.
+    """
+    global ENABLED, _sampler
+
+    ENABLED = True
+    STAGES.clear()
+    tracemalloc.start()
+    _sampler = _RSSSampler()
+    _sampler.start()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+
+    try:
+        profiler.runcall(func)
+    finally:
+        total = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        _sampler.stop()
+        _sampler = None
+        ENABLED = False
+
+        print("Writing profile...")
+
+        os.makedirs(output_dir, exist_ok=True)
+        pstats_path = os.path.join(output_dir, f"{name}.{os.getpid()}.pstats")
+        report_path = os.path.join(output_dir, f"{name}.{os.getpid()}.profile.txt")
+
+        profiler.dump_stats(pstats_path)
+        report = _report(profiler, snapshot, total)
+        with open(report_path, "w") as f:
+            f.write(report)
+
+        print(report)
+        print(f"Profile written to {report_path} and {pstats_path}")
+        print("Done.")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Quality gate between the separation and the encode
+
+# Catches the broken separations (crashed separator, silent or clipping stems,
+# truncated stems) before spending minutes encoding and muxing them. The
+# files are read block by block, all the stems at once.
+
+import contextlib
+
+import numpy as np
+import soundfile as sf
+
+from stemgen.events import log_event
+
+BLOCK_SIZE = 65536
+
+# Stems shorter or longer than the mix
+MAX_LENGTH_DIFF = 0.1
+# Energy of the mix minus the sum of the stems, relative to the mix
+MAX_RESIDUAL_DB = -15.0
+# A stem louder than the mix is garbage
+MAX_STEM_OVER_MIX_DB = 6.0
+# Ratio of clipped samples
+CLIP_LEVEL = 0.999
+MAX_CLIPPED = 0.001
+# Below this, a stem is silent (fine for one stem, e.g. the vocals of an instrumental)
+SILENCE_DB = -80.0
+
+
+def _db(value):
+    return 10 * np.log10(value) if value > 0 else float("-inf")
+
+
+def measure(mix_path, stem_paths):
+    """Returns the metrics of the stems against the mix"""
+    mix_info = sf.info(mix_path)
+    stem_infos = [sf.info(stem_path) for stem_path in stem_paths]
+
+    metrics = {
+        "frames": mix_info.frames,
+        "length_diff": [
+            abs(info.frames - mix_info.frames) / mix_info.samplerate for info in stem_infos
+        ],
+    }
+
+    frames = min([mix_info.frames] + [info.frames for info in stem_infos])
+    mix_energy = 0.0
+    residual_energy = 0.0
+    stem_energy = np.zeros(len(stem_paths))
+    stem_peak = np.zeros(len(stem_paths))
+    stem_clipped = np.zeros(len(stem_paths))
+    samples = 0
+
+    with contextlib.ExitStack() as stack:
+        mix_file = stack.enter_context(sf.SoundFile(mix_path))
+        stem_files = [stack.enter_context(sf.SoundFile(p)) for p in stem_paths]
+
+        for _ in range(0, frames, BLOCK_SIZE):
+            count = min(BLOCK_SIZE, frames - mix_file.tell())
+            mix = mix_file.read(count, dtype="float32", always_2d=True)
+            # (stems, frames, channels)
+            stems = np.stack(
+                [f.read(count, dtype="float32", always_2d=True) for f in stem_files]
+            )
+            # A mono mix is compared to each channel of the stems
+            mix = np.broadcast_to(mix, stems.shape[1:])
+
+            mix_energy += float(np.sum(np.square(mix, dtype=np.float64)))
+            residual_energy += float(
+                np.sum(np.square(mix - stems.sum(axis=0), dtype=np.float64))
+            )
+            stem_energy += np.sum(np.square(stems, dtype=np.float64), axis=(1, 2))
+            stem_peak = np.maximum(stem_peak, np.abs(stems).max(axis=(1, 2)))
+            stem_clipped += np.count_nonzero(np.abs(stems) >= CLIP_LEVEL, axis=(1, 2))
+            samples += mix.size
+
+    samples = max(samples, 1)
+    metrics["mix_rms_db"] = _db(mix_energy / samples)
+    metrics["residual_db"] = _db(residual_energy) - _db(mix_energy) if mix_energy else 0.0
+    metrics["rms_db"] = [_db(energy / samples) for energy in stem_energy]
+    metrics["peak_db"] = [2 * _db(peak) for peak in stem_peak]
+    metrics["clipped"] = [float(clipped / samples) for clipped in stem_clipped]
+
+    return metrics
+
+
+def check(mix_path, stem_paths, names):
+    """Returns `(errors, warnings, metrics)` for the stems of a track"""
+    errors = []
+    warnings = []
+
+    try:
+        metrics = measure(mix_path, stem_paths)
+    except (RuntimeError, ValueError) as e:
+        # Missing or unreadable stem, or channel count mismatch
+        return [f"cannot read the stems: {e}"], warnings, {}
+
+    for name, diff in zip(names, metrics["length_diff"]):
+        if diff > MAX_LENGTH_DIFF:
+            errors.append(f"{name} length is off by {diff:.2f}s")
+
+    if metrics["residual_db"] > MAX_RESIDUAL_DB:
+        errors.append(
+            f"the stems don't add up to the mix (residual {metrics['residual_db']:.1f} dB)"
+        )
+
+    silent = 0
+    for name, rms, clipped in zip(names, metrics["rms_db"], metrics["clipped"]):
+        if rms < SILENCE_DB:
+            silent += 1
+            warnings.append(f"{name} is silent")
+        elif rms > metrics["mix_rms_db"] + MAX_STEM_OVER_MIX_DB:
+            errors.append(f"{name} is {rms - metrics['mix_rms_db']:.1f} dB louder than the mix")
+        if clipped > MAX_CLIPPED:
+            errors.append(f"{name} clips ({clipped:.2%} of the samples)")
+
+    if silent == len(names) and metrics["mix_rms_db"] >= SILENCE_DB:
+        errors.append("all the stems are silent")
+
+    return errors, warnings, metrics
+
+
+def quality_check(mix_path, stem_paths, names, **fields):
+    """Print and log the QC metrics, returns the errors"""
+    print("Checking stems...")
+
+    errors, warnings, metrics = check(mix_path, stem_paths, names)
+
+    if metrics:
+        print(
+            f"residual={metrics['residual_db']:.1f}dB mix_rms={metrics['mix_rms_db']:.1f}dB"
+        )
+        for i, name in enumerate(names):
+            print(
+                f"{name}: rms={metrics['rms_db'][i]:.1f}dB peak={metrics['peak_db'][i]:.1f}dB "
+                f"clipped={metrics['clipped'][i]:.4%} length_diff={metrics['length_diff'][i]:.3f}s"
+            )
+    for warning in warnings:
+        print(f"Warning: {warning}")
+    for error in errors:
+        print(f"Error: {error}")
+
+    log_event("qc", passed=not errors, errors=errors, warnings=warnings, **metrics, **fields)
+
+    print("Done.")
+
+    return errors
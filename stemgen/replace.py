@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Replace one or more stems of a stem file, without touching the others
+
+# Usage:
+# `stemgen replace-stem "Track.stem.m4a" --vocals vocals.wav`
+# `stemgen replace-stem "Track.stem.m4a" --drums drums.wav --bass bass.wav -o "New.stem.m4a"`
+
+# Only the replacements are encoded, in the codec and at the sample rate of
+# the stem file (ALAC or AAC). The compressed samples of the mixdown and of
+# the other stems are copied as is, and the stem metadata, tags and cover
+# are kept (except the build state and the analysis of Stemgen, which were
+# for the old stems). Much cheaper than a new separation and five encodes
+# when a better model comes out for one stem.
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+from stemgen import edit, mux, toolchain
+from stemgen.qc import MAX_LENGTH_DIFF
+from stemgen.routing import STEMS
+
+# Tags describing the old stems: the build state (`--incremental` would skip
+# the track) and the analysis (`--analyze` would keep it)
+STALE_TAGS = {"stemgen_state": None, "stemgen_analysis": None}
+
+
+def _aac_args():
+    # Same choice of encoder as ni-stem
+    codec = toolchain.aac_codec()
+    if codec == "aac_at":
+        return ["-c:a", "aac_at", "-q:a", "0"]
+    if codec == "libfdk_aac":
+        return ["-c:a", "libfdk_aac", "-vbr", "5"]
+    print("For better audio quality, install `aac_at` or `libfdk_aac` codec.")
+    return ["-c:a", "aac"]
+
+
+def encode(input_path, output_path, format, sample_rate, channels):
+    """Encode `input_path` to an `.m4a` that fits in the stem file"""
+    print(f"Encoding {input_path} to {format}...")
+
+    codec_args = _aac_args() if format == "aac" else ["-c:a", "alac"]
+    subprocess.run(
+        [toolchain.command("ffmpeg"), "-v", "error", "-y", "-i", input_path, "-vn", "-map", "0:a:0"]
+        + codec_args
+        + ["-ar", str(sample_rate), "-ac", str(channels), output_path],
+        check=True,
+    )
+
+    print("Done.")
+
+
+def replace_stems(stem_path, replacements, output_path=None):
+    """Replace the stems of `stem_path`, e.g. `{"vocals": "vocals.wav"}`
+
+    Writes to `output_path`, or over `stem_path`.
+    """
+    tracks = mux.read_tracks(stem_path)
+    if len(tracks) != len(STEMS) + 1:
+        raise mux.MuxError(f"{stem_path} has {len(tracks)} audio tracks, not {len(STEMS) + 1}")
+
+    mixdown = tracks[0]
+    format = mux.FORMATS.get(mixdown.codec)
+    if format is None:
+        raise mux.MuxError(f"Unsupported codec {mixdown.codec!r} in {stem_path}")
+
+    output_path = output_path or stem_path
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".replace.", dir=os.path.dirname(os.path.abspath(output_path))
+    )
+    try:
+        for stem, input_path in replacements.items():
+            index = STEMS.index(stem) + 1
+            encoded_path = os.path.join(tmp_dir, f"{stem}.m4a")
+            encode(input_path, encoded_path, format, mixdown.timescale, tracks[index].channels)
+
+            replacement = mux.read_tracks(encoded_path)[0]
+            diff = abs(replacement.duration - mixdown.duration) / mux.MOVIE_TIMESCALE
+            if diff > MAX_LENGTH_DIFF:
+                print(f"Warning: {stem} length is off by {diff:.2f}s")
+            tracks[index] = replacement
+
+        print("Muxing...")
+        tmp_path = os.path.join(tmp_dir, "output.stem.m4a")
+        mux.mux(tracks, tmp_path, mux.read_udta(stem_path))
+        edit.edit(tmp_path, {"tags": STALE_TAGS})
+        if os.path.exists(output_path):
+            shutil.copystat(output_path, tmp_path)
+        os.replace(tmp_path, output_path)
+        print("Done.")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen replace-stem",
+        description="Replace stems of a stem file. Only the new stems are encoded.",
+    )
+    parser.add_argument("stem", help="the stem file")
+    for stem in STEMS:
+        parser.add_argument(f"--{stem}", dest=stem, help=f"the new {stem} (any audio file)")
+    parser.add_argument(
+        "-o", "--output", dest="output", help="write to this file instead of the stem file"
+    )
+    args = parser.parse_args(argv)
+
+    replacements = {stem: getattr(args, stem) for stem in STEMS if getattr(args, stem)}
+    if not replacements:
+        parser.error(f"nothing to replace, use one of {', '.join('--' + s for s in STEMS)}")
+    for path in [args.stem, *replacements.values()]:
+        if not os.path.isfile(path):
+            parser.error(f"{path} doesn't exist")
+
+    try:
+        replace_stems(args.stem, replacements, args.output)
+    except (OSError, subprocess.CalledProcessError, mux.MuxError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Per-stem model routing
+
+# Usage:
+# `stemgen track.wav --routes routes.json`
+
+# `routes.json` maps every stem to a model, or `other` to `"residual"` to
+# derive it as the mix minus the other three stems:
+# {
+#   "vocals": {"model": "bs_roformer", "model_path": "vocals.ckpt"},
+#   "drums": {"model": "htdemucs", "shifts": "2"},
+#   "bass": {"model": "htdemucs", "shifts": "2"},
+#   "other": "residual"
+# }
+# Every distinct model runs once per track.
+
+import json
+
+import numpy as np
+import soundfile as sf
+
+STEMS = ["drums", "bass", "other", "vocals"]
+RESIDUAL = "residual"
+
+DEFAULT_BACKEND = {"model": "bs_roformer", "model_path": None, "shifts": "1", "overlap": None}
+
+
+def load_routes(path):
+    """Returns `{stem: backend or "residual"}`, raises `ValueError` if invalid"""
+    with open(path) as f:
+        config = json.load(f)
+
+    if not isinstance(config, dict) or set(config) != set(STEMS):
+        raise ValueError(f"{path} must route exactly these stems: {', '.join(STEMS)}")
+
+    routes = {}
+    for stem in STEMS:
+        route = config[stem]
+        if route == RESIDUAL:
+            if stem != "other":
+                raise ValueError(f"Only other can be the residual, not {stem}")
+            routes[stem] = RESIDUAL
+        elif isinstance(route, dict) and "model" in route:
+            backend = {**DEFAULT_BACKEND, **route}
+            backend["shifts"] = str(backend["shifts"])
+            if backend["overlap"] is not None:
+                backend["overlap"] = str(backend["overlap"])
+            routes[stem] = backend
+        else:
+            raise ValueError(f'Invalid route for {stem}: {route!r}, expected {{"model": ...}}')
+
+    return routes
+
+
+def backends(routes):
+    """Distinct backends of `routes`, each with the stems it provides"""
+    distinct = []
+
+    for stem, route in routes.items():
+        if route == RESIDUAL:
+            continue
+        for backend, stems in distinct:
+            if backend == route:
+                stems.append(stem)
+                break
+        else:
+            distinct.append((route, [stem]))
+
+    return distinct
+
+
+def _read(path, frames):
+    data, _ = sf.read(path, dtype="float64", always_2d=True)
+    # The separators can be a few samples off
+    if len(data) < frames:
+        data = np.pad(data, ((0, frames - len(data)), (0, 0)))
+    return data[:frames]
+
+
+def residual(mix_path, stem_paths, output_path, subtype):
+    """Write the mix minus the stems to `output_path`"""
+    info = sf.info(mix_path)
+    data = _read(mix_path, info.frames)
+    for stem_path in stem_paths:
+        data -= _read(stem_path, info.frames)
+
+    # libsndfile wraps around instead of clipping
+    sf.write(output_path, np.clip(data, -1.0, 1.0 - 2**-23), info.samplerate, subtype=subtype)
+
+
+def reconstruction_error(mix_path, stem_paths):
+    """Energy of the mix minus the sum of the stems, relative to the mix, in dB
+
+    The lower the better: stems from different models that overlap or miss
+    parts of the mix show up here.
+    """
+    info = sf.info(mix_path)
+    mix = _read(mix_path, info.frames)
+    error = mix - sum(_read(stem_path, info.frames) for stem_path in stem_paths)
+
+    mix_energy = np.sum(mix**2)
+    if mix_energy == 0:
+        return float("-inf")
+    return 10 * np.log10(max(np.sum(error**2), 1e-20) / mix_energy)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+# Segment cache: separate the audio shared by several versions of a track once
+
+# Usage:
+# `stemgen "Track (Radio Edit).wav" "Track (Extended Mix).wav" --segment-cache`
+
+# The mix is split into chunks at content-defined boundaries: a boundary is
+# placed where a hash of a few samples matches a pattern, so the same audio
+# gets the same chunks whatever its offset in the track (an extended intro
+# shifts everything, the chunks still line up). Each chunk is hashed and the
+# stems of the chunks already separated with the same settings come from the
+# cache. The other chunks are separated in regions, with some context on both
+# sides so the model doesn't see a hard cut, and crossfaded into the cached
+# chunks around them.
+# The matching is exact: the versions must share the same samples.
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import soundfile as sf
+
+CACHE_DIR = os.environ.get("STEMGEN_SEGMENTS") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "stemgen",
+    "segments",
+)
+MAX_CACHE_BYTES = 20 * 2**30
+
+# Chunk lengths, in seconds
+MIN_CHUNK = 4.0
+TARGET_CHUNK = 8.0
+MAX_CHUNK = 30.0
+# Audio separated around each region, then dropped
+CONTEXT = 5.0
+# Crossfade between fresh and cached stems, taken from the context
+FADE = 1.0
+
+# Samples hashed to find the boundaries
+WINDOW = 4
+_MULTIPLIERS = np.array(
+    [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93],
+    dtype=np.uint64,
+)
+
+
+def chunk_boundaries(data, sample_rate):
+    """Returns the content-defined chunk boundaries of `data`, from 0 to its length"""
+    frames = len(data)
+    min_chunk = int(MIN_CHUNK * sample_rate)
+    max_chunk = int(MAX_CHUNK * sample_rate)
+    mask = np.uint64((1 << int(np.log2(TARGET_CHUNK * sample_rate - min_chunk))) - 1)
+
+    # Hash of every window of samples (uint64 wraps around)
+    mono = data.astype(np.int64).sum(axis=1).view(np.uint64)
+    with np.errstate(over="ignore"):
+        h = np.zeros(max(0, frames - WINDOW + 1), dtype=np.uint64)
+        for k in range(WINDOW):
+            h += mono[k : frames - WINDOW + 1 + k] * _MULTIPLIERS[k]
+        h ^= h >> np.uint64(29)
+        h *= _MULTIPLIERS[0]
+        h ^= h >> np.uint64(32)
+
+    # Digital silence hashes to 0 everywhere, it can't place a boundary
+    silent = np.ones(len(h), dtype=bool)
+    for k in range(WINDOW):
+        silent &= mono[k : frames - WINDOW + 1 + k] == 0
+    candidates = np.flatnonzero(((h & mask) == 0) & ~silent) + WINDOW
+
+    boundaries = [0]
+    while True:
+        last = boundaries[-1]
+        i = np.searchsorted(candidates, last + min_chunk)
+        if (
+            i < len(candidates)
+            and candidates[i] <= last + max_chunk
+            and frames - candidates[i] >= min_chunk
+        ):
+            boundaries.append(int(candidates[i]))
+        elif frames - last > max_chunk:
+            boundaries.append(last + max_chunk)
+        else:
+            break
+    boundaries.append(frames)
+
+    return boundaries
+
+
+def digest(data, sample_rate):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{sample_rate}:{data.shape[1]}:".encode("utf-8"))
+    h.update(np.ascontiguousarray(data).tobytes())
+    return h.hexdigest()
+
+
+def plan(data, sample_rate, cache_dir):
+    """Returns the chunks of `data`, as `(start, end, digest, cached)`"""
+    boundaries = chunk_boundaries(data, sample_rate)
+
+    chunks = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        key = digest(data[start:end], sample_rate)
+        chunks.append((start, end, key, os.path.isdir(os.path.join(cache_dir, key))))
+
+    return chunks
+
+
+def regions(chunks, frames, sample_rate):
+    """Runs of chunks to separate, as `(start, end, context_start, context_end)`"""
+    context = int(CONTEXT * sample_rate)
+
+    runs = []
+    for start, end, _, cached in chunks:
+        if cached:
+            continue
+        if runs and runs[-1][1] == start:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+
+    return [
+        (start, end, max(0, start - context), min(frames, end + context))
+        for start, end in runs
+    ]
+
+
+def write_regions(data, sample_rate, layout, path, subtype):
+    """Write the regions, with their context, one after the other to `path`"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sf.write(
+        path,
+        np.concatenate([data[cs:ce] for _, _, cs, ce in layout]),
+        sample_rate,
+        subtype=subtype,
+    )
+
+
+def _read(path, frames):
+    data, _ = sf.read(path, dtype="int32", always_2d=True)
+    # The separators can be a few samples off
+    if len(data) < frames:
+        data = np.pad(data, ((0, frames - len(data)), (0, 0)))
+    return data[:frames]
+
+
+def _blend(a, b):
+    # Linear crossfade from `a` to `b`: both are estimates of the same audio
+    w = np.linspace(0, 1, len(a), endpoint=False)[:, None]
+    return np.round(a * (1 - w) + b * w).astype(np.int32)
+
+
+def assemble(chunks, layout, separated_dir, stems_dir, stems, frames, sample_rate, subtype, cache_dir):
+    """Write the full stems to `stems_dir`, from the cache and the separated regions
+
+    `separated_dir` holds the stems of the file written by `write_regions`.
+    """
+    fade = int(FADE * sample_rate)
+    os.makedirs(stems_dir, exist_ok=True)
+
+    for stem in stems:
+        separated = None
+        if layout:
+            length = sum(ce - cs for _, _, cs, ce in layout)
+            separated = _read(os.path.join(separated_dir, f"{stem}.wav"), length)
+            channels = separated.shape[1]
+        else:
+            channels = sf.info(os.path.join(cache_dir, chunks[0][2], f"{stem}.flac")).channels
+
+        output = np.zeros((frames, channels), dtype=np.int32)
+
+        for start, end, key, cached in chunks:
+            if cached:
+                output[start:end] = _read(os.path.join(cache_dir, key, f"{stem}.flac"), end - start)
+
+        offset = 0
+        for start, end, context_start, context_end in layout:
+            region = separated[offset : offset + context_end - context_start]
+            output[start:end] = region[start - context_start : end - context_start]
+            # Seams with the cached chunks, inside the context
+            if start > 0:
+                left = min(fade, start - context_start)
+                output[start - left : start] = _blend(
+                    output[start - left : start],
+                    region[start - left - context_start : start - context_start],
+                )
+            if end < frames:
+                right = min(fade, context_end - end)
+                output[end : end + right] = _blend(
+                    region[end - context_start : end + right - context_start],
+                    output[end : end + right],
+                )
+            offset += context_end - context_start
+
+        sf.write(os.path.join(stems_dir, f"{stem}.wav"), output, sample_rate, subtype=subtype)
+
+
+def store(chunks, stems_dir, stems, sample_rate, subtype, cache_dir, offset=0):
+    """Add the stems of the chunks that are not cached yet
+
+    `offset` is the position of the first chunk in the stems (trimmed silence).
+    """
+    new = [chunk for chunk in chunks if not chunk[3]]
+    if not new:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dirs = [tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir) for _, _, key, _ in new]
+
+    for stem in stems:
+        data, _ = sf.read(os.path.join(stems_dir, f"{stem}.wav"), dtype="int32", always_2d=True)
+        for (start, end, _, _), tmp_dir in zip(new, tmp_dirs):
+            sf.write(
+                os.path.join(tmp_dir, f"{stem}.flac"),
+                data[offset + start : offset + end],
+                sample_rate,
+                subtype=subtype,
+                format="FLAC",
+            )
+
+    for (_, _, key, _), tmp_dir in zip(new, tmp_dirs):
+        try:
+            os.rename(tmp_dir, os.path.join(cache_dir, key))
+        except OSError:
+            # Stored by another job in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def touch(chunks, cache_dir):
+    # The least recently used chunks are pruned first
+    for _, _, key, cached in chunks:
+        if cached:
+            try:
+                os.utime(os.path.join(cache_dir, key))
+            except OSError:
+                pass
+
+
+def prune(root=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Remove the least recently used chunks until the cache fits in `max_bytes`"""
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        if not filenames or os.path.basename(dirpath).startswith("."):
+            continue
+        size = sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+        entries.append((os.path.getmtime(dirpath), size, dirpath))
+        total += size
+
+    for _, size, dirpath in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(dirpath, ignore_errors=True)
+        total -= size
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Skip the leading and trailing silence during separation
+
+# The separation only runs on the active region of the track, then the stems
+# are padded back with exact zeros to the original sample count, so they stay
+# sample-aligned with the mixdown in the stem file.
+
+import os
+
+import numpy as np
+import soundfile as sf
+
+# Anything below this level is considered as silence
+THRESHOLD_DB = -60.0
+# Context kept around the active region, so the model sees the attacks and tails
+MARGIN = 1.0
+# Don't bother trimming less than this
+MIN_TRIM = 2.0
+
+INT32_FULL_SCALE = 2**31
+
+
+def find_active_region(data, sample_rate, threshold_db=THRESHOLD_DB, margin=MARGIN):
+    """Returns the `(start, end)` samples of the active region of `data`
+
+    `data` is an int32 array of shape `(samples, channels)` as read by
+    `soundfile`. Returns `None` if the whole track is silent.
+    """
+    threshold = INT32_FULL_SCALE * 10 ** (threshold_db / 20)
+
+    # First and last sample above threshold on any channel (no abs(), which
+    # would overflow on -2**31)
+    loud = np.flatnonzero(
+        (data.max(axis=1) > threshold) | (data.min(axis=1) < -threshold)
+    )
+    if loud.size == 0:
+        return None
+
+    margin = int(margin * sample_rate)
+    return max(0, int(loud[0]) - margin), min(len(data), int(loud[-1]) + 1 + margin)
+
+
+def trim(path, trimmed_dir, threshold_db=THRESHOLD_DB, margin=MARGIN, audio=None):
+    """Write the active region of `path` to `trimmed_dir` (same file name)
+
+    `audio` is the `(data, sample_rate)` of `path` if it is already decoded.
+    Returns `(trimmed_path, start, frames)` where `frames` is the sample count
+    of the original file, or `None` if there is nothing worth trimming.
+    """
+    print("Detecting silence...")
+
+    info = sf.info(path)
+    if audio is None:
+        audio = sf.read(path, dtype="int32", always_2d=True)
+    data, sample_rate = audio
+
+    region = find_active_region(data, sample_rate, threshold_db, margin)
+    if region is None:
+        print("The track is silent, nothing to trim.")
+        return None
+
+    start, end = region
+    trimmed = len(data) - (end - start)
+    if trimmed < MIN_TRIM * sample_rate:
+        print("No silence to trim.")
+        return None
+
+    os.makedirs(trimmed_dir, exist_ok=True)
+    trimmed_path = os.path.join(trimmed_dir, os.path.basename(path))
+    sf.write(
+        trimmed_path,
+        data[start:end],
+        sample_rate,
+        subtype=info.subtype,
+        format=info.format,
+    )
+
+    print(
+        f"Trimmed {start / sample_rate:.2f}s of leading and "
+        f"{(len(data) - end) / sample_rate:.2f}s of trailing silence."
+    )
+    print("Done.")
+
+    return trimmed_path, start, len(data)
+
+
+def pad(stem_paths, start, frames):
+    """Pad the stems in place with zeros back to `frames` samples"""
+    print("Padding stems...")
+
+    for stem_path in stem_paths:
+        info = sf.info(stem_path)
+        data, sample_rate = sf.read(stem_path, dtype="int32", always_2d=True)
+
+        padded = np.zeros((frames, data.shape[1]), dtype=np.int32)
+        length = min(len(data), frames - start)
+        padded[start : start + length] = data[:length]
+
+        sf.write(
+            stem_path,
+            padded,
+            sample_rate,
+            subtype=info.subtype,
+            format=info.format,
+        )
+
+    print("Done.")
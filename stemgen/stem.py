@@ -5,9 +5,12 @@ import os
 import shutil
 import sys
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json
 import unicodedata
+from stemgen import profiling, toolchain
 from stemgen.metadata import get_cover, get_metadata
 
 LOGO = r"""
@@ -62,7 +65,19 @@ parser.add_argument(
     help="the path to the output folder",
 )
 parser.add_argument("-f", "--format", dest="FORMAT", default="alac", help="aac or alac")
+parser.add_argument(
+    "--metadata",
+    dest="METADATA",
+    nargs="+",
+    help="the stem metadata file(s), one per stem file (part 1, part 2, etc.)",
+)
 parser.add_argument("-v", "--version", action="version", version=VERSION)
+parser.add_argument(
+    "--profile",
+    dest="PROFILE",
+    action="store_true",
+    help="profile CPU and memory and write a report in the output folder",
+)
 args = parser.parse_args()
 
 INPUT_PATH = (
@@ -76,113 +91,103 @@ OUTPUT_PATH = (
     else os.path.join(PROCESS_DIR, args.OUTPUT_PATH)
 )
 FORMAT = args.FORMAT
+METADATA = args.METADATA
 PYTHON_EXEC = sys.executable if not None else "python3"
+WORKING_DIR = None
 
 # CREATION
 
 
+def count_stems():
+    count = 0
+    while os.path.exists(f"{INPUT_DIR}/{FILE_NAME}.{count + 1}{FILE_EXTENSION}"):
+        count += 1
+    return count
+
+
+def get_stem_names(parts):
+    if parts == 1:
+        return [f"{FILE_NAME}.stem.m4a"]
+    return [f"{FILE_NAME} [part {part + 1}].stem.m4a" for part in range(parts)]
+
+
+def create_part(part, parts, mixdown_path):
+    with open(f"{OUTPUT_PATH}/{WORKING_DIR}/tags.json") as f:
+        tags = json.load(f)
+    if parts > 1:
+        tags["title"] = f"{tags['title']} [part {part + 1}]"
+
+    stem_args = [PYTHON_EXEC, os.path.join(INSTALL_DIR, "ni-stem/ni-stem"), "create", "-s"]
+    stem_args += link_stems(4 * part + 1, 4 * part + 4)
+    stem_args += [
+        "-x",
+        mixdown_path,
+        # The tags of the part are passed on stdin, tags.json is left as is
+        "-t",
+        "-",
+        "-m",
+        METADATA[part]
+        if METADATA and part < len(METADATA)
+        else os.path.join(INSTALL_DIR, "metadata.json"),
+        "-f",
+        FORMAT,
+        "-o",
+        f"{OUTPUT_PATH}/{WORKING_DIR}/{get_stem_names(parts)[part]}",
+    ]
+
+    subprocess.run(stem_args, input=json.dumps(tags).encode("utf-8"), check=True)
+
+
 def create_stem():
     print("Creating stem...")
-    os.chdir(INSTALL_DIR)
-
-    is_double_stem = False
-
-    # Create another stem if we have more than 4 stems in the folder
-    if os.path.exists(f"{INPUT_DIR}/{FILE_NAME}.5{FILE_EXTENSION}"):
-        is_double_stem = True
-
-    if is_double_stem:
-        # Open tags.json and edit the title
-        with open(f"{OUTPUT_PATH}/{FILE_NAME}/tags.json", "r+") as f:
-            tags = json.load(f)
-            tags["title"] = f"{tags['title']} [part 1]"
-            f.seek(0)
-            json.dump(tags, f)
-            f.truncate()
-
-        stem_args = [PYTHON_EXEC, "ni-stem/ni-stem", "create", "-s"]
-        stem_args += [
-            f"{INPUT_DIR}/{FILE_NAME}.1{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.2{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.3{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.4{FILE_EXTENSION}",
-        ]
-        stem_args += [
-            "-x",
-            INPUT_PATH,
-            "-t",
-            f"{OUTPUT_PATH}/{FILE_NAME}/tags.json",
-            "-m",
-            "metadata.part1.json",
-            "-f",
-            FORMAT,
-            "-o",
-            f"{OUTPUT_PATH}/{FILE_NAME}/{FILE_NAME} [part 1].stem.m4a",
-        ]
-
-        subprocess.run(stem_args)
-
-        # Open tags.json and edit the title (again)
-        with open(f"{OUTPUT_PATH}/{FILE_NAME}/tags.json", "r+") as f:
-            tags = json.load(f)
-            tags["title"] = tags["title"].replace(" [part 1]", " [part 2]")
-            f.seek(0)
-            json.dump(tags, f)
-            f.truncate()
-
-        stem_args = [PYTHON_EXEC, "ni-stem/ni-stem", "create", "-s"]
-        stem_args += [
-            f"{INPUT_DIR}/{FILE_NAME}.5{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.6{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.7{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.8{FILE_EXTENSION}",
-        ]
-        stem_args += [
-            "-x",
-            INPUT_PATH,
-            "-t",
-            f"{OUTPUT_PATH}/{FILE_NAME}/tags.json",
-            "-m",
-            "metadata.part2.json",
-            "-f",
-            FORMAT,
-            "-o",
-            f"{OUTPUT_PATH}/{FILE_NAME}/{FILE_NAME} [part 2].stem.m4a",
-        ]
-
-        subprocess.run(stem_args)
+
+    # One stem file per group of 4 stems (e.g. 8 tracks: part 1 and part 2)
+    stems = count_stems()
+    if stems == 0 or stems % 4:
+        print(f"Found {stems} stems, expected a multiple of 4: {FILE_NAME}.1{FILE_EXTENSION} to {FILE_NAME}.4{FILE_EXTENSION}, etc.")
+        sys.exit(1)
+    parts = stems // 4
+
+    # The mixdown is the same in every part: it is encoded once
+    if parts > 1:
+        subprocess.run(
+            [PYTHON_EXEC, os.path.join(INSTALL_DIR, "ni-stem/ni-stem"), "convert", "-i", FILE_PATH, "-f", FORMAT],
+            check=True,
+        )
+        mixdown_path = os.path.splitext(FILE_PATH)[0] + ".m4a"
     else:
-        stem_args = [PYTHON_EXEC, "ni-stem/ni-stem", "create", "-s"]
-        stem_args += [
-            f"{INPUT_DIR}/{FILE_NAME}.1{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.2{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.3{FILE_EXTENSION}",
-            f"{INPUT_DIR}/{FILE_NAME}.4{FILE_EXTENSION}",
-        ]
-        stem_args += [
-            "-x",
-            INPUT_PATH,
-            "-t",
-            f"{OUTPUT_PATH}/{FILE_NAME}/tags.json",
-            "-m",
-            "metadata.json",
-            "-f",
-            FORMAT,
-            "-o",
-            f"{OUTPUT_PATH}/{FILE_NAME}/{FILE_NAME}.stem.m4a",
-        ]
-
-        subprocess.run(stem_args)
+        mixdown_path = FILE_PATH
+
+    with ThreadPoolExecutor(parts) as executor:
+        list(executor.map(lambda part: create_part(part, parts, mixdown_path), range(parts)))
 
     print("Done.")
 
 
+def link_stems(first, last):
+    # ni-stem writes the converted tracks next to their source: link the stems
+    # into the working dir so that nothing is written in the input folder
+    paths = []
+
+    for i in range(first, last + 1):
+        src = f"{INPUT_DIR}/{FILE_NAME}.{i}{FILE_EXTENSION}"
+        dst = f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}.{i}{FILE_EXTENSION}"
+        try:
+            os.symlink(src, dst)
+        except OSError:
+            # No symlink privilege on Windows
+            shutil.copy(src, dst)
+        paths.append(dst)
+
+    return paths
+
+
 # SETUP
 
 
 def setup():
     for package in REQUIRED_PACKAGES:
-        if not shutil.which(package):
+        if not toolchain.find(package):
             print(f"Please install {package} before running Stem.")
             sys.exit(2)
 
@@ -191,7 +196,7 @@ def setup():
         sys.exit(2)
 
     if not os.path.exists(OUTPUT_PATH):
-        os.mkdir(OUTPUT_PATH)
+        os.makedirs(OUTPUT_PATH, exist_ok=True)
         print("Output dir created.")
     else:
         print("Output dir already exists.")
@@ -204,9 +209,12 @@ def setup():
         print("Invalid input file format. File should be one of:", SUPPORTED_FILES)
         sys.exit(1)
 
-    setup_file()
-    get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, FILE_NAME)
-    get_metadata(FILE_PATH, OUTPUT_PATH, FILE_NAME, FILE_NAME)
+    with profiling.stage("setup_file"):
+        setup_file()
+    with profiling.stage("get_cover"):
+        get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, WORKING_DIR)
+    with profiling.stage("get_metadata"):
+        get_metadata(FILE_PATH, OUTPUT_PATH, WORKING_DIR, FILE_NAME)
 
     print("Ready!")
 
@@ -214,8 +222,10 @@ def setup():
 def run():
     print(f"Creating a Stem file for {FILE_NAME}...")
 
-    create_stem()
-    clean_dir()
+    with profiling.stage("create_stem"):
+        create_stem()
+    with profiling.stage("clean_dir"):
+        clean_dir()
 
     print("Success! Have fun :)")
 
@@ -228,64 +238,63 @@ def strip_accents(text):
 
 
 def setup_file():
-    global FILE_NAME, INPUT_DIR, FILE_PATH
+    global FILE_NAME, WORKING_DIR, INPUT_DIR, FILE_PATH
     FILE_NAME = BASE_PATH.removesuffix(FILE_EXTENSION).removesuffix(".0")
-    INPUT_DIR = os.path.join(PROCESS_DIR, os.path.dirname(INPUT_PATH))
+    INPUT_DIR = os.path.dirname(INPUT_PATH)
 
-    if os.path.exists(f"{OUTPUT_PATH}/{FILE_NAME}"):
-        print("Working dir already exists.")
-    else:
-        os.mkdir(f"{OUTPUT_PATH}/{FILE_NAME}")
-        print("Working dir created.")
+    # Every job gets its own working dir, so several Stem processes can share
+    # the same output folder
+    WORKING_DIR = os.path.basename(
+        tempfile.mkdtemp(prefix=f".{FILE_NAME}.", dir=OUTPUT_PATH)
+    )
+    print("Working dir created.")
 
-    shutil.copy(INPUT_PATH, f"{OUTPUT_PATH}/{FILE_NAME}/{FILE_NAME}{FILE_EXTENSION}")
-    FILE_PATH = f"{OUTPUT_PATH}/{FILE_NAME}/{FILE_NAME}{FILE_EXTENSION}"
+    shutil.copy(INPUT_PATH, f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}{FILE_EXTENSION}")
+    FILE_PATH = f"{OUTPUT_PATH}/{WORKING_DIR}/{FILE_NAME}{FILE_EXTENSION}"
     print("Done.")
 
 
 def clean_dir():
     print("Cleaning...")
 
-    os.chdir(OUTPUT_PATH)
+    for name in get_stem_names(count_stems() // 4):
+        if os.path.isfile(os.path.join(OUTPUT_PATH, WORKING_DIR, name)):
+            os.replace(
+                os.path.join(OUTPUT_PATH, WORKING_DIR, name),
+                os.path.join(OUTPUT_PATH, name),
+            )
 
-    for file in os.listdir(INPUT_DIR):
-        if file.endswith(".m4a"):
-            os.remove(os.path.join(INPUT_DIR, file))
+    remove_working_dir()
 
-    if os.path.isfile(os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME}.stem.m4a")):
-        os.rename(
-            os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME}.stem.m4a"),
-            os.path.join(OUTPUT_PATH, f"{FILE_NAME}.stem.m4a"),
-        )
+    print("Done.")
 
-    if os.path.isfile(
-        os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME} [part 1].stem.m4a")
-    ):
-        os.rename(
-            os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME} [part 1].stem.m4a"),
-            os.path.join(OUTPUT_PATH, f"{FILE_NAME} [part 1].stem.m4a"),
-        )
-        if os.path.isfile(
-            os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME} [part 2].stem.m4a")
-        ):
-            os.rename(
-                os.path.join(OUTPUT_PATH, FILE_NAME, f"{FILE_NAME} [part 2].stem.m4a"),
-                os.path.join(OUTPUT_PATH, f"{FILE_NAME} [part 2].stem.m4a"),
-            )
 
+def remove_working_dir():
     try:
-        shutil.rmtree(os.path.join(OUTPUT_PATH, FILE_NAME))
+        shutil.rmtree(os.path.join(OUTPUT_PATH, WORKING_DIR))
+    except FileNotFoundError:
+        pass
     except PermissionError:
         print(
-            f"Permission error encountered. Directory {os.path.join(OUTPUT_PATH, FILE_NAME)} might still be in use."
+            f"Permission error encountered. Directory {os.path.join(OUTPUT_PATH, WORKING_DIR)} might still be in use."
         )
 
-    print("Done.")
-
 
 def main():
-    setup()
-    run()
+    if args.PROFILE:
+        profiling.run("stem", _main, OUTPUT_PATH)
+    else:
+        _main()
+
+
+def _main():
+    try:
+        setup()
+        run()
+    finally:
+        # Only remove what this job created
+        if WORKING_DIR is not None:
+            remove_working_dir()
 
 
 if __name__ == "__main__":
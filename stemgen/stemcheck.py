@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Stemcheck lets you check the integrity of a stem file
+
+# Installation:
+# `python3 -m pip install ffmpeg-python`
+
+# Usage:
+# `python3 stemcheck.py track.stem.m4a`
+
+import argparse
+
+from stemgen import profiling
+from stemgen.stempeg.read import Info, read_stems
+
+
+def stemcheck(
+    stems_file,
+    idx=None,
+    start=None,
+    duration=None,
+):
+    print("Reading stem file...")
+
+    with profiling.stage("read_stems"):
+        info = Info(stems_file)
+        S, sr = read_stems(
+            stems_file, stem_id=idx, start=start, duration=duration, check=True
+        )
+
+    print("Done. Integrity check succeeded!")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--version", "-v", action="version", version="1.0.0")
+
+    parser.add_argument("filename", metavar="filename", help="Input STEM file")
+
+    # Kept for compatibility: the integrity check always runs
+    parser.add_argument("--check", action="store_true", help="Run an integrity check")
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile CPU and memory and write a report in the current folder",
+    )
+
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.run("stemcheck", lambda: stemcheck(args.filename))
+    else:
+        stemcheck(args.filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 Stempeg is a Python package to read and write [STEM](https://www.native-instruments.com/en/specials/stems/) files.
 Technically, stems are audio containers that combine multiple audio streams and metadata in a single audio file. This makes it ideal to playback multitrack audio, where users can select the audio sub-stream during playback (e.g. supported by VLC). 
 
-Under the hood, _stempeg_ uses [ffmpeg](https://www.ffmpeg.org/) for reading and writing multistream audio, optionally [MP4Box](https://github.com/gpac/gpac) is used to create STEM files that are compatible with Native Instruments hardware and software.
+Under the hood, _stempeg_ uses [ffmpeg](https://www.ffmpeg.org/) for reading and writing multistream audio, STEM files that are compatible with Native Instruments hardware and software are muxed in Python (`stemgen/mux.py`).
 
 - `stempeg.read`: reading audio tensors and metadata.
 - `stempeg.write`: writing audio tensors.
@@ -21,9 +21,10 @@ from .write import FilesWriter, StreamsWriter, ChannelsWriter, NIStemsWriter
 from .cmds import check_available_aac_encoders
 
 import re
-import subprocess as sp
 import importlib.resources
 
+from stemgen import toolchain
+
 __version__ = "1.0.0"
 
 
@@ -47,11 +48,7 @@ def ffmpeg_version():
         version number as string
     """
 
-    cmd = ["ffmpeg", "-version"]
-
-    output = sp.check_output(cmd)
-    aac_codecs = [x for x in output.splitlines() if "ffmpeg version " in str(x)][0]
-    hay = aac_codecs.decode("ascii")
+    hay = toolchain.version("ffmpeg") or ""
     match = re.findall(r"ffmpeg version \w?(\d+\.)?(\d+\.)?(\*|\d+)", hay)
     if match:
         return "".join(match[0])
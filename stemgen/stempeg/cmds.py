@@ -1,25 +1,14 @@
-import re
-import subprocess as sp
 import logging
 
+from stemgen import toolchain
+
 FFMPEG_PATH = None
 FFPROBE_PATH = None
 MP4BOX_PATH = None
 
 
 def find_cmd(cmd):
-    try:
-        from shutil import which
-
-        return which(cmd)
-    except ImportError:
-        import os
-
-        for path in os.environ["PATH"].split(os.pathsep):
-            if os.access(os.path.join(path, cmd), os.X_OK):
-                return path
-
-    return None
+    return toolchain.find(cmd)
 
 
 def ffmpeg_and_ffprobe_exists():
@@ -56,18 +45,7 @@ def check_available_aac_encoders():
         list(str): List of available encoder codecs from ffmpeg
 
     """
-    cmd = [FFMPEG_PATH, "-v", "error", "-codecs"]
-
-    output = sp.check_output(cmd)
-    aac_codecs = [
-        x for x in output.splitlines() if "AAC (Advanced Audio Coding)" in str(x)
-    ][0]
-    hay = aac_codecs.decode("ascii")
-    match = re.findall(r"\(encoders: ([^\)]*) \)", hay)
-    if match:
-        return match[0].split(" ")
-    else:
-        return None
+    return toolchain.aac_encoders() or None
 
 
 def get_aac_codec():
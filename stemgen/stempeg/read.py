@@ -15,7 +15,7 @@ from multiprocessing import Pool
 import atexit
 from functools import partial
 import datetime as dt
-from .cmds import mp4box_exists, find_cmd
+from .cmds import FFMPEG_PATH, FFPROBE_PATH, mp4box_exists, find_cmd
 
 
 class Reader(object):
@@ -84,7 +84,7 @@ def _read_ffmpeg(
     process = (
         ffmpeg.input(filename)
         .output("pipe:", **output_kwargs)
-        .run_async(pipe_stdout=True, pipe_stderr=True)
+        .run_async(cmd=FFMPEG_PATH, pipe_stdout=True, pipe_stderr=True)
     )
     buffer, _ = process.communicate()
 
@@ -207,7 +207,7 @@ def read_stems(
         else:
             metadata = info
 
-        ffmpeg.probe(filename)
+        ffmpeg.probe(filename, cmd=FFPROBE_PATH)
     except ffmpeg._run.Error as e:
         raise Warning(
             "An error occurs with ffprobe (see ffprobe output below)\n\n{}".format(
@@ -320,7 +320,7 @@ class Info(object):
 
     def __init__(self, filename):
         super(Info, self).__init__()
-        self.info = ffmpeg.probe(filename)
+        self.info = ffmpeg.probe(filename, cmd=FFPROBE_PATH)
         self.audio_streams = [
             stream for stream in self.info["streams"] if stream["codec_type"] == "audio"
         ]
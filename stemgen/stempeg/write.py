@@ -2,7 +2,6 @@
 Save stems to disk. 
 """
 
-import base64
 import json
 import logging
 import tempfile as tmp
@@ -17,8 +16,9 @@ import ffmpeg
 import numpy as np
 
 import stemgen.stempeg as stempeg
+from stemgen import mux
 
-from .cmds import FFMPEG_PATH, mp4box_exists, get_aac_codec, find_cmd
+from .cmds import FFMPEG_PATH, get_aac_codec
 
 
 def _build_channel_map(nb_stems, nb_channels, stem_names=None):
@@ -450,13 +450,6 @@ class NIStemsWriter(Writer):
         bitrate=256000,
         output_sample_rate=44100,
     ):
-        if not mp4box_exists():
-            raise RuntimeError(
-                "MP4Box could not be found! "
-                "Please install them before using NIStemsWriter()."
-                "See: https://github.com/faroit/stempeg"
-            )
-        self.mp4boxcli = find_cmd("MP4Box")
         self.bitrate = bitrate
         self.default_metadata = default_metadata
         self.stems_metadata = stems_metadata
@@ -518,32 +511,16 @@ class NIStemsWriter(Writer):
             if self.stems_metadata is not None:
                 metadata["stems"] = self.stems_metadata
 
-            callArgs = [self.mp4boxcli]
-            callArgs.extend(["-add", str(Path(tempdir, "0.m4a#ID=Z")), path])
-            for s in range(1, data.shape[0]):
-                callArgs.extend(
+            try:
+                mux.mux_files(
                     [
-                        "-add",
-                        str(Path(tempdir, str(s) + self._suffix + "#ID=Z:disable")),
-                    ]
+                        str(Path(tempdir, str(s) + self._suffix))
+                        for s in range(data.shape[0])
+                    ],
+                    path,
+                    [(b"stem", json.dumps(metadata).encode())],
                 )
-            callArgs.extend(
-                [
-                    "-brand",
-                    "M4A:0",
-                    "-rb",
-                    "isom",
-                    "-rb",
-                    "iso2",
-                    "-udta",
-                    "0:type=stem:src=base64,"
-                    + base64.b64encode(json.dumps(metadata).encode()).decode(),
-                    "-quiet",
-                ]
-            )
-            try:
-                sp.check_call(callArgs)
-            except sp.CalledProcessError as err:
+            except mux.MuxError as err:
                 raise RuntimeError(err) from None
 
 
@@ -592,7 +569,7 @@ def write_audio(
         ffmpeg.input("pipe:", format="f32le", **input_kwargs)
         .output(path, **output_kwargs)
         .overwrite_output()
-        .run_async(pipe_stdin=True, pipe_stderr=True, quiet=True)
+        .run_async(cmd=FFMPEG_PATH, pipe_stdin=True, pipe_stderr=True, quiet=True)
     )
     try:
         process.stdin.write(data.astype("<f4").tobytes())
@@ -635,8 +612,7 @@ def write_stems(path, data, sample_rate=44100, writer=StreamsWriter(stem_names=N
             `stempeg.NIStemsWriter`
                 Stem will be saved into a single multistream audio.
                 Additionally Native Instruments Stems compabible
-                Metadata is added. This requires the installation of
-                `MP4Box`. See [Readme](../README.md) for more info.
+                Metadata is added.
     Notes:
         Note that file ending of `path` sets the container but not the codec!
         The support for different stem writers depends on the specified output
@@ -14,6 +14,7 @@ import subprocess
 import os
 from os import path as op
 
+from stemgen import profiling, toolchain
 from stemgen.stempeg.read import Info, read_stems
 from stemgen.stempeg.write import write_stems
 from stemgen.stempeg.write import FilesWriter
@@ -28,15 +29,17 @@ def stemsep(
     duration=None,
     check=False,
 ):
-    bit_depth = get_bit_depth(stems_file)
-    codec = get_codec(extension, bit_depth)
+    with profiling.stage("probe"):
+        bit_depth = get_bit_depth(stems_file)
+        codec = get_codec(extension, bit_depth)
 
     print("Reading stem file...")
 
-    info = Info(stems_file)
-    S, sr = read_stems(
-        stems_file, stem_id=idx, start=start, duration=duration
-    )
+    with profiling.stage("read_stems"):
+        info = Info(stems_file)
+        S, sr = read_stems(
+            stems_file, stem_id=idx, start=start, duration=duration
+        )
 
     if check:
         print("Done. Integrity check succeeded!")
@@ -65,17 +68,18 @@ def stemsep(
 
     print("Writing stems...")
 
-    write_stems(
-        (op.join(rootpath, basename), extension),
-        S,
-        sample_rate=sr,
-        writer=FilesWriter(
-            multiprocess=False,
-            output_sample_rate=sr,
-            stem_names=stem_names,
-            codec=codec,
-        ),
-    )
+    with profiling.stage("write_stems"):
+        write_stems(
+            (op.join(rootpath, basename), extension),
+            S,
+            sample_rate=sr,
+            writer=FilesWriter(
+                multiprocess=False,
+                output_sample_rate=sr,
+                stem_names=stem_names,
+                codec=codec,
+            ),
+        )
 
     print("Done!")
 
@@ -119,7 +123,7 @@ def get_bit_depth(file_path):
         try:
             output = subprocess.check_output(
                 [
-                    "ffprobe",
+                    toolchain.command("ffprobe"),
                     "-v",
                     "error",
                     "-select_streams",
@@ -153,7 +157,7 @@ def get_bit_depth(file_path):
         try:
             output = subprocess.check_output(
                 [
-                    "ffprobe",
+                    toolchain.command("ffprobe"),
                     "-v",
                     "error",
                     "-select_streams",
@@ -214,17 +218,29 @@ def main():
 
     parser.add_argument("outdir", metavar="outdir", nargs="?", help="Output folder")
 
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile CPU and memory and write a report in the output folder",
+    )
+
     args = parser.parse_args()
 
-    stemsep(
-        args.filename,
-        args.outdir,
-        args.extension,
-        args.id,
-        args.s,
-        args.t,
-        args.check,
-    )
+    def _stemsep():
+        stemsep(
+            args.filename,
+            args.outdir,
+            args.extension,
+            args.id,
+            args.s,
+            args.t,
+            args.check,
+        )
+
+    if args.profile:
+        profiling.run("stemsep", _stemsep, args.outdir or ".")
+    else:
+        _stemsep()
 
 
 if __name__ == "__main__":
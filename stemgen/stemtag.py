@@ -14,6 +14,7 @@ from pathlib import Path
 import soundfile as sf
 import pyloudnorm as pyln
 from decimal import Decimal
+from stemgen import analysis
 
 
 def main():
@@ -97,12 +98,17 @@ def main():
                         )
 
                         try:
-                            # Load audio (with shape (samples, channels))
-                            data, rate = sf.read(regular_file_path)
-                            # Create BS.1770 meter
-                            meter = pyln.Meter(rate)
-                            # Measure loudness
-                            loudness = meter.integrated_loudness(data)
+                            # Measured by Stemgen when the stem file was created
+                            result = analysis.read(stem_file_path)
+                            if result and result.get("lufs") is not None:
+                                loudness = result["lufs"]
+                            else:
+                                # Load audio (with shape (samples, channels))
+                                data, rate = sf.read(regular_file_path)
+                                # Create BS.1770 meter
+                                meter = pyln.Meter(rate)
+                                # Measure loudness
+                                loudness = meter.integrated_loudness(data)
                             lufs = "LUFS: " + str(
                                 Decimal(str(loudness)).quantize(Decimal("1.00"))
                             )
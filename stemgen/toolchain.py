@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Toolchain: the paths, versions and encoders of the external tools, found once
+
+# Usage:
+# `stemgen toolchain`
+# `stemgen toolchain --refresh`
+
+# ffmpeg, ffprobe, sox, MP4Box and qaac are looked up in `PATH` once per
+# process. Their version, and the encoders of ffmpeg, are cached on disk,
+# keyed by the path, modification time and size of the binary: an upgrade is
+# picked up on the next run, and creating stems doesn't spawn `ffmpeg -codecs`
+# or `ffmpeg -version` for every track to find out what is installed.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+CACHE_PATH = os.environ.get("STEMGEN_TOOLCHAIN") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "stemgen",
+    "toolchain.json",
+)
+
+# Names of every tool, best first, and the flag printing its version
+TOOLS = {
+    "ffmpeg": (["ffmpeg"], "-version"),
+    "ffprobe": (["ffprobe"], "-version"),
+    "sox": (["sox"], "--version"),
+    "MP4Box": (["MP4Box"], "-version"),
+    "qaac": (["qaac64", "qaac32", "qaac"], "--check"),
+}
+
+# AAC encoders of ffmpeg, best first
+AAC_CODECS = ["aac_at", "libfdk_aac", "aac"]
+
+_lock = threading.Lock()
+_paths = {}
+_infos = {}
+
+
+def find(tool):
+    """Returns the path of `tool`, or `None` if it isn't installed"""
+    with _lock:
+        if tool not in _paths:
+            names = TOOLS[tool][0] if tool in TOOLS else [tool]
+            _paths[tool] = next(filter(None, map(shutil.which, names)), None)
+        return _paths[tool]
+
+
+def command(tool):
+    """Returns the path of `tool` to run it, or its name if it isn't installed (running it then fails as usual)"""
+    return find(tool) or (TOOLS[tool][0][-1] if tool in TOOLS else tool)
+
+
+def _run(args):
+    try:
+        result = subprocess.run(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=30,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    # MP4Box and qaac print their version on stderr
+    return (result.stdout + result.stderr).decode("utf-8", "replace")
+
+
+def parse_encoders(output):
+    """Audio encoders of `ffmpeg -encoders`, to the codec they encode"""
+    lines = output.splitlines()
+    start = next((i + 1 for i, line in enumerate(lines) if line.strip() == "------"), 0)
+
+    encoders = {}
+    for line in lines[start:]:
+        fields = line.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith("A"):
+            continue
+        # e.g. `A....D aac_at  aac (AudioToolbox) (codec aac)`, the native
+        # encoder has the name of its codec
+        match = re.search(r"\(codec (\w+)\)$", fields[2] if len(fields) > 2 else "")
+        encoders[fields[1]] = match.group(1) if match else fields[1]
+    return encoders
+
+
+def _detect(tool, path):
+    output = _run([path, TOOLS[tool][1]]) if tool in TOOLS else ""
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    detected = {"version": lines[0] if lines else None}
+    if tool == "ffmpeg":
+        detected["encoders"] = parse_encoders(_run([path, "-hide_banner", "-encoders"]))
+    return detected
+
+
+def _load():
+    try:
+        with open(CACHE_PATH) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def _save(entries):
+    # Atomic, several ni-stem processes can start at once
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".toolchain.", suffix=".json", dir=os.path.dirname(CACHE_PATH)
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError:
+        pass
+
+
+def info(tool, refresh=False):
+    """Returns the path, version and encoders of `tool`, or `None` if it isn't installed"""
+    path = find(tool)
+    if path is None:
+        return None
+
+    with _lock:
+        if tool in _infos and not refresh:
+            return _infos[tool]
+
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        key = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+        entries = _load()
+        entry = entries.get(real_path)
+        if refresh or not isinstance(entry, dict) or {k: entry.get(k) for k in key} != key:
+            entry = dict(key, **_detect(tool, path))
+            entries = _load()
+            entries[real_path] = entry
+            _save(entries)
+
+        _infos[tool] = dict(entry, path=path)
+        return _infos[tool]
+
+
+def version(tool):
+    """Returns the first line printed by `tool` about its version, or `None`"""
+    tool_info = info(tool)
+    return tool_info["version"] if tool_info else None
+
+
+def encoders():
+    """Returns the audio encoders of ffmpeg, to the codec they encode"""
+    tool_info = info("ffmpeg")
+    return tool_info.get("encoders", {}) if tool_info else {}
+
+
+def aac_encoders():
+    """Returns the AAC encoders of ffmpeg"""
+    return [name for name, codec in encoders().items() if codec == "aac"]
+
+
+def aac_codec():
+    """Returns the best AAC encoder of ffmpeg: `aac_at`, `libfdk_aac`, then `aac`"""
+    available = aac_encoders()
+    return next((codec for codec in AAC_CODECS if codec in available), "aac")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen toolchain",
+        description="Show the external tools found, their versions and the AAC encoder used.",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="detect the versions and encoders again"
+    )
+    args = parser.parse_args(argv)
+
+    for tool in TOOLS:
+        tool_info = info(tool, args.refresh)
+        if tool_info is None:
+            print(f"{tool}: not found")
+        else:
+            print(f"{tool}: {tool_info['path']} ({tool_info['version']})")
+    if find("ffmpeg"):
+        print(f"AAC encoders: {', '.join(aac_encoders()) or 'none'}, using {aac_codec()}")
+    print(f"Cache: {CACHE_PATH}")
+
+    return 0 if find("ffmpeg") and find("ffprobe") else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Watch an inbox folder and create the stem files of the new tracks as soon as
+# they arrive
+
+# Usage:
+# `stemgen watch ~/Music/Inbox -o ~/Music/Stems`
+# `stemgen watch ~/Music/Inbox -o ~/Music/Stems -j 2 -n htdemucs`
+
+# Uses inotify on Linux and polls the folder elsewhere. A file is only picked
+# up once its size and mtime have been stable for `--settle` seconds (so that
+# half-downloaded files are ignored), then a worker runs Stemgen on it.
+# Processed inputs are moved to `done/` or `failed/` in the inbox, next to the
+# log of their job (renamed `NAME (2).EXT` etc. if the name is taken). Any
+# other option is passed to `stemgen`.
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stemgen.cli import PYTHON_EXEC, SUPPORTED_FILES
+
+POLL_INTERVAL = 2.0
+SETTLE_SECONDS = 3.0
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class _Inotify:
+    """Minimal inotify binding, only used to wake up the watcher"""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {path}")
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        # The events are not parsed: the folder is scanned again
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    def wait(self, timeout):
+        time.sleep(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+        return True
+
+    def close(self):
+        pass
+
+
+def _open_watcher(path):
+    if sys.platform.startswith("linux"):
+        try:
+            return _Inotify(path)
+        except (OSError, AttributeError) as e:
+            print(f"inotify not available ({e}), polling instead.")
+    return _Poller()
+
+
+def _scan(inbox):
+    """Supported files at the top of the inbox, with their size and mtime"""
+    files = {}
+
+    for entry in os.scandir(inbox):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        if os.path.splitext(entry.name)[1] not in SUPPORTED_FILES:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+    return files
+
+
+def _move(path, folder):
+    """Move `path` to `folder`, as `NAME (2).EXT` etc. if the name is taken"""
+    os.makedirs(folder, exist_ok=True)
+    name, extension = os.path.splitext(os.path.basename(path))
+    destination = os.path.join(folder, name + extension)
+    count = 1
+    while os.path.exists(destination) or os.path.exists(destination + ".log"):
+        count += 1
+        destination = os.path.join(folder, f"{name} ({count}){extension}")
+    os.replace(path, destination)
+    return destination
+
+
+def process(path, output_path, done_path, failed_path, stemgen_args):
+    """Run Stemgen on `path` and move it to `done_path` or `failed_path`"""
+    name = os.path.basename(path)
+    print(f"Processing {name}...")
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [PYTHON_EXEC, "-m", "stemgen", path, "-o", output_path] + stemgen_args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    seconds = time.perf_counter() - start
+
+    folder = done_path if result.returncode == 0 else failed_path
+    destination = _move(path, folder)
+    with open(destination + ".log", "wb") as f:
+        f.write(result.stdout)
+
+    if result.returncode == 0:
+        print(f"Done: {name} ({seconds:.1f}s)")
+    else:
+        print(f"Failed: {name}, see {destination}.log")
+
+    return result.returncode
+
+
+def watch(inbox, output_path, workers, settle, done_path, failed_path, stemgen_args):
+    print(f"Watching {inbox} with {workers} worker(s)...")
+
+    watcher = _open_watcher(inbox)
+    pending = {}  # path -> (size, mtime, stable since)
+    queued = {}  # path -> (size, mtime)
+    # Files whose job raised (e.g. they couldn't be moved), skipped until they
+    # change so that they aren't processed again and again
+    failed = {}  # path -> (size, mtime)
+
+    def _done(future, path):
+        stat = queued.pop(path)
+        if future.exception() is not None:
+            failed[path] = stat
+            print(
+                f"Failed: {os.path.basename(path)}: {future.exception()!r}, "
+                "skipped until it changes"
+            )
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                now = time.monotonic()
+                files = _scan(inbox)
+
+                for path, stat in files.items():
+                    if path in queued or failed.get(path) == stat:
+                        continue
+                    if path not in pending or pending[path][:2] != stat:
+                        pending[path] = (*stat, now)
+                    elif now - pending[path][2] >= settle:
+                        del pending[path]
+                        queued[path] = stat
+                        future = executor.submit(
+                            process,
+                            path,
+                            output_path,
+                            done_path,
+                            failed_path,
+                            stemgen_args,
+                        )
+                        future.add_done_callback(lambda f, path=path: _done(f, path))
+
+                # Forget the files that went away
+                for path in list(pending):
+                    if path not in files:
+                        del pending[path]
+                for path in list(failed):
+                    if path not in files:
+                        del failed[path]
+
+                # Wake up on changes, and regularly while files are settling
+                watcher.wait(min(settle, POLL_INTERVAL) if pending else POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("Stopping, waiting for the running jobs...")
+    finally:
+        watcher.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="stemgen watch",
+        description="Create the stem files of the tracks dropped in a folder. "
+        "Unknown options are passed to stemgen.",
+    )
+    parser.add_argument("inbox", help="the folder to watch")
+    parser.add_argument(
+        "-o", "--output", dest="output", default=".", help="the path to the output folder"
+    )
+    parser.add_argument(
+        "-j", "--workers", dest="workers", type=int, default=1, help="number of parallel jobs"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=SETTLE_SECONDS,
+        help="seconds a file must stay unchanged before it is processed",
+    )
+    parser.add_argument("--done", help="where to move the processed inputs (default: INBOX/done)")
+    parser.add_argument("--failed", help="where to move the failed inputs (default: INBOX/failed)")
+    args, stemgen_args = parser.parse_known_args(argv)
+
+    # The input is moved once its job exits: the previews must be upgraded first
+    if "--preview" in stemgen_args and "--preview-wait" not in stemgen_args:
+        stemgen_args.append("--preview-wait")
+
+    inbox = os.path.abspath(args.inbox)
+    if not os.path.isdir(inbox):
+        print(f"{inbox} is not a folder.")
+        sys.exit(1)
+
+    watch(
+        inbox,
+        os.path.abspath(args.output),
+        max(1, args.workers),
+        args.settle,
+        os.path.abspath(args.done or os.path.join(inbox, "done")),
+        os.path.abspath(args.failed or os.path.join(inbox, "failed")),
+        stemgen_args,
+    )
+
+
+if __name__ == "__main__":
+    main()